@@ -0,0 +1,141 @@
+"""
+Broker de mensagens entre workers do backend.
+
+Cada worker (uvicorn --workers N, ou vários hosts) liga-se aqui e anuncia quem está
+conectado a ele. O broker mantém o registo de presença do cluster, reencaminha as
+mensagens para o worker certo e replica eventos de sistema (ex.: mudança no anel Chord).
+
+Uso:
+    python -m app.broker                                  # socket Unix padrão
+    python -m app.broker --address tcp://0.0.0.0:7800     # vários hosts
+"""
+import argparse
+import asyncio
+import json
+import os
+from typing import Dict, Set
+
+from .services.message_bus import BROKER_ADDRESS, BUS_LINE_LIMIT, parse_address
+
+DRAIN_THRESHOLD = 64 * 1024
+
+
+class Broker:
+    def __init__(self):
+        # worker -> ligação
+        self.workers: Dict[str, asyncio.StreamWriter] = {}
+        # usuário -> workers onde está conectado
+        self.presence: Dict[str, Set[str]] = {}
+
+    def _send(self, writer: asyncio.StreamWriter, frame: dict):
+        writer.write(json.dumps(frame, separators=(",", ":")).encode() + b"\n")
+
+    def _send_others(self, origin: str, frame: dict):
+        for worker_id, writer in self.workers.items():
+            if worker_id != origin:
+                self._send(writer, frame)
+
+    def _join(self, worker_id: str, username: str):
+        holders = self.presence.setdefault(username, set())
+        first = not holders
+        holders.add(worker_id)
+        if first:
+            self._send_others(worker_id, {"op": "presence", "user": username, "online": True})
+
+    def _leave(self, worker_id: str, username: str):
+        holders = self.presence.get(username)
+        if not holders or worker_id not in holders:
+            return
+        holders.discard(worker_id)
+        if not holders:
+            del self.presence[username]
+            self._send_others(worker_id, {"op": "presence", "user": username, "online": False})
+
+    def _remote_users(self, worker_id: str):
+        """Usuários online em algum worker que não o indicado."""
+        return sorted(u for u, holders in self.presence.items() if holders - {worker_id})
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker_id = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                frame = json.loads(line)
+                op = frame.get("op")
+
+                if op == "hello":
+                    worker_id = frame["worker"]
+                    self.workers[worker_id] = writer
+                    self._send(writer, {"op": "snapshot", "users": self._remote_users(worker_id)})
+                    for username in frame.get("users", []):
+                        self._join(worker_id, username)
+                    print(f"🛰️ Worker ligado: {worker_id}")
+                elif worker_id is None:
+                    continue
+                elif op == "join":
+                    self._join(worker_id, frame["user"])
+                elif op == "leave":
+                    self._leave(worker_id, frame["user"])
+                elif op == "send":
+                    holders = [h for h in self.presence.get(frame["to"], ()) if h != worker_id]
+                    deliver = {"op": "deliver", "to": frame["to"], "msg": frame["msg"]}
+                    if "ref" in frame:
+                        # Pedido com confirmação: cada worker destino responde com um "ack" à origem
+                        deliver["ref"], deliver["from"], deliver["holders"] = frame["ref"], worker_id, len(holders)
+                        if not holders:
+                            self._send(writer, {"op": "ack", "ref": frame["ref"], "ok": False, "holders": 0})
+                    for holder in holders:
+                        self._send(self.workers[holder], deliver)
+                elif op == "ack":
+                    origin = self.workers.get(frame["worker"])
+                    if origin is not None:
+                        self._send(origin, {
+                            "op": "ack", "ref": frame["ref"], "ok": frame["ok"], "holders": frame.get("holders", 1),
+                        })
+                elif op == "broadcast":
+                    self._send_others(worker_id, {"op": "broadcast", "msg": frame["msg"]})
+                elif op == "event":
+                    self._send_others(worker_id, {"op": "event", "event": frame["event"], "data": frame.get("data", {})})
+
+                # Backpressure: não lê mais deste worker enquanto algum destino estiver atrasado
+                lagging = [w for w in self.workers.values() if w.transport.get_write_buffer_size() > DRAIN_THRESHOLD]
+                if lagging:
+                    await asyncio.gather(*(w.drain() for w in lagging), return_exceptions=True)
+        except (ConnectionError, ValueError, KeyError) as e:
+            print(f"⚠️ Erro com worker {worker_id}: {e}")
+        finally:
+            if worker_id is not None and self.workers.get(worker_id) is writer:
+                del self.workers[worker_id]
+                for username in [u for u, holders in self.presence.items() if worker_id in holders]:
+                    self._leave(worker_id, username)
+                print(f"🛰️ Worker desligado: {worker_id}")
+            writer.close()
+
+    async def serve(self, address: str):
+        kind, target = parse_address(address)
+        if kind == "unix":
+            if os.path.exists(target):
+                os.unlink(target)
+            server = await asyncio.start_unix_server(self.handle, target, limit=BUS_LINE_LIMIT)
+        else:
+            host, port = target
+            server = await asyncio.start_server(self.handle, host, port, limit=BUS_LINE_LIMIT)
+        print(f"🛰️ Broker a escutar em {address}")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broker de mensagens do Okupopia")
+    parser.add_argument("--address", default=BROKER_ADDRESS, help="unix:/caminho.sock ou tcp://host:porta")
+    args = parser.parse_args()
+    try:
+        asyncio.run(Broker().serve(args.address))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
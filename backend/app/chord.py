@@ -1,6 +1,16 @@
-from typing import List, Optional, Dict, Any
+import os
+from bisect import bisect_left
+from functools import lru_cache
+from hashlib import blake2b
+from typing import List, Optional, Dict, Any, Sequence, Tuple
 from pydantic import BaseModel
 
+try:
+    import numpy as np
+except ImportError:
+    # NumPy é opcional: sem ele as funções em lote usam o laço puro
+    np = None
+
 # Schema para validação e tipagem (equivalente à interface ChordNode)
 class ChordNode(BaseModel):
     id: int
@@ -23,68 +33,255 @@ def hash_string(string: str) -> int:
         
     return abs(hash_val)
 
+# Abaixo deste tamanho o custo de montar os arrays NumPy supera o ganho
+VECTOR_MIN_BATCH = 64
+
+def _hash_strings_vectorized(keys: List[str]):
+    """hash_string coluna a coluna sobre todas as chaves (aritmética uint32 com wrap-around)."""
+    lengths = np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+    width = int(lengths.max())
+    if width == 0:
+        return np.zeros(len(keys), dtype=np.int64)
+    # dtype <U guarda cada caractere como um code point UCS-4, completando com zeros à direita
+    codes = np.array(keys, dtype=f"<U{width}").view(np.uint32).reshape(len(keys), width)
+    hashes = np.zeros(len(keys), dtype=np.uint32)
+    for column in range(width):
+        updated = hashes * np.uint32(31) + codes[:, column]
+        hashes = np.where(lengths > column, updated, hashes)
+    # Mesma conversão para signed 32-bit + abs() do laço puro
+    return np.abs(hashes.view(np.int32).astype(np.int64))
+
+def hash_strings(keys: Sequence[str]) -> List[int]:
+    """hash_string para muitas chaves de uma vez (vetorizado quando o NumPy está instalado)."""
+    keys = list(keys)
+    if np is None or len(keys) < VECTOR_MIN_BATCH:
+        return [hash_string(k) for k in keys]
+    return _hash_strings_vectorized(keys).tolist()
+
+def get_chord_positions(keys: Sequence[str]) -> List[int]:
+    """get_chord_position em lote, sem passar pelo cache LRU."""
+    return [h % 256 for h in hash_strings(keys)]
+
+# Cache LRU das posições: a mesma chave (user:x, node:y) é consultada a cada frame do chat
+POSITION_CACHE_SIZE = 65536
+
+@lru_cache(maxsize=POSITION_CACHE_SIZE)
 def get_chord_position(key: str) -> int:
     return hash_string(key) % 256
 
-def find_responsible_node(key: str, nodes: List[ChordNode]) -> Optional[ChordNode]:
-    """Encontra o nó sucessor responsável, ignorando nós inativos."""
-    # 1. Filtra apenas os nós ativos
-    active_nodes = [n for n in nodes if n.active]
-    if not active_nodes:
-        return None
-
-    position = get_chord_position(key)
-    
-    # 2. Mapeia e ordena as posições apenas dos ativos
-    node_positions = []
-    for n in active_nodes:
-        node_positions.append({
-            "node": n,
-            "pos": get_chord_position(f"node:{n.id}")
-        })
-    
-    # Ordenação crucial para o anel
-    sorted_nodes = sorted(node_positions, key=lambda x: x["pos"])
-
-    # 3. Busca o sucessor
-    for entry in sorted_nodes:
-        if entry["pos"] >= position:
-            return entry["node"]
-
-    # 4. Wrap around: se a posição da chave for maior que o último nó, 
-    # o responsável é o primeiro nó do anel (o menor hash)
-    return sorted_nodes[0]["node"]
+@lru_cache(maxsize=POSITION_CACHE_SIZE)
+def hash32(key: str) -> int:
+    """Posição no espaço completo de 32 bits (BLAKE2b truncado, calculado em C)."""
+    return int.from_bytes(blake2b(key.encode(), digest_size=4).digest(), "big")
 
-def get_replica_nodes(key: str, nodes: List[ChordNode], count: int = 3) -> List[ChordNode]:
-    """Retorna as réplicas apenas entre os nós que estão ONLINE."""
-    active_nodes = [n for n in nodes if n.active]
-    if not active_nodes:
-        return []
+def hash32_many(keys: Sequence[str]) -> List[int]:
+    """hash32 em lote, sem passar pelo cache LRU."""
+    from_bytes = int.from_bytes
+    return [from_bytes(blake2b(k.encode(), digest_size=4).digest(), "big") for k in keys]
 
-    primary = find_responsible_node(key, nodes)
-    if not primary:
-        return []
+# Versões do anel:
+#   1 = legado: hash_string(key) % 256 e um único ponto por nó
+#   2 = espaço de 32 bits com `vnodes` pontos virtuais por nó físico
+LEGACY_RING_VERSION = 1
+VNODE_RING_VERSION = 2
+
+class RingConfig(BaseModel):
+    version: int = LEGACY_RING_VERSION
+    vnodes: int = 1
+
+    @property
+    def space(self) -> int:
+        """Tamanho do espaço de posições do anel."""
+        return 256 if self.version == LEGACY_RING_VERSION else 2 ** 32
+
+    def position(self, key: str) -> int:
+        if self.version == LEGACY_RING_VERSION:
+            return get_chord_position(key)
+        return hash32(key)
+
+    def positions(self, keys: Sequence[str]) -> List[int]:
+        """
+        Posições de muitas chaves (colocação em massa: rebalanceamento, painel admin).
+        Só o hash legado (v1) é vetorizado com NumPy; no v2 o custo é o próprio BLAKE2b de cada
+        chave (já em C), por isso o lote apenas evita o cache LRU e as chamadas por chave.
+        """
+        if self.version == LEGACY_RING_VERSION:
+            return get_chord_positions(keys)
+        return hash32_many(keys)
+
+    def node_points(self, node_id: int) -> List[int]:
+        """Posições dos pontos (virtuais) de um nó físico."""
+        if self.version == LEGACY_RING_VERSION:
+            return [get_chord_position(f"node:{node_id}")]
+        return [hash32(f"node:{node_id}#{v}") for v in range(self.vnodes)]
+
+LEGACY_RING = RingConfig()
+
+def default_ring_config() -> RingConfig:
+    """Configuração para anéis novos (sem estado gravado), ajustável por variável de ambiente."""
+    return RingConfig(
+        version=int(os.getenv("CHORD_RING_VERSION", str(VNODE_RING_VERSION))),
+        vnodes=int(os.getenv("CHORD_VNODES", "64")),
+    )
+
+# Intervalo de posições (start, end]: se start > end dá a volta no anel; start == end é o anel inteiro
+KeyRange = Tuple[int, int]
+
+def in_range(position: int, start: int, end: int) -> bool:
+    if start < end:
+        return start < position <= end
+    if start > end:
+        return position > start or position <= end
+    return True
+
+class ChordRing:
+    """
+    Fotografia imutável do anel com os pontos dos nós ativos ordenados pela posição.
+    Deve ser reconstruída sempre que a lista de nós mudar (startup, toggle);
+    as consultas fazem apenas uma busca binária sobre as posições.
+    """
+    __slots__ = ("config", "_positions", "_nodes", "_distinct")
 
-    # Ordena os ativos para definir a vizinhança no anel
-    node_positions = sorted([
-        {"node": n, "pos": get_chord_position(f"node:{n.id}")}
-        for n in active_nodes
-    ], key=lambda x: x["pos"])
-    
-    # Localiza o índice do primário no array de ativos
-    try:
-        primary_idx = next(i for i, x in enumerate(node_positions) if x["node"].id == primary.id)
-    except StopIteration:
+    def __init__(self, nodes: List[ChordNode], config: RingConfig = LEGACY_RING):
+        self.config = config
+        entries = [(pos, n) for n in nodes if n.active for pos in config.node_points(n.id)]
+        # sort estável: posições repetidas mantêm a ordem original dos nós
+        entries.sort(key=lambda e: e[0])
+        self._positions: Tuple[int, ...] = tuple(pos for pos, _ in entries)
+        self._nodes: Tuple[ChordNode, ...] = tuple(node for _, node in entries)
+        self._distinct = len({n.id for n in self._nodes})
+
+    def __len__(self) -> int:
+        return self._distinct
+
+    @property
+    def nodes(self) -> Tuple[ChordNode, ...]:
+        """Nós ativos (sem repetições), pela ordem do primeiro ponto de cada um no anel."""
+        return tuple({n.id: n for n in self._nodes}.values())
+
+    def position(self, key: str) -> int:
+        return self.config.position(key)
+
+    def boundaries(self) -> Tuple[int, ...]:
+        return self._positions
+
+    def _successor_index(self, position: int) -> int:
+        idx = bisect_left(self._positions, position)
+        # Wrap around: depois do último ponto, o responsável é o primeiro do anel
+        return idx if idx < len(self._positions) else 0
+
+    def owners_at(self, position: int, count: int) -> List[ChordNode]:
+        """Os `count` primeiros nós físicos distintos a partir da posição, no sentido do anel."""
+        if not self._positions:
+            return []
+        return self._owners_from(self._successor_index(position), count)
+
+    def _owners_from(self, start: int, count: int) -> List[ChordNode]:
+        total = len(self._positions)
+        wanted = min(count, self._distinct)
+        owners: List[ChordNode] = []
+        seen = set()
+        for i in range(total):
+            node = self._nodes[(start + i) % total]
+            if node.id not in seen:
+                seen.add(node.id)
+                owners.append(node)
+                if len(owners) == wanted:
+                    break
+        return owners
+
+    def find_responsible_node(self, key: str) -> Optional[ChordNode]:
+        """Encontra o nó sucessor responsável pela chave."""
+        if not self._nodes:
+            return None
+        return self._nodes[self._successor_index(self.position(key))]
+
+    def get_replica_nodes(self, key: str, count: int = 3) -> List[ChordNode]:
+        """O primário seguido dos seus sucessores, até `count` nós físicos distintos."""
+        return self.owners_at(self.position(key), count)
+
+    def place_positions(self, positions: Sequence[int], count: int = 1) -> List[List[ChordNode]]:
+        """
+        get_replica_nodes para muitas posições: os sucessores vêm de uma busca binária
+        vetorizada e as réplicas são calculadas uma vez por ponto do anel, não por chave.
+        As listas devolvidas são partilhadas entre chaves com o mesmo sucessor: não as altere.
+        """
+        total = len(self._positions)
+        if not total:
+            return [[] for _ in positions]
+        if np is not None and len(positions) >= VECTOR_MIN_BATCH:
+            indexes = np.searchsorted(np.asarray(self._positions, dtype=np.int64), np.asarray(positions, dtype=np.int64))
+            indexes[indexes == total] = 0
+            indexes = indexes.tolist()
+        else:
+            indexes = [self._successor_index(p) for p in positions]
+        owners: Dict[int, List[ChordNode]] = {}
+        placements = []
+        for index in indexes:
+            replicas = owners.get(index)
+            if replicas is None:
+                replicas = owners[index] = self._owners_from(index, count)
+            placements.append(replicas)
+        return placements
+
+    def place_many(self, keys: Sequence[str], count: int = 1) -> List[List[ChordNode]]:
+        """Réplicas (primário primeiro) de muitas chaves de uma vez."""
+        return self.place_positions(self.config.positions(keys), count)
+
+    def load_spread(self) -> Dict[int, float]:
+        """Fração do espaço de chaves de que cada nó é primário."""
+        total = len(self._positions)
+        if total == 1:
+            return {self._nodes[0].id: 1.0}
+        space = self.config.space
+        share: Dict[int, float] = {n.id: 0.0 for n in self._nodes}
+        for i in range(total):
+            arc = (self._positions[i] - self._positions[i - 1]) % space
+            share[self._nodes[i].id] += arc / space
+        return share
+
+def changed_ranges(old: ChordRing, new: ChordRing, replicas: int = 1) -> List[KeyRange]:
+    """
+    Intervalos de posições cujos `replicas` responsáveis mudam de `old` para `new`.
+    Apenas as chaves nesses intervalos precisam de ser rebalanceadas.
+    Os dois anéis têm de usar a mesma configuração.
+    """
+    if old.config != new.config:
+        raise ValueError("Anéis com configurações diferentes não são comparáveis")
+    cuts = sorted(set(old.boundaries()) | set(new.boundaries()))
+    if not cuts:
         return []
-    
-    replicas = []
-    num_to_get = min(count, len(active_nodes))
-    
-    for i in range(num_to_get):
-        next_idx = (primary_idx + i) % len(node_positions)
-        replicas.append(node_positions[next_idx]["node"])
-        
-    return replicas
+    if not old.boundaries() or not new.boundaries():
+        return [(cuts[0], cuts[0])]
+
+    # Cada segmento elementar (cuts[i-1], cuts[i]] tem os mesmos responsáveis em cada anel
+    moved: List[KeyRange] = []
+    for i, end in enumerate(cuts):
+        start = cuts[i - 1]
+        before = [n.id for n in old.owners_at(end, replicas)]
+        after = [n.id for n in new.owners_at(end, replicas)]
+        if before == after:
+            continue
+        if moved and moved[-1][1] == start:
+            moved[-1] = (moved[-1][0], end)
+        else:
+            moved.append((start, end))
+    if len(cuts) == 1:
+        return [(cuts[0], cuts[0])] if moved else []
+    # Junta o último com o primeiro se se tocarem na volta do anel
+    if len(moved) > 1 and moved[-1][1] == moved[0][0]:
+        moved[0] = (moved[-1][0], moved[0][1])
+        moved.pop()
+    return moved
+
+def find_responsible_node(key: str, nodes: List[ChordNode]) -> Optional[ChordNode]:
+    """Encontra o nó sucessor responsável, ignorando nós inativos.
+    Monta um anel temporário; em caminhos quentes use um ChordRing já construído."""
+    return ChordRing(nodes).find_responsible_node(key)
+
+def get_replica_nodes(key: str, nodes: List[ChordNode], count: int = 3) -> List[ChordNode]:
+    """Retorna as réplicas apenas entre os nós que estão ONLINE."""
+    return ChordRing(nodes).get_replica_nodes(key, count)
 
 def initialize_nodes() -> List[ChordNode]:
     """Inicializa os nós padrão."""
@@ -1,48 +1,308 @@
+import asyncio
+import json
 import os
-from typing import Any, List, Optional
-from supabase._async.client import create_client as create_async_client, AsyncClient
+from collections import OrderedDict
+from time import monotonic, perf_counter
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    # orjson é opcional: só acelera as cópias das leituras partilhadas
+    orjson = None
+
+from . import metrics
+from .storage import KVBackend, MemoryBackend, ShardedBackend, SQLiteBackend, SupabaseBackend
+from .storage.supabase import TABLE_NAME
+
 load_dotenv()
 
 url: str = os.getenv("SUPABASE_URL")
 key: str = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
-# Variável global que será preenchida no startup
-supabase: AsyncClient = None
+# Motor de armazenamento: "supabase" (padrão), "sqlite", "memory" ou "sharded"
+KV_BACKEND = os.getenv("KV_BACKEND", "supabase").lower()
+KV_SQLITE_PATH = os.getenv("KV_SQLITE_PATH", "okupopia.db")
+
+# Modo "sharded": uma partição por nó Chord, cada uma com o motor KV_SHARD_ENGINE
+# (sqlite: um ficheiro por nó em KV_SHARD_DIR; supabase: uma tabela {TABLE_NAME}_node{id} por nó)
+KV_SHARD_ENGINE = os.getenv("KV_SHARD_ENGINE", "sqlite").lower()
+KV_SHARD_DIR = os.getenv("KV_SHARD_DIR", "shards")
+KV_REPLICAS = int(os.getenv("KV_REPLICAS", "3"))
+KV_WRITE_QUORUM = int(os.getenv("KV_WRITE_QUORUM", "2"))
+KV_READ_QUORUM = int(os.getenv("KV_READ_QUORUM", "1"))
+
+# Cache de snapshots dos scans por prefixo (segundos; 0 desliga). As escritas deste processo
+# invalidam-no na hora; as de outros workers só são vistas quando o snapshot expira.
+KV_SNAPSHOT_TTL = float(os.getenv("KV_SNAPSHOT_TTL", "0"))
+KV_SNAPSHOT_MAX_ENTRIES = int(os.getenv("KV_SNAPSHOT_MAX_ENTRIES", "1024"))
+
+if orjson is not None:
+    _encode, _decode = orjson.dumps, orjson.loads
+else:
+    _encode, _decode = json.dumps, json.loads
+
+def create_shard(engine: str, name: str) -> KVBackend:
+    if engine == "sqlite":
+        os.makedirs(KV_SHARD_DIR, exist_ok=True)
+        return SQLiteBackend(os.path.join(KV_SHARD_DIR, f"{name}.db"))
+    if engine == "supabase":
+        return SupabaseBackend(url, key, table=f"{TABLE_NAME}_{name}")
+    if engine == "memory":
+        return MemoryBackend()
+    raise ValueError(f"KV_SHARD_ENGINE desconhecido: {engine}")
+
+def create_backend(name: str = KV_BACKEND) -> KVBackend:
+    if name == "supabase":
+        return SupabaseBackend(url, key)
+    if name == "sqlite":
+        return SQLiteBackend(KV_SQLITE_PATH)
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sharded":
+        return ShardedBackend(
+            meta=create_shard(KV_SHARD_ENGINE, "meta"),
+            shard_factory=lambda node_id: create_shard(KV_SHARD_ENGINE, f"node{node_id}"),
+            replicas=KV_REPLICAS,
+            write_quorum=KV_WRITE_QUORUM,
+            read_quorum=KV_READ_QUORUM,
+        )
+    raise ValueError(f"KV_BACKEND desconhecido: {name}")
+
+class _Flight:
+    """Uma leitura em curso no motor, partilhada por todas as chamadas idênticas que chegarem entretanto."""
+
+    __slots__ = ("done", "joined", "blob", "stale")
 
-async def init_supabase():
-    global supabase
-    if supabase is None:
-        # O segredo está no 'await' aqui
-        supabase = await create_async_client(url, key)
+    def __init__(self):
+        self.done: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.joined = 0
+        self.blob: Optional[bytes] = None
+        # Uma escrita num prefixo observado: quem chegar depois não pode reaproveitar este resultado
+        self.stale = False
 
-TABLE_NAME = "kv_store_aef9e41b"
 
 class KVStore:
-    @staticmethod
-    async def set(key: str, value: Any):
-        await init_supabase() # Garante que o cliente existe
-        response = await supabase.table(TABLE_NAME).upsert({"key": key, "value": value}).execute()
-        return response
-
-    @staticmethod
-    async def get(key: str) -> Optional[Any]:
-        await init_supabase()
-        response = await supabase.table(TABLE_NAME).select("value").eq("key", key).maybe_single().execute()
-        if response and hasattr(response, 'data') and response.data:
-            return response.data.get("value")
-        return None
-
-    @staticmethod
-    async def delete(key: str):
-        await init_supabase()
-        await supabase.table(TABLE_NAME).delete().eq("key", key).execute()
-
-    @staticmethod
-    async def get_by_prefix(prefix: str) -> List[Any]:
-        await init_supabase()
-        response = await supabase.table(TABLE_NAME).select("value").like("key", f"{prefix}%").execute()
-        return [d["value"] for d in response.data] if response.data else []
-
-kv = KVStore()
\ No newline at end of file
+    """
+    Fachada usada pela aplicação; delega para o motor configurado.
+    Leituras idênticas concorrentes partilham uma única ida ao motor (single-flight) e,
+    com KV_SNAPSHOT_TTL > 0, os resultados dos scans por prefixo ficam em cache por alguns
+    instantes. Cada escrita invalida as consultas (em curso ou em cache) dos prefixos das chaves
+    escritas, por isso quem escreve e depois lê vê sempre a própria escrita.
+    """
+
+    def __init__(self, backend: KVBackend, snapshot_ttl: float = KV_SNAPSHOT_TTL,
+                 snapshot_max_entries: int = KV_SNAPSHOT_MAX_ENTRIES):
+        self.backend = backend
+        self.snapshot_ttl = snapshot_ttl
+        self.snapshot_max_entries = snapshot_max_entries
+        self._flights: Dict[tuple, _Flight] = {}
+        self._snapshots: "OrderedDict[tuple, Tuple[float, bytes, str]]" = OrderedDict()
+        # prefixo observado -> {consulta: referências (voos e snapshots)}
+        self._watched: Dict[str, Dict[tuple, int]] = {}
+
+    async def connect(self):
+        await self.backend.connect()
+
+    async def close(self):
+        await self.backend.close()
+
+    def set_ring(self, ring, handoff: bool = True):
+        """Informa o motor do anel Chord atual (relevante só no modo particionado)."""
+        self.backend.set_ring(ring, handoff)
+        # Com o anel novo as leituras podem vir de outras réplicas
+        self.clear_snapshots()
+
+    async def rebalance(self, old, new) -> int:
+        return await self.backend.rebalance(old, new)
+
+    def replication_status(self) -> Optional[dict]:
+        return self.backend.replication_status()
+
+    async def _timed(self, op: str, call: Awaitable):
+        """Executa a operação do motor medindo latência e falhas (contadores pré-alocados por operação)."""
+        m = metrics.KV[op]
+        start = perf_counter()
+        try:
+            return await call
+        except Exception:
+            m.errors.inc()
+            raise
+        finally:
+            m.latency.observe(perf_counter() - start)
+
+    # --- Leituras partilhadas ---
+
+    def _watch(self, prefixes: Iterable[str], query: tuple, delta: int):
+        for prefix in prefixes:
+            queries = self._watched.setdefault(prefix, {})
+            count = queries.get(query, 0) + delta
+            if count > 0:
+                queries[query] = count
+            else:
+                queries.pop(query, None)
+                if not queries:
+                    del self._watched[prefix]
+
+    def _drop_snapshot(self, query: tuple):
+        snapshot = self._snapshots.pop(query, None)
+        if snapshot is not None:
+            self._watch((snapshot[2],), query, -1)
+
+    def clear_snapshots(self):
+        for query in list(self._snapshots):
+            self._drop_snapshot(query)
+
+    def _invalidate(self, keys: Iterable[str]):
+        """Marca como desatualizadas as consultas que observam algum prefixo das chaves escritas."""
+        if not self._watched:
+            return
+        watched = self._watched
+        for key in keys:
+            for i in range(len(key) + 1):
+                queries = watched.get(key[:i])
+                if not queries:
+                    continue
+                for query in list(queries):
+                    flight = self._flights.get(query)
+                    if flight is not None:
+                        flight.stale = True
+                    self._drop_snapshot(query)
+
+    async def _read(self, op: str, query: tuple, prefixes: Tuple[str, ...], call: Callable[[], Awaitable],
+                    count: Callable[[Any], int], snapshot: bool = False):
+        if snapshot and self.snapshot_ttl > 0:
+            cached = self._snapshots.get(query)
+            if cached is not None:
+                if cached[0] > monotonic():
+                    self._snapshots.move_to_end(query)
+                    metrics.KV[op].snapshot_hits.inc()
+                    return _decode(cached[1])
+                self._drop_snapshot(query)
+
+        flight = self._flights.get(query)
+        if flight is not None and not flight.stale:
+            # Mesma consulta já a caminho do motor: espera por ela e recebe uma cópia própria
+            flight.joined += 1
+            metrics.KV[op].coalesced.inc()
+            try:
+                await asyncio.shield(flight.done)
+            except asyncio.CancelledError:
+                if not flight.done.cancelled():
+                    raise
+                # Quem fazia a consulta foi cancelado (não nós): tenta de novo
+                return await self._read(op, query, prefixes, call, count, snapshot)
+            return _decode(flight.blob)
+
+        flight = self._flights[query] = _Flight()
+        self._watch(prefixes, query, 1)
+        try:
+            result = await self._timed(op, call())
+        except BaseException as e:
+            if flight.joined:
+                if isinstance(e, asyncio.CancelledError):
+                    flight.done.cancel()
+                else:
+                    flight.done.set_exception(e)
+            raise
+        finally:
+            # A partir daqui quem chegar faz a sua própria consulta (ou usa o snapshot)
+            if self._flights.get(query) is flight:
+                del self._flights[query]
+            self._watch(prefixes, query, -1)
+        metrics.KV[op].items.observe(count(result))
+
+        cache = snapshot and self.snapshot_ttl > 0 and not flight.stale
+        if flight.joined or cache:
+            # Serializado uma única vez, antes de o chamador poder alterar o resultado
+            flight.blob = _encode(result)
+            flight.done.set_result(None)
+        if cache:
+            self._drop_snapshot(query)
+            self._snapshots[query] = (monotonic() + self.snapshot_ttl, flight.blob, prefixes[0])
+            self._watch(prefixes, query, 1)
+            while len(self._snapshots) > self.snapshot_max_entries:
+                self._drop_snapshot(next(iter(self._snapshots)))
+        return result
+
+    # --- Operações ---
+
+    async def set(self, key: str, value: Any):
+        try:
+            await self._timed("set", self.backend.set(key, value))
+        finally:
+            self._invalidate((key,))
+        metrics.KV["set"].items.observe(1)
+
+    async def get(self, key: str) -> Optional[Any]:
+        return await self._read(
+            "get", ("get", key), (key,),
+            lambda: self.backend.get(key),
+            lambda value: 0 if value is None else 1,
+        )
+
+    async def delete(self, key: str):
+        try:
+            await self._timed("delete", self.backend.delete(key))
+        finally:
+            self._invalidate((key,))
+        metrics.KV["delete"].items.observe(1)
+
+    async def get_by_prefix(self, prefix: str) -> List[Any]:
+        return await self._read(
+            "get_by_prefix", ("get_by_prefix", prefix), (prefix,),
+            lambda: self.backend.get_by_prefix(prefix),
+            len, snapshot=True,
+        )
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Busca várias chaves numa única ida ao banco. Chaves ausentes não aparecem no resultado."""
+        keys = tuple(dict.fromkeys(keys))
+        return await self._read(
+            "get_many", ("get_many",) + keys, keys,
+            lambda: self.backend.get_many(keys),
+            len,
+        )
+
+    async def set_many(self, items: Dict[str, Any]):
+        try:
+            await self._timed("set_many", self.backend.set_many(items))
+        finally:
+            self._invalidate(items)
+        metrics.KV["set_many"].items.observe(len(items))
+
+    async def delete_many(self, keys: Iterable[str]):
+        keys = list(keys)
+        try:
+            await self._timed("delete_many", self.backend.delete_many(keys))
+        finally:
+            self._invalidate(keys)
+        metrics.KV["delete_many"].items.observe(len(keys))
+
+    async def delete_unchanged(self, expected: Dict[str, Any]) -> List[str]:
+        """Remove só as chaves que ainda têm o valor esperado (ver KVBackend.delete_unchanged)."""
+        deleted: List[str] = []
+        try:
+            deleted = await self._timed("delete_unchanged", self.backend.delete_unchanged(expected))
+        finally:
+            self._invalidate(expected)
+        metrics.KV["delete_unchanged"].items.observe(len(deleted))
+        return deleted
+
+    async def scan(
+        self,
+        prefix: str = "",
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        limit: Optional[int] = None,
+        reverse: bool = False,
+    ) -> List[Tuple[str, Any]]:
+        """Range scan ordenado pela chave (ver KVBackend.scan)."""
+        return await self._read(
+            "scan", ("scan", prefix, after, before, limit, reverse), (prefix,),
+            lambda: self.backend.scan(prefix, after, before, limit, reverse),
+            len, snapshot=True,
+        )
+
+kv = KVStore(create_backend())
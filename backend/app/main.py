@@ -1,17 +1,23 @@
-import json
-import os
+import asyncio
 import time
 import uuid
-from typing import List
+from typing import List, Optional
 from fastapi import APIRouter, FastAPI, WebSocket, WebSocketDisconnect, Body, Query, Path, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from supabase import create_client, Client
 
 # Importações internas
 from .database import kv
-from . import chord
+from . import chord, metrics
 from .services.websocket_manager import manager 
+from .services import message_store, wire
+from .services.user_cache import user_cache
+from .services import user_directory
+from .services.operation_log import operation_log
+from .services.compactor import compactor
+from .services.offline_queue import offline_queue
+from .services.node_stats import node_stats, REPLICATION_FACTOR
 
 app = FastAPI(title="Okupopia API", version="1.0.0")
 
@@ -23,56 +29,132 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+
+# Tempo de consulta ao anel no roteamento das mensagens do chat
+ROUTE_LOOKUP_TIME = metrics.CHORD_LOOKUP.labels("route_message")
 
 # Criamos o roteador com o prefixo necessário
 api_router = APIRouter(prefix="/make-server-aef9e41b")
 
-# --- CLIENTE SUPABASE ---
-url: str = os.getenv("SUPABASE_URL")
-key: str = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-supabase: Client = create_client(url, key)
-
 # --- ESTADO GLOBAL ---
 chord_nodes: List[chord.ChordNode] = []
+# Versão do anel (espaço de posições e nós virtuais), gravada junto com os nós
+ring_config: chord.RingConfig = chord.LEGACY_RING
+# Anel pré-calculado; reconstruído apenas quando chord_nodes muda
+chord_ring = chord.ChordRing([])
+# Referências para as tarefas em segundo plano não serem recolhidas pelo GC
+background_tasks: set = set()
+
+def rebuild_ring() -> chord.ChordRing:
+    """Reconstrói o anel e devolve o anterior (para calcular os intervalos movidos)."""
+    global chord_ring
+    previous = chord_ring
+    chord_ring = chord.ChordRing(chord_nodes, ring_config)
+    # No modo particionado as leituras consultam todas as réplicas até o rebalance terminar
+    kv.set_ring(chord_ring)
+    # Recoloca nas estatísticas do painel admin só os usuários cujos responsáveis mudaram
+    node_stats.set_ring(chord_ring)
+    return previous
 
 # --- EVENTOS DE CICLO DE VIDA ---
 @app.on_event("startup")
 async def startup_event():
-    global chord_nodes
+    await kv.connect()
+    print(f"💾 KV Store: motor '{kv.backend.name}'")
+    # O anel vem primeiro: no modo particionado é ele que diz onde cada chave vive
+    await load_nodes()
+    await message_store.message_writer.start()
+    await operation_log.start()
+
+    try:
+        await message_store.ensure_indexes()
+    except Exception as e:
+        print(f"❌ ERRO ao gerar índices de mensagens: {e}")
+
     try:
-        stored = await kv.get("system:chord_nodes")
+        await user_directory.ensure_index()
+    except Exception as e:
+        print(f"❌ ERRO ao gerar o diretório de usuários: {e}")
+
+    try:
+        await node_stats.load(chord_ring)
+    except Exception as e:
+        print(f"❌ ERRO ao carregar estatísticas dos nós: {e}")
+
+    # Arquiva em segundo plano as mensagens antigas (segmentos comprimidos por conversa)
+    await compactor.start()
+
+    # Outros workers avisam pelo barramento quando o anel muda
+    manager.bus.subscribe("chord_nodes", on_nodes_changed)
+    manager.bus.subscribe("ring_rebalanced", on_ring_rebalanced)
+    await manager.bus.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await compactor.stop()
+    await node_stats.stop()
+    await manager.bus.stop()
+    # Grava as mensagens ainda na fila do group commit antes de fechar o banco
+    await message_store.message_writer.stop()
+    await operation_log.stop()
+    await kv.close()
+
+async def load_nodes():
+    global chord_nodes, ring_config
+    try:
+        found = await kv.get_many(["system:chord_nodes", "system:ring_config"])
+        stored, config = found.get("system:chord_nodes"), found.get("system:ring_config")
         if stored and len(stored) > 0:
             chord_nodes = [chord.ChordNode(**n) for n in stored]
-            print(f"✅ Chord: {len(chord_nodes)} nós carregados.")
+            # Anéis gravados antes das versões continuam no formato legado (256 posições, sem vnodes)
+            ring_config = chord.RingConfig(**config) if config else chord.LEGACY_RING
+            rebuild_ring()
+            print(f"✅ Chord: {len(chord_nodes)} nós carregados (anel v{ring_config.version}, {ring_config.vnodes} vnodes).")
             return
     except Exception as e:
         print(f"❌ ERRO ao carregar nós: {e}")
 
     chord_nodes = chord.initialize_nodes()
+    ring_config = chord.default_ring_config()
+    rebuild_ring()
     await save_nodes()
 
 async def save_nodes():
     global chord_nodes
     data_to_save = [n.dict() for n in chord_nodes]
-    await kv.set("system:chord_nodes", data_to_save)
+    config = ring_config.dict()
+    await kv.set_many({"system:chord_nodes": data_to_save, "system:ring_config": config})
+    # Os outros workers reconstroem o anel sem precisar reler o banco
+    await manager.bus.emit("chord_nodes", {"nodes": data_to_save, "config": config})
+
+async def on_nodes_changed(data: dict):
+    global chord_nodes, ring_config
+    chord_nodes = [chord.ChordNode(**n) for n in data["nodes"]]
+    if data.get("config"):
+        ring_config = chord.RingConfig(**data["config"])
+    rebuild_ring()
+    print("🔄 Chord: anel atualizado por outro worker.")
+
+async def on_ring_rebalanced(data: dict):
+    kv.set_ring(chord_ring, handoff=False)
+
+async def rebalance_storage(previous: chord.ChordRing, ring: chord.ChordRing):
+    """Transfere as chaves dos intervalos movidos para os novos responsáveis (em segundo plano)."""
+    try:
+        copied = await kv.rebalance(previous, ring)
+    except Exception as e:
+        print(f"❌ ERRO no rebalanceamento do armazenamento: {e}")
+        return
+    if ring is chord_ring:
+        await manager.bus.emit("ring_rebalanced", {"copied": copied})
+    if copied:
+        log_operation("STORAGE_REBALANCED", {"copiedKeys": copied})
     
-async def log_operation(operation: str, details: dict):
-    """Registra logs de operações do sistema no KV Store do Supabase."""
-    timestamp = int(time.time() * 1000)
+def log_operation(operation: str, details: dict):
+    """Registra logs de operações do sistema (append-only, gravado em lote fora do caminho do pedido)."""
     print(f" LOG: [{operation}] - {details}")
-    
-    # Busca logs existentes ou cria lista vazia
-    logs = await kv.get("system:operation_logs") or []
-    
-    # Insere o novo log no início da lista
-    logs.insert(0, {
-        "timestamp": timestamp,
-        "operation": operation,
-        "details": details
-    })
-    
-    # Mantém apenas os últimos 100 logs para não sobrecarregar o banco
-    await kv.set("system:operation_logs", logs[:100])
+    operation_log.record(operation, details)
 
 # --- ROTAS DE AUTH & USUÁRIOS (Usando api_router) ---
 
@@ -81,99 +163,131 @@ async def signup(data: dict = Body(...)):
     username, password, name = data.get("username"), data.get("password"), data.get("name")
     if not all([username, password, name]):
         raise HTTPException(status_code=400, detail="Missing fields")
+    # ":" separa os componentes das chaves (inbox:{usuario}:{id}): "bob:x" cairia no prefixo de "bob"
+    if not message_store.valid_username(username):
+        raise HTTPException(status_code=400, detail="Username inválido")
     
-    if await kv.get(f"user:{username}"):
+    if await user_cache.get(username):
         raise HTTPException(status_code=409, detail="Exists")
 
     user_data = {
         "username": username, "password": password, "name": name,
         "status": "online", "joinedAt": int(time.time() * 1000)
     }
-    await kv.set(f"user:{username}", user_data)
+    await user_cache.put(user_data)
+    # Entradas do diretório para a busca por prefixo no /users
+    await user_directory.add(user_data)
+    node_stats.add_user(username, name)
     return {"success": True, "user": user_data}
 
 @api_router.post("/signin")
 async def signin(data: dict = Body(...)):
-    user = await kv.get(f"user:{data.get('username')}")
+    user = await user_cache.get(data.get("username"))
     if not user or user.get("password") != data.get("password"):
         raise HTTPException(status_code=401)
     return {"success": True, "user": user}
 
 @api_router.get("/inbox")
-async def get_inbox(username: str = Query(...)):
-    all_msgs = await kv.get_by_prefix("message:")
-    # Ignorar mensagens deletadas pelo usuário
-    user_msgs = [
-        m for m in all_msgs 
-        if (m["to"] == username or m["from"] == username) and username not in m.get("deleted_for", [])
-    ]
-    user_msgs.sort(key=lambda x: x["timestamp"], reverse=True)
-    return {"messages": user_msgs}
+async def get_inbox(
+    username: str = Query(...),
+    before: Optional[str] = Query(None),  # cursor: id da mensagem mais antiga já carregada
+    after: Optional[str] = Query(None),   # cursor: id da mensagem mais recente já carregada
+    limit: Optional[int] = Query(None, ge=1, le=message_store.MAX_PAGE_SIZE)
+):
+    # Sem parâmetros de paginação devolve o histórico completo (clientes antigos)
+    if before is None and after is None and limit is None:
+        # Lê apenas as mensagens do índice do usuário (já sem as que ele apagou)
+        user_msgs = await message_store.get_inbox_messages(username)
+        return {"messages": user_msgs}
+    return await message_store.get_inbox_page(
+        username, before=before, after=after,
+        limit=limit or message_store.DEFAULT_PAGE_SIZE
+    )
 
 # --- ROTAS DE MENSAGENS E BUSCA (Dentro do api_router) ---
 @api_router.get("/users")
-async def get_users(username: str = Query(None)):
-    all_users = await kv.get_by_prefix("user:")
-    user_list = [
-        {"username": u["username"], "name": u["name"]} 
-        for u in all_users if u["username"] != username
-    ]
-    return {"users": user_list}
+async def get_users(
+    username: str = Query(None),
+    q: Optional[str] = Query(None, max_length=100),  # prefixo do username ou do nome
+    cursor: Optional[str] = Query(None),            # nextCursor da página anterior
+    limit: Optional[int] = Query(None, ge=1, le=user_directory.MAX_USERS_PAGE),
+    fields: Optional[str] = Query(None),            # ex.: "username,name,status"
+):
+    # Sempre paginado pelo diretório; sem parâmetros devolve a primeira página (DEFAULT_USERS_PAGE)
+    requested = [f.strip() for f in (fields or "").split(",") if f.strip()] or user_directory.INDEX_FIELDS
+    unknown = set(requested) - set(user_directory.PUBLIC_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Campos desconhecidos: {', '.join(sorted(unknown))}")
+    return await user_directory.page(
+        q or "", cursor=cursor, limit=limit or user_directory.DEFAULT_USERS_PAGE,
+        exclude=username, fields=requested,
+    )
 
 @api_router.get("/conversations")
 async def get_conversations(username: str = Query(...)):
-    all_messages = await kv.get_by_prefix("message:")
-    # Filtra mensagens onde o usuário participa e que não foram deletadas por ele
-    user_messages = [
-        m for m in all_messages 
-        if (m["to"] == username or m["from"] == username) and username not in m.get("deleted_for", [])
-    ]
-    
-    conversations = {}
-    for msg in user_messages:
-        partner = msg["from"] if msg["to"] == username else msg["to"]
-        
-        if partner not in conversations:
-            conversations[partner] = {
-                "username": partner, 
-                "lastMessage": msg, 
-                "unreadCount": 0
-            }
-        
-        if msg["timestamp"] > conversations[partner]["lastMessage"]["timestamp"]:
-            conversations[partner]["lastMessage"] = msg
-            
-        if msg["to"] == username and not msg.get("read", False):
-            conversations[partner]["unreadCount"] += 1
+    # Agrupado a partir do índice de inbox; não lidas derivadas da marca de leitura
+    summaries = await message_store.get_conversation_summaries(username)
+    conversations = {conv["username"]: conv for conv in summaries}
 
+    # Perfis dos parceiros: do cache, e os que faltam numa única consulta
+    users = await user_cache.get_many(conversations)
     result = []
     for partner, conv in conversations.items():
-        user_info = await kv.get(f"user:{partner}")
+        user_info = users.get(partner)
         if user_info:
             result.append({**conv, "name": user_info["name"]})
 
     result.sort(key=lambda x: x["lastMessage"]["timestamp"], reverse=True)
     return {"conversations": result}
 
+@api_router.get("/conversations/{partner}/messages")
+async def get_conversation_history(
+    partner: str,
+    username: str = Query(...),
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    limit: int = Query(message_store.DEFAULT_PAGE_SIZE, ge=1, le=message_store.MAX_PAGE_SIZE)
+):
+    """Histórico de uma conversa, paginado por cursor (mais recentes primeiro)."""
+    return await message_store.get_conversation_page(
+        username, partner, before=before, after=after, limit=limit
+    )
+
+@api_router.get("/search")
+async def search_messages(
+    username: str = Query(...),
+    q: str = Query(..., min_length=1, max_length=200),
+    partner: Optional[str] = Query(None),  # restringe a busca a uma conversa
+    cursor: Optional[str] = Query(None, pattern=r"^\d+$"),
+    limit: int = Query(message_store.DEFAULT_SEARCH_PAGE, ge=1, le=message_store.MAX_PAGE_SIZE)
+):
+    """Busca no texto das mensagens do usuário, por relevância (prefixos, sem acentos)."""
+    return await message_store.search_messages(username, q, partner=partner, cursor=cursor, limit=limit)
+
     
 @api_router.put("/mark-read")
 async def mark_read(data: dict = Body(...)):
     username = data.get("username") # Quem está lendo (Ex: Kassovita)
     other_user = data.get("otherUser") # Quem enviou (Ex: Eliseu)
+    if not username or not other_user:
+        raise HTTPException(status_code=400, detail="Missing fields")
+    timestamp = data.get("timestamp")
+    if timestamp is not None:
+        try:
+            timestamp = int(timestamp)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="timestamp inválido")
     
-    all_messages = await kv.get_by_prefix("message:")
-    
-    for msg in all_messages:
-        if msg["to"] == username and msg["from"] == other_user and not msg.get("read"):
-            msg["read"] = True
-            await kv.set(f"message:{msg['id']}", msg)
+    # Uma única escrita: "li tudo desta conversa até este instante"
+    read_up_to = await message_store.mark_read(username, other_user, timestamp)
     
     await manager.send_personal_message({
         "type": "read_receipt",
-        "from": username # Kassovita diz: "Eu li!"
+        "from": username, # Kassovita diz: "Eu li!"
+        "readUpTo": read_up_to
     }, other_user) # Envia para remetente
             
-    return {"success": True}
+    return {"success": True, "readUpTo": read_up_to}
 
 @api_router.delete("/messages/{message_id}")
 async def delete_message(
@@ -186,7 +300,8 @@ async def delete_message(
     - delete_for_all só pode ser feito pelo emissor.
     - delete_for_all = False remove apenas para o usuário logado.
     """
-    msg = await kv.get(f"message:{message_id}")
+    # Mensagens antigas podem já estar num segmento arquivado
+    msg, archived_in = await message_store.find_message(message_id, username)
     if not msg:
         raise HTTPException(status_code=404, detail="Mensagem não encontrada")
 
@@ -195,82 +310,25 @@ async def delete_message(
         raise HTTPException(status_code=403, detail="Apenas o emissor pode apagar para todos")
 
     if delete_for_all:
-        # Apaga completamente
-        await kv.delete(f"message:{message_id}")
+        # Apaga completamente (mensagem e índices dos dois participantes)
+        await message_store.delete_message(msg, archived_in)
+        node_stats.add_messages(msg["from"], -1)
     else:
         # Apaga só para o usuário
-        if "deleted_for" not in msg:
-            msg["deleted_for"] = []
-        if username not in msg["deleted_for"]:
-            msg["deleted_for"].append(username)
-        await kv.set(f"message:{message_id}", msg)
+        await message_store.hide_message(msg, username, archived_in)
 
     return {"success": True, "message": "Mensagem deletada"}
 
 # --- ADMIN & CHORD VISUALIZATION (Usando api_router) ---
 @api_router.get("/admin/nodes")
 async def get_nodes():
-    users = await kv.get_by_prefix("user:")
-    all_messages = await kv.get_by_prefix("message:")
-    
-    # Resetar contadores
-    for node in chord_nodes:
-        node.users = []
-        node.messageCount = 0
-
-    # Distribuir usuários e contar mensagens por nó responsável
-    for user in users:
-        resp = chord.find_responsible_node(f"user:{user['username']}", chord_nodes)
-        if resp:
-            for n in chord_nodes:
-                if n.id == resp.id:
-                    n.users.append(user['username'])
-
-    for msg in all_messages:
-        # A mensagem conta para o nó responsável pelo REMETENTE
-        resp = chord.find_responsible_node(f"user:{msg.get('from')}", chord_nodes)
-        if resp:
-            for n in chord_nodes:
-                if n.id == resp.id:
-                    n.messageCount += 1
-    
-    return {"nodes": [n.dict() for n in chord_nodes]}
+    # Contadores mantidos incrementalmente (signup, mensagens, mudanças no anel)
+    return {"nodes": node_stats.nodes_view(chord_nodes)}
 
 @api_router.get("/admin/distribution")
 async def get_distribution():
-    try:
-        all_users = await kv.get_by_prefix("user:")
-        distribution = {}
-
-        for user in all_users:
-            username = user['username']
-            user_key = f"user:{username}"
-            
-            # Nó primário
-            primary = chord.find_responsible_node(user_key, chord_nodes)
-            
-            # Réplicas
-            replicas = chord.get_replica_nodes(user_key, chord_nodes, count=3)
-            active_nodes = [n for n in [primary] + replicas if n and n.active]
-
-            # Indica se nenhum nó ativo
-            primary_name = primary.name if primary and primary.active else "Offline"
-            
-            # Posição no anel
-            chord_pos = chord.get_chord_position(user_key)
-            
-            distribution[username] = {
-                "name": user['name'],
-                "primaryNode": primary_name,
-                "primaryNodeId": primary.id if primary and primary.active else None,
-                "replicaNodes": [r.name for r in replicas if r.id != (primary.id if primary else None) and r.active],
-                "chordPosition": chord_pos
-            }
-
-        return {"distribution": distribution}
-    except Exception as e:
-        print(f"❌ Erro ao calcular distribuição: {e}")
-        raise HTTPException(status_code=500, detail=f"Erro interno: {str(e)}")
+    # Colocação materializada: recalculada só para os usuários afetados por cada mudança
+    return {"distribution": node_stats.distribution}
 
 
 @api_router.post("/admin/nodes/{node_id}/toggle")
@@ -284,58 +342,114 @@ async def toggle_node(node_id: int = Path(...)):
     
     # Inverte o status de atividade
     node.active = not node.active
+    previous_ring = rebuild_ring()
+    # Só as chaves destes intervalos mudam de responsável (primário ou réplicas)
+    moved = chord.changed_ranges(previous_ring, chord_ring, REPLICATION_FACTOR)
+    space = ring_config.space
+    moved_share = sum(((end - start) % space) or space for start, end in moved) / space
     
     # Persiste a alteração no Supabase para que outros servidores vejam
     await save_nodes() 
+    task = asyncio.create_task(rebalance_storage(previous_ring, chord_ring))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
     
     # Log da operação para auditoria
     op_name = "NODE_ACTIVATED" if node.active else "NODE_DEACTIVATED"
-    await log_operation(op_name, {
+    log_operation(op_name, {
         "nodeId": node.id,
         "nodeName": node.name,
-        "newStatus": node.active
+        "newStatus": node.active,
+        "movedRanges": len(moved),
+        "movedKeyspace": round(moved_share, 4),
     })
     
     return {"success": True, "node": node.dict()}
 
+@api_router.get("/admin/replication")
+async def get_replication():
+    # Anti-entropia entre réplicas (modo particionado): progresso da ronda e bytes copiados
+    status = kv.replication_status()
+    return {"antiEntropy": status or {"enabled": False}}
+
 @api_router.get("/admin/logs")
-async def get_logs():
-    # Retorna os últimos logs de redistribuição e erros do sistema
-    logs = await kv.get("system:operation_logs") or []
-    return {"logs": logs}
+async def get_logs(
+    before: Optional[str] = Query(None),  # cursor: id do último log já carregado
+    limit: int = Query(100, ge=1, le=500)
+):
+    # Retorna os últimos logs de redistribuição e erros do sistema (mais recentes primeiro)
+    return await operation_log.page(before=before, limit=limit)
 
 @api_router.delete("/admin/logs")
 async def clear_logs():
-    await kv.set("system:operation_logs", [])
+    await operation_log.clear()
     return {"success": True}
 
 # --- WEBSOCKET ENDPOINT (Usando api_router) ---
+async def ack_when_durable(username: str, message: dict, durable: asyncio.Future, queued: bool = False):
+    """Confirma ao remetente que a mensagem foi gravada (ou avisa que falhou)."""
+    try:
+        await durable
+        node_stats.add_messages(message["from"])
+        frame = {"type": "ack", "id": message["id"], "to": message["to"]}
+        if queued:
+            # Destinatário offline: a mensagem espera na fila dele até à próxima conexão
+            frame["queued"] = True
+            await offline_queue.queued(message["to"])
+    except Exception as e:
+        print(f"❌ Mensagem {message['id']} não foi gravada: {e}")
+        frame = {
+            "type": "error",
+            "id": message["id"],
+            "to": message["to"],
+            "message": "❌ Falha ao gravar a mensagem."
+        }
+    await manager.send_personal_message(frame, username)
+
 @api_router.websocket("/ws/{username}")
-async def websocket_endpoint(websocket: WebSocket, username: str):
+async def websocket_endpoint(
+    websocket: WebSocket,
+    username: str,
+    backlog: Optional[str] = Query(None),  # "batch": recebe a fila offline em lotes com ack
+):
     await manager.connect(username, websocket)
     try:
+        await offline_queue.attach(username, websocket, batched=backlog == "batch")
         while True:
-            data = await websocket.receive_text()
-            msg_payload = json.loads(data)
+            # Texto JSON ou binário (MessagePack), conforme o cliente
+            msg_payload = await wire.receive(websocket)
+            metrics.WS_FRAMES_IN.inc()
             
             target_user = msg_payload.get("to")
             msg_type = msg_payload.get("type", "chat")
 
+            if msg_type == "backlog_ack":
+                # Cliente confirmou um lote da fila offline: apaga-o e envia o próximo
+                await offline_queue.ack(username, websocket, msg_payload.get("upTo"))
+                continue
+
             if not target_user: continue
 
             if msg_type == "typing":
-                await manager.send_personal_message({"type": "typing", "from": username}, target_user)
+                # Indicadores de digitação são agregados por remetente na fila do destinatário
+                await manager.send_personal_message({
+                    "type": "typing",
+                    "from": username,
+                    "status": msg_payload.get("status", "start")
+                }, target_user)
                 continue
 
             text = msg_payload.get("text")
             if not text: continue
 
-            responsible_node = chord.find_responsible_node(f"user:{target_user}", chord_nodes)
+            lookup_start = time.perf_counter()
+            responsible_node = chord_ring.find_responsible_node(f"user:{target_user}")
+            ROUTE_LOOKUP_TIME.observe(time.perf_counter() - lookup_start)
             if not responsible_node or not responsible_node.active:
-                await websocket.send_text(json.dumps({
+                await manager.send_personal_message({
                     "type": "error",
                     "message": "❌ Todos os nós estão offline. Mensagem não enviada."
-                }))
+                }, username)
                 continue
 
             timestamp = int(time.time() * 1000)
@@ -350,29 +464,35 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
                 "deleted_for": []  # lista de usuários que deletaram essa mensagem
             }
 
-            delivered = await manager.send_personal_message(full_message, target_user)
+            # Confirmado pelo worker do destinatário; sem confirmação a mensagem vai para a fila offline
+            delivered = await manager.send_personal_message(full_message, target_user, confirm=True)
 
-            if delivered:
-                await kv.set(f"message:{full_message['id']}", full_message)
-            else:
-                await websocket.send_text(json.dumps({
-                    "type": "error",
-                    "message": f"❌ Usuário {target_user} não pôde ser alcançado."
-                }))
+            # Group commit: não espera pelo banco para ler o próximo frame.
+            # Offline: grava também na fila de entrega do destinatário (nas réplicas do nó responsável)
+            durable = await message_store.enqueue_message(full_message, pending=not delivered)
+            task = asyncio.create_task(ack_when_durable(username, full_message, durable, queued=not delivered))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
 
-            
             if not delivered:
-                print(f"📡 Roteando Chord: {target_user} -> {responsible_node.name}")
+                print(f"📡 Roteando Chord: {target_user} -> {responsible_node.name} (fila offline)")
 
     except WebSocketDisconnect:
-        manager.disconnect(username)
+        offline_queue.detach(username, websocket)
+        manager.disconnect(username, websocket)
     except Exception as e:
         print(f"⚠️ Erro WebSocket ({username}): {e}")
-        manager.disconnect(username)
+        offline_queue.detach(username, websocket)
+        manager.disconnect(username, websocket)
 
 # --- REGISTRO FINAL ---
 app.include_router(api_router)
 
 @app.get("/health")
 async def health():
-    return {"status": "online"}
\ No newline at end of file
+    return {"status": "online"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Formato de texto do Prometheus (valores deste worker)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
\ No newline at end of file
@@ -0,0 +1,189 @@
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Métricas no formato de texto do Prometheus, sem dependências externas.
+# Os contadores e histogramas são objetos pré-alocados: no caminho quente só há
+# somas e uma busca binária nos limites dos buckets, nada é alocado por pedido.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOKUP_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3)
+# Contagens de chaves/linhas por chamada; medir bytes obrigaria a serializar cada valor outra vez
+ITEM_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # Um contador por bucket e o último para +Inf (não cumulativos; acumulados só na exportação)
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Family:
+    """Métrica com um rótulo; os filhos são criados na primeira utilização de cada valor."""
+
+    def __init__(self, name: str, help: str, kind: str, label: Optional[str], factory: Callable):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label = label
+        self.factory = factory
+        self.children: Dict[str, object] = {}
+
+    def labels(self, value: str = ""):
+        child = self.children.get(value)
+        if child is None:
+            child = self.children[value] = self.factory()
+        return child
+
+
+_registry: List[Family] = []
+_gauges: List[Tuple[str, str, Callable[[], float]]] = []
+
+
+def counter(name: str, help: str, label: Optional[str] = None) -> Family:
+    family = Family(name, help, "counter", label, Counter)
+    _registry.append(family)
+    return family
+
+
+def histogram(name: str, help: str, bounds: Tuple[float, ...] = LATENCY_BUCKETS, label: Optional[str] = None) -> Family:
+    family = Family(name, help, "histogram", label, lambda: Histogram(bounds))
+    _registry.append(family)
+    return family
+
+
+def gauge(name: str, help: str, read: Callable[[], float]):
+    """Valor lido apenas no momento da coleta (ex.: número de conexões, profundidade das filas)."""
+    _gauges.append((name, help, read))
+
+
+def _labels(family: Family, value: str, extra: str = "") -> str:
+    parts = []
+    if family.label:
+        parts.append(f'{family.label}="{value}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def render() -> str:
+    lines: List[str] = []
+    for family in _registry:
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {family.kind}")
+        for value, metric in sorted(family.children.items()):
+            if family.kind == "counter":
+                lines.append(f"{family.name}{_labels(family, value)} {metric.value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.bounds + ("+Inf",), metric.counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{family.name}_bucket{_labels(family, value, le)} {cumulative}")
+            lines.append(f"{family.name}_sum{_labels(family, value)} {metric.sum}")
+            lines.append(f"{family.name}_count{_labels(family, value)} {cumulative}")
+    for name, help, read in _gauges:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+        try:
+            lines.append(f"{name} {read()}")
+        except Exception:
+            lines.append(f"{name} NaN")
+    return "\n".join(lines) + "\n"
+
+
+# --- Métricas da aplicação ---
+
+HTTP_LATENCY = histogram(
+    "okupopia_http_request_duration_seconds", "Latência dos pedidos HTTP por rota.", label="route"
+)
+HTTP_ERRORS = counter(
+    "okupopia_http_request_exceptions_total", "Pedidos HTTP que terminaram com exceção.", label="route"
+)
+
+WS_FRAMES_IN = counter("okupopia_ws_frames_in_total", "Frames WebSocket recebidos dos clientes.").labels()
+WS_FRAMES_OUT = counter("okupopia_ws_frames_out_total", "Frames WebSocket enviados aos clientes.").labels()
+WS_FRAMES_DROPPED = counter(
+    "okupopia_ws_frames_dropped_total", "Frames descartados por filas de envio cheias."
+).labels()
+WS_SLOW_CONSUMERS = counter(
+    "okupopia_ws_slow_consumer_disconnects_total", "Conexões fechadas por não acompanharem o envio."
+).labels()
+
+KV_OPS = (
+    "get", "set", "delete", "get_by_prefix", "get_many", "set_many", "delete_many", "delete_unchanged", "scan",
+)
+
+
+class KVOpMetrics:
+    __slots__ = ("latency", "items", "errors", "coalesced", "snapshot_hits")
+
+    def __init__(self, op: str):
+        self.latency: Histogram = KV_LATENCY.labels(op)
+        self.items: Histogram = KV_ITEMS.labels(op)
+        self.errors: Counter = KV_ERRORS.labels(op)
+        self.coalesced: Counter = KV_COALESCED.labels(op)
+        self.snapshot_hits: Counter = KV_SNAPSHOT_HITS.labels(op)
+
+
+KV_LATENCY = histogram("okupopia_kv_duration_seconds", "Latência das operações do KV Store.", label="op")
+KV_ITEMS = histogram(
+    "okupopia_kv_items_per_op",
+    "Número de itens (chaves gravadas/removidas ou linhas devolvidas, não bytes) por operação do KV Store.",
+    bounds=ITEM_BUCKETS, label="op",
+)
+KV_ERRORS = counter("okupopia_kv_errors_total", "Operações do KV Store que falharam.", label="op")
+KV_COALESCED = counter(
+    "okupopia_kv_coalesced_total", "Leituras servidas por uma consulta idêntica já em curso.", label="op"
+)
+KV_SNAPSHOT_HITS = counter(
+    "okupopia_kv_snapshot_hits_total", "Leituras por prefixo servidas pelo cache de snapshots.", label="op"
+)
+KV = {op: KVOpMetrics(op) for op in KV_OPS}
+
+CHORD_LOOKUP = histogram(
+    "okupopia_chord_lookup_seconds", "Tempo das consultas ao anel Chord.", bounds=LOOKUP_BUCKETS, label="caller"
+)
+
+
+class MetricsMiddleware:
+    """Middleware ASGI (sem BaseHTTPMiddleware) que mede a latência de cada rota pelo template do caminho."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        except Exception:
+            HTTP_ERRORS.labels(_route(scope)).inc()
+            raise
+        finally:
+            HTTP_LATENCY.labels(_route(scope)).observe(perf_counter() - start)
+
+
+def _route(scope) -> str:
+    route = scope.get("route")
+    # Pedidos sem rota (404) partilham um rótulo, para não criar uma série por caminho
+    return route.path if route is not None else "unmatched"
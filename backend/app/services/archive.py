@@ -0,0 +1,263 @@
+import base64
+import json
+import zlib
+from collections import Counter, OrderedDict
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+
+from ..database import kv
+from .key_locks import KeyLocks
+
+# Arquivo de mensagens frias: segmentos imutáveis e comprimidos por conversa.
+#
+#   segment:{a}:{b}:{primeiro_id}            -> cabeçalho + mensagens comprimidas (a <= b)
+#   archive:{usuario}:{parceiro}:{primeiro_id} -> descritor do segmento na visão do usuário:
+#                                              intervalo de ids/tempo e ids ocultos só para ele
+#
+# O conteúdo comprimido nunca muda; apagar para todos só marca o id no cabeçalho
+# ("deleted") e apagar para um usuário marca-o no descritor dele ("hidden").
+
+SEGMENT_PREFIX = "segment:"
+DESCRIPTOR_PREFIX = "archive:"
+SEGMENT_FORMAT = 1
+SEGMENT_CODEC = "zlib"
+SEGMENT_CACHE_SIZE = 256
+SCAN_BATCH = 200
+# Tentativas de uma marca (deleted/hidden) que outro worker pode ter gravado por cima
+UPDATE_ATTEMPTS = 3
+
+# Campos guardados na linha compacta; os restantes vão num dicionário "extra"
+_COMPACT_FIELDS = {"id", "from", "to", "text", "timestamp", "read", "type", "deleted_for"}
+
+
+def segment_key(pair: Tuple[str, str], first_id: str) -> str:
+    return f"{SEGMENT_PREFIX}{pair[0]}:{pair[1]}:{first_id}"
+
+
+def descriptor_prefix(username: str, partner: Optional[str] = None) -> str:
+    if partner is None:
+        return f"{DESCRIPTOR_PREFIX}{username}:"
+    return f"{DESCRIPTOR_PREFIX}{username}:{partner}:"
+
+
+def descriptor_key(username: str, partner: str, first_id: str) -> str:
+    return descriptor_prefix(username, partner) + first_id
+
+
+def conversation_pair(a: str, b: str) -> Tuple[str, str]:
+    return (a, b) if a <= b else (b, a)
+
+
+# --- Codificação ---
+
+def encode_segment(pair: Tuple[str, str], messages: List[dict]) -> dict:
+    """Segmento de uma conversa: mensagens ordenadas por id, numa linha compacta cada."""
+    rows = []
+    for m in messages:
+        mask = sum(1 << i for i, user in enumerate(pair) if user in m.get("deleted_for", []))
+        extra = {k: v for k, v in m.items() if k not in _COMPACT_FIELDS}
+        if m.get("type", "chat") != "chat":
+            extra["type"] = m["type"]
+        rows.append([
+            m["id"],
+            pair.index(m["from"]),
+            m.get("text", ""),
+            m["timestamp"],
+            1 if m.get("read") else 0,
+            mask,
+            extra or None,
+        ])
+    raw = json.dumps(rows, separators=(",", ":"), ensure_ascii=False).encode()
+    return {
+        "format": SEGMENT_FORMAT,
+        "codec": SEGMENT_CODEC,
+        "pair": list(pair),
+        "firstId": messages[0]["id"],
+        "lastId": messages[-1]["id"],
+        "fromTs": messages[0]["timestamp"],
+        "toTs": messages[-1]["timestamp"],
+        "count": len(messages),
+        "rawBytes": len(raw),
+        # Apagadas para todos depois do arquivamento: {id: remetente}
+        "deleted": {},
+        "data": base64.b64encode(zlib.compress(raw, 9)).decode("ascii"),
+    }
+
+
+def _decode_rows(segment: dict) -> List[list]:
+    if segment.get("codec") != SEGMENT_CODEC:
+        raise ValueError(f"Codec de segmento desconhecido: {segment.get('codec')}")
+    return json.loads(zlib.decompress(base64.b64decode(segment["data"])))
+
+
+def _to_message(row: list, pair: List[str]) -> dict:
+    message_id, sender, text, timestamp, read, mask, extra = row
+    msg = {
+        "id": message_id,
+        "from": pair[sender],
+        "to": pair[1 - sender] if pair[0] != pair[1] else pair[0],
+        "text": text,
+        "timestamp": timestamp,
+        "read": bool(read),
+        "type": "chat",
+        "deleted_for": [user for i, user in enumerate(pair) if mask & (1 << i)],
+    }
+    if extra:
+        msg.update(extra)
+    return msg
+
+
+def descriptor(segment_key_: str, partner: str, messages: List[dict], hidden: List[str]) -> dict:
+    return {
+        "segment": segment_key_,
+        "partner": partner,
+        "firstId": messages[0]["id"],
+        "lastId": messages[-1]["id"],
+        "fromTs": messages[0]["timestamp"],
+        "toTs": messages[-1]["timestamp"],
+        "count": len(messages),
+        "hidden": hidden,
+    }
+
+
+# --- Leitura ---
+
+class SegmentReader:
+    """Descompressão dos segmentos com um cache LRU (o conteúdo comprimido é imutável)."""
+
+    def __init__(self, max_size: int = SEGMENT_CACHE_SIZE):
+        self.max_size = max_size
+        self._rows: "OrderedDict[tuple, List[list]]" = OrderedDict()
+
+    def rows(self, key: str, segment: dict) -> List[list]:
+        cache_key = (key, segment["lastId"], segment["count"])
+        rows = self._rows.get(cache_key)
+        if rows is None:
+            rows = self._rows[cache_key] = _decode_rows(segment)
+            while len(self._rows) > self.max_size:
+                self._rows.popitem(last=False)
+        else:
+            self._rows.move_to_end(cache_key)
+        return rows
+
+    def messages(self, key: str, segment: dict) -> List[dict]:
+        """Mensagens do segmento que não foram apagadas para todos, por ordem de id."""
+        deleted = segment.get("deleted", {})
+        pair = segment["pair"]
+        return [_to_message(row, pair) for row in self.rows(key, segment) if row[0] not in deleted]
+
+
+reader = SegmentReader()
+
+# Marcas num segmento e nos seus descritores (hide, delete, regravações do compactador)
+locks = KeyLocks()
+
+
+async def descriptors(username: str, partner: Optional[str] = None) -> List[dict]:
+    """Descritores dos segmentos visíveis para o usuário (todas as conversas ou só uma)."""
+    return await kv.get_by_prefix(descriptor_prefix(username, partner))
+
+
+async def read(descs: Iterable[dict], username: str) -> Dict[str, List[dict]]:
+    """Mensagens visíveis para o usuário em cada segmento (uma única consulta), por chave do segmento."""
+    descs = list(descs)
+    segments = await kv.get_many(d["segment"] for d in descs)
+    result: Dict[str, List[dict]] = {}
+    for d in descs:
+        segment = segments.get(d["segment"])
+        if segment is None:
+            continue
+        hidden = set(d.get("hidden", ()))
+        result[d["segment"]] = [
+            m for m in reader.messages(d["segment"], segment)
+            if m["id"] not in hidden and username not in m["deleted_for"]
+        ]
+    return result
+
+
+async def read_all(username: str, partner: Optional[str] = None) -> List[dict]:
+    found = await read(await descriptors(username, partner), username)
+    return [m for messages in found.values() for m in messages]
+
+
+async def find(message_id: str, username: str) -> Tuple[Optional[dict], Optional[dict]]:
+    """Procura uma mensagem arquivada visível para o usuário; devolve (mensagem, descritor)."""
+    candidates = [
+        d for d in await descriptors(username)
+        if d["firstId"] <= message_id <= d["lastId"]
+    ]
+    found = await read(candidates, username)
+    for d in candidates:
+        for m in found.get(d["segment"], []):
+            if m["id"] == message_id:
+                return m, d
+    return None, None
+
+
+async def hide(msg: dict, username: str, desc: dict):
+    """Apaga uma mensagem arquivada só para o usuário (marca no descritor dele)."""
+    key = descriptor_key(username, desc["partner"], desc["firstId"])
+    # Relê sob o lock do segmento: o descritor recebido pode já estar desatualizado
+    async with locks.hold(desc["segment"]):
+        for _ in range(UPDATE_ATTEMPTS):
+            current = await kv.get(key)
+            if current is None or msg["id"] in current["hidden"]:
+                return
+            current["hidden"].append(msg["id"])
+            if len(current["hidden"]) >= current["count"]:
+                # Nada mais a mostrar deste segmento para o usuário
+                await kv.delete(key)
+                return
+            await kv.set(key, current)
+
+
+async def delete(msg: dict, desc: dict):
+    """
+    Apaga uma mensagem arquivada para todos (marca no cabeçalho do segmento).
+    Ler-alterar-gravar do cabeçalho: serializado por segmento neste processo e relido
+    depois de gravar, para regravar a marca se outro worker a perdeu por cima.
+    """
+    async with locks.hold(desc["segment"]):
+        for _ in range(UPDATE_ATTEMPTS):
+            segment = await kv.get(desc["segment"])
+            if segment is None or msg["id"] in segment.get("deleted", {}):
+                return
+            segment.setdefault("deleted", {})[msg["id"]] = msg["from"]
+            await kv.set(desc["segment"], segment)
+
+
+async def _scan_all(prefix: str) -> AsyncIterator[Tuple[str, dict]]:
+    after = None
+    while True:
+        rows = await kv.scan(prefix, after=after, limit=SCAN_BATCH)
+        if not rows:
+            return
+        after = rows[-1][0]
+        for row in rows:
+            yield row
+
+
+def segments() -> AsyncIterator[Tuple[str, dict]]:
+    """Todos os segmentos, em páginas de SCAN_BATCH."""
+    return _scan_all(SEGMENT_PREFIX)
+
+
+async def hidden_ids() -> Set[Tuple[str, str]]:
+    """Pares (usuário, id) de mensagens arquivadas que o usuário apagou só para si."""
+    hidden = set()
+    async for key, desc in _scan_all(DESCRIPTOR_PREFIX):
+        user = key[len(DESCRIPTOR_PREFIX):].split(":", 1)[0]
+        hidden.update((user, message_id) for message_id in desc.get("hidden", ()))
+    return hidden
+
+
+async def sent_counts() -> Counter:
+    """Mensagens arquivadas (não apagadas para todos) por remetente, para as estatísticas dos nós."""
+    counts: Counter = Counter()
+    seen = set()
+    async for key, segment in segments():
+        for m in reader.messages(key, segment):
+            # Um segmento regravado por duas compactações concorrentes não conta duas vezes
+            if m["id"] not in seen:
+                seen.add(m["id"])
+                counts[m["from"]] += 1
+    return counts
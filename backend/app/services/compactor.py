@@ -0,0 +1,211 @@
+import asyncio
+import os
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from .. import metrics
+from ..database import kv
+from . import archive
+from .message_store import message_key, message_keys, pending_key
+
+# Compactação em segundo plano: mensagens mais antigas do que ARCHIVE_AFTER_DAYS saem das
+# linhas quentes (message:* e índices) para segmentos comprimidos por conversa (archive.py).
+# Desligada por omissão (0): ativar explicitamente com ARCHIVE_AFTER_DAYS > 0
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_SEGMENT_SIZE = int(os.getenv("ARCHIVE_SEGMENT_SIZE", "1000"))
+ARCHIVE_BATCH = 5000
+# Tentativas de gravar um segmento enquanto as linhas quentes mudam por baixo
+ARCHIVE_ATTEMPTS = 3
+
+# Com vários workers só um compacta de cada vez (melhor esforço: as leituras removem duplicados)
+LEASE_KEY = "system:archive_lease"
+
+ARCHIVED_MESSAGES = metrics.counter(
+    "okupopia_archived_messages_total", "Mensagens movidas para segmentos comprimidos."
+).labels()
+ARCHIVED_SEGMENTS = metrics.counter(
+    "okupopia_archive_segments_total", "Segmentos de arquivo gravados pelo compactador."
+).labels()
+
+
+class Compactor:
+    def __init__(self):
+        self._worker = uuid.uuid4().hex[:6]
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None and ARCHIVE_AFTER_DAYS > 0:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+            try:
+                if await self._acquire_lease():
+                    await self.run_once()
+            except Exception as e:
+                print(f"⚠️ Erro ao compactar mensagens antigas: {e}")
+
+    async def _acquire_lease(self) -> bool:
+        now = time.time()
+        lease = await kv.get(LEASE_KEY)
+        if lease and lease.get("owner") != self._worker and lease.get("until", 0) > now:
+            return False
+        await kv.set(LEASE_KEY, {"owner": self._worker, "until": now + ARCHIVE_INTERVAL})
+        # Sem compare-and-set: relê para desistir se outro worker gravou por cima ao mesmo tempo
+        lease = await kv.get(LEASE_KEY)
+        return bool(lease) and lease.get("owner") == self._worker
+
+    async def run_once(self, older_than_days: float = ARCHIVE_AFTER_DAYS) -> int:
+        """Arquiva todas as mensagens anteriores ao limite; devolve quantas foram movidas."""
+        cutoff = int((time.time() - older_than_days * 86400) * 1000)
+        total = raw_bytes = stored_bytes = 0
+        after: Optional[str] = None
+        while True:
+            # Os ids começam pelo timestamp em ms: o limite é um simples range scan.
+            # O cursor avança sobre as mensagens que ficaram quentes (pendentes ou alteradas).
+            rows = await kv.scan("message:", after=after, before=message_key(str(cutoff)), limit=ARCHIVE_BATCH)
+            if not rows:
+                break
+            after = rows[-1][0]
+            by_pair: Dict[Tuple[str, str], List[dict]] = defaultdict(list)
+            for _, msg in rows:
+                by_pair[archive.conversation_pair(msg["from"], msg["to"])].append(msg)
+            for pair, messages in by_pair.items():
+                messages.sort(key=lambda m: m["id"])
+                for i in range(0, len(messages), ARCHIVE_SEGMENT_SIZE):
+                    segment = await self._archive(pair, messages[i:i + ARCHIVE_SEGMENT_SIZE])
+                    if segment is None:
+                        continue
+                    raw_bytes += segment["rawBytes"]
+                    stored_bytes += len(segment["data"])
+                    total += segment["count"]
+        if total:
+            print(
+                f"🗜️ {total} mensagens arquivadas "
+                f"({raw_bytes / 1024:.0f} KiB -> {stored_bytes / 1024:.0f} KiB comprimidos)"
+            )
+        return total
+
+    async def _current(self, messages: List[dict]) -> List[dict]:
+        """
+        Relê as linhas e devolve só as que ainda podem ser arquivadas: iguais às lidas
+        e sem entrada na fila offline (ainda não entregues ao destinatário).
+        """
+        keys = [message_key(m["id"]) for m in messages]
+        pending = [pending_key(m["to"], m["id"]) for m in messages]
+        found = await kv.get_many(keys + pending)
+        return [
+            m for m, key, queued in zip(messages, keys, pending)
+            if found.get(key) == m and queued not in found
+        ]
+
+    async def _write(self, pair: Tuple[str, str], messages: List[dict], written: List[str]) -> Tuple[dict, List[str]]:
+        """
+        Grava o segmento e os descritores; remove as chaves de uma gravação anterior que mudaram.
+        Ao regravar mantém as marcas (deleted/hidden) feitas entretanto sobre as mensagens já arquivadas.
+        """
+        key = archive.segment_key(pair, messages[0]["id"])
+        async with archive.locks.hold(key):
+            ids = {m["id"] for m in messages}
+            keys = [key] + [
+                archive.descriptor_key(user, pair[1] if user == pair[0] else pair[0], messages[0]["id"])
+                for user in dict.fromkeys(pair)
+            ]
+            # A gravação anterior pode estar noutras chaves, se o primeiro id mudou
+            previous = await kv.get_many(keys + written)
+            segment = archive.encode_segment(pair, messages)
+            for k, value in previous.items():
+                if k.startswith(archive.SEGMENT_PREFIX):
+                    deleted = value.get("deleted", {})
+                    segment["deleted"].update((i, deleted[i]) for i in deleted if i in ids)
+            items = {key: segment}
+            for user, desc_key in zip(dict.fromkeys(pair), keys[1:]):
+                partner = pair[1] if user == pair[0] else pair[0]
+                hidden = [m["id"] for m in messages if user in m.get("deleted_for", [])]
+                for k, value in previous.items():
+                    if k.startswith(archive.descriptor_prefix(user, partner)):
+                        hidden += [i for i in value.get("hidden", ()) if i in ids and i not in hidden]
+                # Quem já apagou todas as mensagens do segmento não precisa de descritor
+                if len(hidden) < len(messages):
+                    items[desc_key] = archive.descriptor(key, partner, messages, hidden)
+            await kv.set_many(items)
+        # O primeiro id (e com ele a chave do segmento) pode mudar entre tentativas
+        stale = [k for k in written if k not in items]
+        if stale:
+            await kv.delete_many(stale)
+        return segment, list(items)
+
+    async def _archive(self, pair: Tuple[str, str], messages: List[dict]) -> Optional[dict]:
+        """
+        Grava o segmento e os descritores e só depois remove as linhas quentes.
+
+        As linhas são relidas antes de gravar e outra vez depois: se alguma mudou ou sumiu
+        (mark-read, apagar, hide) o segmento é regravado com o estado atual. A remoção só
+        apaga as linhas que ainda são iguais às do segmento (delete_unchanged): uma escrita
+        que chegue entre a releitura e a remoção fica na linha quente e o segmento é
+        regravado com ela. Sem estabilizar em ARCHIVE_ATTEMPTS tentativas, as linhas que
+        continuam quentes saem do segmento e ficam para a próxima execução.
+        Devolve None quando nenhuma mensagem foi arquivada.
+        """
+        written: List[str] = []
+        segment: Optional[dict] = None
+        stored: List[dict] = []
+        # Linhas já removidas (o segmento passa a ser a única cópia) e linhas ainda quentes
+        archived: List[dict] = []
+        hot = await self._current(messages)
+        for _ in range(ARCHIVE_ATTEMPTS):
+            if not hot:
+                break
+            stored = sorted(archived + hot, key=lambda m: m["id"])
+            segment, written = await self._write(pair, stored, written)
+
+            current = await self._current(hot)
+            if current != hot:
+                hot = current
+                continue
+
+            # Os postings da busca ficam: continuam a encontrar a mensagem, agora no segmento.
+            # As entradas pending:* não entram: mensagens ainda na fila nunca chegam aqui.
+            removed = set(await kv.delete_unchanged({message_key(m["id"]): m for m in hot}))
+            done = [m for m in hot if message_key(m["id"]) in removed]
+            await kv.delete_many(
+                key for msg in done for key in message_keys(msg, include_search=False)
+                if key != message_key(msg["id"]) and key != pending_key(msg["to"], msg["id"])
+            )
+            archived.extend(done)
+            hot = [m for m in hot if message_key(m["id"]) not in removed]
+            if not hot:
+                break
+            # Alguma linha mudou entre a releitura e a remoção: regrava com o estado atual
+            found = await kv.get_many(message_key(m["id"]) for m in hot)
+            hot = await self._current([found[k] for k in (message_key(m["id"]) for m in hot) if k in found])
+
+        archived.sort(key=lambda m: m["id"])
+        if archived and stored != archived:
+            # Linhas que continuam quentes (ou que sumiram entretanto) saem do segmento
+            segment, written = await self._write(pair, archived, written)
+        if not archived:
+            # Nada a arquivar ou as linhas não estabilizaram: desfaz o que foi gravado
+            if written:
+                await kv.delete_many(written)
+            return None
+        ARCHIVED_MESSAGES.inc(len(archived))
+        ARCHIVED_SEGMENTS.inc()
+        return segment
+
+
+# Instância única usada no ciclo de vida da app
+compactor = Compactor()
@@ -0,0 +1,29 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List
+
+
+class KeyLocks:
+    """
+    Um asyncio.Lock por chave, criado na primeira utilização e descartado quando ninguém
+    o usa nem espera por ele (a memória acompanha só as chaves em disputa).
+    Serializa ler-alterar-gravar sobre a mesma chave dentro deste processo.
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, List] = {}  # chave -> [lock, utilizadores]
+
+    @asynccontextmanager
+    async def hold(self, key: str) -> AsyncIterator[None]:
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._locks.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._locks)
@@ -0,0 +1,272 @@
+import asyncio
+import os
+import socket
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from . import wire
+
+# "local" (um único processo) ou "broker" (vários workers/hosts ligados ao app.broker)
+MESSAGE_BUS = os.getenv("MESSAGE_BUS", "local").lower()
+BROKER_ADDRESS = os.getenv("BROKER_ADDRESS", "unix:/tmp/okupopia-broker.sock")
+# Frames do barramento são linhas JSON; o limite cobre mensagens grandes
+BUS_LINE_LIMIT = 2 ** 20
+BUS_RECONNECT_DELAY = 1.0
+# Tempo máximo à espera da confirmação de entrega do worker remoto; sem ela o usuário conta como offline
+BUS_ACK_TIMEOUT = float(os.getenv("BUS_ACK_TIMEOUT", "2"))
+
+DeliverHandler = Callable[[str, dict], Awaitable[bool]]
+BroadcastHandler = Callable[[dict], Awaitable[None]]
+EventHandler = Callable[[dict], Awaitable[None]]
+
+
+def parse_address(address: str) -> Tuple[str, object]:
+    """'unix:/caminho.sock' ou 'tcp://host:porta' -> (tipo, destino)."""
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    if address.startswith("tcp://"):
+        host, _, port = address[len("tcp://"):].rpartition(":")
+        return "tcp", (host or "127.0.0.1", int(port))
+    raise ValueError(f"Endereço de broker inválido: {address}")
+
+
+class MessageBus:
+    """
+    Barramento entre workers. O ConnectionManager usa-o para entregar mensagens a
+    usuários ligados a outro processo e para saber quem está online no cluster.
+    Esta implementação base é a de processo único: não há mais ninguém para avisar.
+    """
+
+    def __init__(self):
+        self.on_deliver: Optional[DeliverHandler] = None
+        self.on_broadcast: Optional[BroadcastHandler] = None
+        self._subscribers: Dict[str, List[EventHandler]] = {}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, event: str, handler: EventHandler):
+        """Regista um handler para eventos de sistema emitidos por outros workers."""
+        self._subscribers.setdefault(event, []).append(handler)
+
+    async def _dispatch_event(self, event: str, data: dict):
+        for handler in self._subscribers.get(event, []):
+            try:
+                await handler(data)
+            except Exception as e:
+                print(f"⚠️ Erro no evento {event}: {e}")
+
+    def join(self, username: str):
+        """O usuário conectou-se a este worker."""
+
+    def leave(self, username: str):
+        """O usuário desconectou-se deste worker."""
+
+    def is_online_elsewhere(self, username: str) -> bool:
+        return False
+
+    async def send(self, username: str, message: dict, confirm: bool = False) -> bool:
+        """
+        Entrega a mensagem ao worker onde o usuário está. False se ninguém o tem.
+        Com `confirm` só devolve True depois de o worker remoto confirmar que a entregou ao socket.
+        """
+        return False
+
+    async def broadcast(self, message: dict):
+        """Entrega a mensagem aos usuários de todos os outros workers."""
+
+    async def emit(self, event: str, data: dict):
+        """Avisa os outros workers de uma mudança de estado (ex.: anel Chord)."""
+
+
+class BrokerBus(MessageBus):
+    """
+    Cliente do app.broker (socket Unix ou TCP, uma linha JSON por frame).
+    Mantém uma cópia local do registo de presença, atualizada pelo broker,
+    para que send_personal_message decida sem ida e volta se o destinatário está online.
+    """
+
+    def __init__(self, address: str = BROKER_ADDRESS):
+        super().__init__()
+        self.address = address
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._local_users: Set[str] = set()
+        # Usuários online em outros workers (réplica do registo do broker)
+        self._remote_users: Set[str] = set()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+        # Envios à espera de confirmação: ref -> (future, respostas negativas recebidas)
+        self._acks: Dict[int, List] = {}
+        self._next_ref = 0
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            try:
+                await asyncio.wait_for(self._connected.wait(), BUS_RECONNECT_DELAY * 3)
+            except asyncio.TimeoutError:
+                print(f"⚠️ Broker indisponível em {self.address}; tentando em segundo plano.")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    async def _open(self):
+        kind, target = parse_address(self.address)
+        if kind == "unix":
+            return await asyncio.open_unix_connection(target, limit=BUS_LINE_LIMIT)
+        host, port = target
+        return await asyncio.open_connection(host, port, limit=BUS_LINE_LIMIT)
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await self._open()
+            except OSError:
+                await asyncio.sleep(BUS_RECONNECT_DELAY)
+                continue
+
+            self._writer = writer
+            self._write({"op": "hello", "worker": self.worker_id, "users": sorted(self._local_users)})
+            self._connected.set()
+            print(f"🛰️ Barramento ligado ao broker {self.address} como {self.worker_id}")
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    try:
+                        await self._handle(wire.loads(line))
+                    except (KeyError, TypeError) as e:
+                        print(f"⚠️ Frame inválido do broker: {e}")
+            except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+                print(f"⚠️ Ligação ao broker perdida: {e}")
+            finally:
+                self._connected.clear()
+                self._writer = None
+                self._remote_users.clear()
+                # Sem broker as confirmações não chegam: quem espera trata o destinatário como offline
+                for future, _ in self._acks.values():
+                    if not future.done():
+                        future.set_result(False)
+                self._acks.clear()
+                writer.close()
+            await asyncio.sleep(BUS_RECONNECT_DELAY)
+
+    async def _handle(self, frame: dict):
+        op = frame.get("op")
+        if op == "deliver":
+            delivered = bool(self.on_deliver and await self.on_deliver(frame["to"], frame["msg"]))
+            if "ref" in frame:
+                self._write({
+                    "op": "ack", "worker": frame["from"], "ref": frame["ref"],
+                    "ok": delivered, "holders": frame.get("holders", 1),
+                })
+        elif op == "ack":
+            self._resolve(frame)
+        elif op == "broadcast":
+            if self.on_broadcast:
+                await self.on_broadcast(frame["msg"])
+        elif op == "presence":
+            if frame["online"]:
+                self._remote_users.add(frame["user"])
+            else:
+                self._remote_users.discard(frame["user"])
+        elif op == "snapshot":
+            self._remote_users = set(frame["users"])
+        elif op == "event":
+            await self._dispatch_event(frame["event"], frame.get("data", {}))
+
+    def _resolve(self, frame: dict):
+        pending = self._acks.get(frame["ref"])
+        if pending is None:
+            return
+        future = pending[0]
+        if frame["ok"]:
+            future.set_result(True)
+        else:
+            # Com o usuário em vários workers basta um entregar; offline só se todos recusarem
+            pending[1] += 1
+            if pending[1] >= frame.get("holders", 1):
+                future.set_result(False)
+        if future.done():
+            del self._acks[frame["ref"]]
+
+    def _write(self, frame: dict) -> bool:
+        if self._writer is None:
+            return False
+        self._writer.write(wire.dumps(frame).encode() + b"\n")
+        return True
+
+    async def _drain(self):
+        if self._writer is not None:
+            try:
+                await self._writer.drain()
+            except ConnectionError:
+                pass
+
+    def join(self, username: str):
+        self._local_users.add(username)
+        self._write({"op": "join", "user": username})
+
+    def leave(self, username: str):
+        self._local_users.discard(username)
+        self._write({"op": "leave", "user": username})
+
+    def is_online_elsewhere(self, username: str) -> bool:
+        return username in self._remote_users
+
+    async def send(self, username: str, message: dict, confirm: bool = False) -> bool:
+        if username not in self._remote_users:
+            return False
+        if not confirm:
+            if not self._write({"op": "send", "to": username, "msg": message}):
+                return False
+            await self._drain()
+            return True
+
+        self._next_ref += 1
+        ref = self._next_ref
+        future = asyncio.get_running_loop().create_future()
+        if not self._write({"op": "send", "to": username, "msg": message, "ref": ref}):
+            return False
+        self._acks[ref] = [future, 0]
+        await self._drain()
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), BUS_ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Sem confirmação de entrega para {username}; mensagem segue para a fila offline.")
+            return False
+        finally:
+            self._acks.pop(ref, None)
+
+    async def broadcast(self, message: dict):
+        if self._write({"op": "broadcast", "msg": message}):
+            await self._drain()
+
+    async def emit(self, event: str, data: dict):
+        if self._write({"op": "event", "event": event, "data": data}):
+            await self._drain()
+
+
+def create_bus(name: str = MESSAGE_BUS) -> MessageBus:
+    if name == "local":
+        return MessageBus()
+    if name == "broker":
+        return BrokerBus(BROKER_ADDRESS)
+    raise ValueError(f"MESSAGE_BUS desconhecido: {name}")
+
+
+# Instância única partilhada pelo ConnectionManager e pelas rotas
+bus = create_bus()
@@ -0,0 +1,533 @@
+import asyncio
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .. import metrics
+from ..database import kv
+from . import archive, search
+from .key_locks import KeyLocks
+from .write_pipeline import GroupCommitWriter
+
+# Índices secundários mantidos junto com cada mensagem:
+#   inbox:{usuario}:{id}                      -> todas as mensagens em que o usuário participa
+#   conversation:{usuario}:{parceiro}:{id}    -> mensagens de uma conversa, vista por um dos lados
+# Os ids começam pelo timestamp em ms, então a ordem das chaves já é cronológica.
+# O valor de cada entrada é um resumo pequeno da mensagem (sem o texto).
+#
+# Busca: search:{usuario}:{termo}:{id} (ver search.py), gravado no mesmo upsert da mensagem.
+# Entrega diferida: pending:{destinatario}:{id} -> mensagem enviada com o destinatário offline
+# (escoada na reconexão por offline_queue.py).
+#
+# Estado de leitura: read:{leitor}:{parceiro} -> timestamp (ms) até onde o leitor já leu.
+# O campo "read" das mensagens é derivado dessa marca d'água na leitura.
+#
+# Mensagens antigas saem destas chaves para segmentos comprimidos (ver archive.py e
+# compactor.py); as leituras juntam as linhas quentes com as mensagens arquivadas.
+
+INDEX_VERSION = 3
+INDEX_VERSION_KEY = "system:message_index_version"
+
+# Paginação por cursor (keyset): o cursor é o id de uma mensagem
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+DEFAULT_SEARCH_PAGE = 20
+
+# Marcas de leitura: serializadas por chave e regravadas se outro worker as recuar
+_read_locks = KeyLocks()
+MARK_READ_ATTEMPTS = 3
+
+# Estágio de group commit partilhado por todas as conexões WebSocket
+message_writer = GroupCommitWriter(kv.set_many)
+metrics.gauge("okupopia_write_queue_depth", "Escritas de mensagens à espera do próximo group commit.",
+              lambda: message_writer.pending)
+
+
+def valid_username(username: str) -> bool:
+    """Usernames entram nas chaves de índice, onde ":" é o separador."""
+    return isinstance(username, str) and ":" not in username
+
+
+def message_key(message_id: str) -> str:
+    return f"message:{message_id}"
+
+
+def inbox_prefix(username: str) -> str:
+    return f"inbox:{username}:"
+
+
+def conversation_prefix(username: str, partner: str) -> str:
+    return f"conversation:{username}:{partner}:"
+
+
+def read_key(reader: str, partner: str) -> str:
+    return f"read:{reader}:{partner}"
+
+
+def pending_prefix(username: str) -> str:
+    return f"pending:{username}:"
+
+
+def pending_key(username: str, message_id: str) -> str:
+    return pending_prefix(username) + message_id
+
+
+def _partner(msg: dict, username: str) -> str:
+    return msg["from"] if msg["to"] == username else msg["to"]
+
+
+def _summary(msg: dict) -> dict:
+    return {
+        "id": msg["id"],
+        "from": msg["from"],
+        "to": msg["to"],
+        "timestamp": msg["timestamp"],
+    }
+
+
+def _index_keys_for(msg: dict, username: str) -> List[str]:
+    """Chaves de índice de uma mensagem do ponto de vista de um participante."""
+    partner = _partner(msg, username)
+    return [
+        inbox_prefix(username) + msg["id"],
+        conversation_prefix(username, partner) + msg["id"],
+    ]
+
+
+def _participants(msg: dict) -> List[str]:
+    # dict.fromkeys remove duplicados (mensagem para si mesmo) mantendo a ordem
+    return list(dict.fromkeys([msg["from"], msg["to"]]))
+
+
+def search_entries(msg: dict) -> Dict[str, dict]:
+    """Postings da busca dos participantes que ainda não apagaram a mensagem."""
+    deleted_for = msg.get("deleted_for", [])
+    entries: Dict[str, dict] = {}
+    for user in _participants(msg):
+        if user not in deleted_for:
+            entries.update(search.entries_for(msg, user, _partner(msg, user)))
+    return entries
+
+
+def index_entries(msg: dict) -> Dict[str, dict]:
+    """Entradas de índice (e da busca) dos participantes que ainda não apagaram a mensagem."""
+    summary = _summary(msg)
+    deleted_for = msg.get("deleted_for", [])
+    return {
+        **{
+            key: summary
+            for user in _participants(msg) if user not in deleted_for
+            for key in _index_keys_for(msg, user)
+        },
+        **search_entries(msg),
+    }
+
+
+def message_keys(msg: dict, include_search: bool = True) -> List[str]:
+    """A linha da mensagem e as entradas de índice de todos os participantes."""
+    keys = [message_key(msg["id"]), pending_key(msg["to"], msg["id"])]
+    for user in _participants(msg):
+        keys.extend(_index_keys_for(msg, user))
+        if include_search:
+            keys.extend(search.keys_for(msg, user))
+    return keys
+
+
+def message_items(msg: dict) -> Dict[str, Any]:
+    """A mensagem e as suas entradas de índice, prontas para um único upsert."""
+    return {message_key(msg["id"]): msg, **index_entries(msg)}
+
+
+async def save_message(msg: dict):
+    """Persiste a mensagem e os seus índices imediatamente."""
+    await kv.set_many(message_items(msg))
+
+
+async def enqueue_message(msg: dict, pending: bool = False) -> asyncio.Future:
+    """
+    Entrega a mensagem ao group commit; o Future resolve quando ela estiver gravada.
+    Com `pending` (destinatário offline) entra também na fila de entrega do destinatário.
+    """
+    items = message_items(msg)
+    if pending:
+        items[pending_key(msg["to"], msg["id"])] = msg
+    return await message_writer.submit(items)
+
+
+async def get_watermarks(pairs: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], int]:
+    """Marcas de leitura de vários pares (leitor, parceiro) numa única consulta; ausentes valem 0."""
+    pairs = list(dict.fromkeys(pairs))
+    found = await kv.get_many(read_key(r, p) for r, p in pairs)
+    return {(r, p): found.get(read_key(r, p)) or 0 for r, p in pairs}
+
+
+async def mark_read(reader: str, partner: str, up_to: Optional[int] = None) -> int:
+    """
+    Avança a marca de leitura do leitor nesta conversa (nunca recua).
+    Custo constante, independente do tamanho da conversa. Devolve a marca em vigor.
+    Uma marca no futuro marcaria como lidas mensagens que ainda não existem: fica limitada a agora.
+    """
+    now = int(time.time() * 1000)
+    up_to = now if up_to is None else min(int(up_to), now)
+    key = read_key(reader, partner)
+    # Ler-comparar-gravar concorrente podia deixar a marca menor por último: serializa por chave
+    # neste processo e relê depois de gravar, regravando se outro worker recuou a marca
+    async with _read_locks.hold(key):
+        for _ in range(MARK_READ_ATTEMPTS):
+            current = await kv.get(key) or 0
+            if up_to <= current:
+                return current
+            await kv.set(key, up_to)
+            if (await kv.get(key) or 0) >= up_to:
+                return up_to
+        return await kv.get(key) or 0
+
+
+def _is_read(msg: dict, watermarks: Dict[Tuple[str, str], int]) -> bool:
+    # Mensagens marcadas como lidas antes das marcas d'água mantêm o flag original
+    return bool(msg.get("read")) or msg["timestamp"] <= watermarks.get((msg["to"], msg["from"]), 0)
+
+
+async def _apply_read_flags(messages: List[dict]):
+    # O destinatário de cada mensagem é o leitor cuja marca decide o flag "read"
+    watermarks = await get_watermarks((m["to"], m["from"]) for m in messages)
+    for m in messages:
+        m["read"] = _is_read(m, watermarks)
+
+
+async def _load(entries: List[dict], username: str, archived: Iterable[dict] = ()) -> List[dict]:
+    found = await kv.get_many(message_key(e["id"]) for e in entries)
+    messages = [
+        m for m in found.values()
+        if username in (m["from"], m["to"]) and username not in m.get("deleted_for", [])
+    ]
+    # Durante uma compactação a mesma mensagem pode estar quente e arquivada: vale a quente
+    hot = {m["id"] for m in messages}
+    messages.extend(m for m in archived if m["id"] not in hot)
+    await _apply_read_flags(messages)
+    return messages
+
+
+async def get_inbox_messages(username: str) -> List[dict]:
+    """Mensagens enviadas ou recebidas pelo usuário, da mais recente para a mais antiga."""
+    await message_writer.barrier()
+    entries = await kv.get_by_prefix(inbox_prefix(username))
+    messages = await _load(entries, username, await archive.read_all(username))
+    messages.sort(key=lambda m: m["timestamp"], reverse=True)
+    return messages
+
+
+async def _archived_window(
+    username: str,
+    partner: Optional[str],
+    before: Optional[str],
+    after: Optional[str],
+    count: int,
+    hot_ids: List[str],
+) -> List[dict]:
+    """
+    As `count` mensagens arquivadas mais próximas do cursor que ainda podem entrar na página.
+    Os segmentos são abertos por ordem de distância ao cursor e a busca para assim que o
+    seguinte já não tem nada melhor do que a janela atual (quentes incluídas).
+    """
+    descs = [
+        d for d in await archive.descriptors(username, partner)
+        if (before is None or d["firstId"] < before) and (after is None or d["lastId"] > after)
+    ]
+    if not descs:
+        return []
+    forward = after is not None
+    if forward:
+        descs.sort(key=lambda d: d["firstId"])
+    else:
+        descs.sort(key=lambda d: d["lastId"], reverse=True)
+
+    archived: List[dict] = []
+    window = sorted(hot_ids, reverse=not forward)[:count]
+    for d in descs:
+        if len(window) >= count and (d["firstId"] > window[-1] if forward else d["lastId"] < window[-1]):
+            break
+        found = await archive.read([d], username)
+        matches = [
+            m for m in found.get(d["segment"], [])
+            if (before is None or m["id"] < before) and (after is None or m["id"] > after)
+        ]
+        archived.extend(matches)
+        window = sorted(set(window).union(m["id"] for m in matches), reverse=not forward)[:count]
+    return archived
+
+
+async def get_page(
+    prefix: str,
+    username: str,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    partner: Optional[str] = None,
+) -> dict:
+    """
+    Página de mensagens de um índice ordenado por tempo, da mais recente para a mais antiga.
+    - sem cursor: as `limit` mais recentes;
+    - `before`: as anteriores ao cursor (rolar para trás);
+    - `after`: as posteriores ao cursor (buscar novidades).
+    Custa um range scan de `limit` chaves, independente do tamanho do histórico; as mensagens
+    arquivadas (do usuário, ou só da conversa com `partner`) entram na mesma ordem.
+    """
+    await message_writer.barrier()
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    # Pede uma chave a mais só para saber se ainda há outra página
+    if after is not None:
+        rows = await kv.scan(
+            prefix, after=prefix + after,
+            before=prefix + before if before is not None else None,
+            limit=limit + 1,
+        )
+    else:
+        rows = await kv.scan(
+            prefix, before=prefix + before if before is not None else None,
+            limit=limit + 1, reverse=True,
+        )
+    entries = [value for _, value in rows]
+    archived = await _archived_window(username, partner, before, after, limit + 1, [e["id"] for e in entries])
+
+    # Junta quentes e arquivadas pela ordem do índice e corta na página pedida
+    hot_ids = {e["id"] for e in entries}
+    ids = sorted(hot_ids | {m["id"] for m in archived}, reverse=after is None)
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    page_ids = set(ids)
+    messages = await _load(
+        [e for e in entries if e["id"] in page_ids],
+        username,
+        [m for m in archived if m["id"] in page_ids and m["id"] not in hot_ids],
+    )
+    messages.sort(key=lambda m: (m["timestamp"], m["id"]), reverse=True)
+    return {
+        "messages": messages,
+        # Se ainda há mensagens na direção pedida
+        "hasMore": has_more,
+        # Cursores para a próxima chamada: before = mais antiga da página, after = mais recente
+        "cursors": {
+            "before": min(ids) if ids else before,
+            "after": max(ids) if ids else after,
+        },
+    }
+
+
+async def get_inbox_page(username: str, **page) -> dict:
+    return await get_page(inbox_prefix(username), username, **page)
+
+
+async def get_conversation_page(username: str, partner: str, **page) -> dict:
+    return await get_page(conversation_prefix(username, partner), username, partner=partner, **page)
+
+
+async def get_conversation_summaries(username: str) -> List[dict]:
+    """
+    Uma entrada por parceiro com a última mensagem e o número de não lidas.
+    Só os resumos do índice são lidos; das mensagens completas carrega apenas a última de cada conversa.
+    Segmentos arquivados só são abertos quando podem ter não lidas ou quando a conversa já não tem linhas quentes.
+    """
+    await message_writer.barrier()
+    entries = await kv.get_by_prefix(inbox_prefix(username))
+    descs = await archive.descriptors(username)
+
+    last: Dict[str, dict] = {}
+    received: Dict[str, Dict[str, int]] = {}
+    for e in entries:
+        partner = _partner(e, username)
+        if partner not in last or (e["timestamp"], e["id"]) > (last[partner]["timestamp"], last[partner]["id"]):
+            last[partner] = e
+        if e["to"] == username:
+            received.setdefault(partner, {})[e["id"]] = e["timestamp"]
+
+    watermarks = await get_watermarks((username, p) for p in {*last, *(d["partner"] for d in descs)})
+    needed = [
+        d for d in descs
+        if d["partner"] not in last or d["toTs"] > watermarks[(username, d["partner"])]
+    ]
+    last_archived: Dict[str, dict] = {}
+    found = await archive.read(needed, username)
+    for d in needed:
+        partner = d["partner"]
+        for m in found.get(d["segment"], []):
+            if m["to"] == username:
+                received.setdefault(partner, {}).setdefault(m["id"], m["timestamp"])
+            if partner not in last and (
+                partner not in last_archived
+                or (m["timestamp"], m["id"]) > (last_archived[partner]["timestamp"], last_archived[partner]["id"])
+            ):
+                last_archived[partner] = m
+
+    last_messages = {
+        m["id"]: m
+        for m in await _load(list(last.values()), username, last_archived.values())
+    }
+
+    summaries = []
+    for partner, entry in [*last.items(), *last_archived.items()]:
+        msg = last_messages.get(entry["id"])
+        if not msg:
+            continue
+        read_up_to = watermarks[(username, partner)]
+        summaries.append({
+            "username": partner,
+            "lastMessage": msg,
+            "unreadCount": sum(1 for ts in received.get(partner, {}).values() if ts > read_up_to),
+        })
+    return summaries
+
+
+async def find_message(message_id: str, username: str) -> Tuple[Optional[dict], Optional[dict]]:
+    """
+    Procura a mensagem nas linhas quentes e depois nos segmentos arquivados visíveis ao usuário.
+    Devolve (mensagem, descritor do segmento); o descritor é None para mensagens quentes.
+    """
+    msg = await kv.get(message_key(message_id))
+    if msg:
+        return msg, None
+    return await archive.find(message_id, username)
+
+
+async def hide_message(msg: dict, username: str, archived_in: Optional[dict] = None):
+    """Apaga a mensagem apenas para um usuário: marca deleted_for e remove-a dos índices dele."""
+    if archived_in is not None:
+        await archive.hide(msg, username, archived_in)
+        await kv.delete_many(search.keys_for(msg, username))
+        return
+    deleted_for = msg.setdefault("deleted_for", [])
+    if username not in deleted_for:
+        deleted_for.append(username)
+    await kv.set(message_key(msg["id"]), msg)
+    if username in _participants(msg):
+        keys = _index_keys_for(msg, username) + search.keys_for(msg, username)
+        if username == msg["to"]:
+            keys.append(pending_key(username, msg["id"]))
+        await kv.delete_many(keys)
+
+
+async def delete_message(msg: dict, archived_in: Optional[dict] = None):
+    """Apaga a mensagem para todos, incluindo as entradas de índice."""
+    if archived_in is not None:
+        await archive.delete(msg, archived_in)
+        # Os postings da busca das mensagens arquivadas continuam nas chaves da busca
+        await kv.delete_many(key for user in _participants(msg) for key in search.keys_for(msg, user))
+        return
+    await kv.delete_many(message_keys(msg))
+
+
+async def search_messages(
+    username: str,
+    query: str,
+    partner: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_SEARCH_PAGE,
+) -> dict:
+    """
+    Busca no texto das mensagens do usuário (quentes e arquivadas), ordenada por relevância.
+    Todos os termos têm de aparecer; cada termo casa também como prefixo de uma palavra,
+    sem distinguir maiúsculas nem acentos. O cursor é a posição na lista ordenada.
+    """
+    terms = search.query_terms(query)
+    offset = int(cursor) if cursor else 0
+    if not terms:
+        return {"results": [], "total": 0, "nextCursor": None, "terms": []}
+    await message_writer.barrier()
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    # Range scans paginados por termo, só dentro da partição do usuário
+    base = len(search.term_prefix(username))
+    scans = await asyncio.gather(*(_postings(username, term) for term in terms))
+    per_term: List[Dict[str, float]] = []
+    for term, rows in zip(terms, scans):
+        best: Dict[str, float] = {}
+        for key, posting in rows:
+            if partner is not None and posting.get("partner") != partner:
+                continue
+            matched, message_id = key[base:].rsplit(":", 1)
+            best[message_id] = max(best.get(message_id, 0.0), search.score(term, matched, posting["tf"]))
+        per_term.append(best)
+
+    # IDF sobre as mensagens alcançadas pela consulta (não há contagem global por usuário):
+    # numa consulta de vários termos os mais raros pesam mais na ordenação
+    documents = len(set().union(*per_term))
+    scores: Optional[Dict[str, float]] = None
+    for best in per_term:
+        weight = search.idf(documents, len(best)) if best else 0.0
+        weighted = {i: s * weight for i, s in best.items()}
+        # Interseção: só ficam as mensagens que têm todos os termos
+        scores = weighted if scores is None else {i: s + weighted[i] for i, s in scores.items() if i in weighted}
+
+    ranked = sorted(scores, key=lambda i: (scores[i], i), reverse=True)
+    page_ids = ranked[offset:offset + limit]
+    messages = await _load_ids(page_ids, username)
+    results = [{**messages[i], "score": round(scores[i], 3)} for i in page_ids if i in messages]
+    return {
+        "results": results,
+        "total": len(ranked),
+        "nextCursor": str(offset + limit) if offset + limit < len(ranked) else None,
+        "terms": terms,
+    }
+
+
+async def _postings(username: str, term: str) -> List[Tuple[str, dict]]:
+    """Todos os postings de um termo, lidos em páginas de POSTINGS_PAGE por intervalo de chaves."""
+    # Termos curtos só casam por igualdade: o ":" fecha o prefixo no próprio termo
+    prefix = search.term_prefix(username, term) + ("" if len(term) >= search.MIN_PREFIX_LENGTH else ":")
+    rows: List[Tuple[str, dict]] = []
+    after: Optional[str] = None
+    while True:
+        page = await kv.scan(prefix, after=after, limit=search.POSTINGS_PAGE)
+        rows.extend(page)
+        if len(page) < search.POSTINGS_PAGE:
+            return rows
+        after = page[-1][0]
+
+
+async def _load_ids(ids: List[str], username: str) -> Dict[str, dict]:
+    """Mensagens visíveis ao usuário por id, procurando nos segmentos as que já não estão quentes."""
+    found = await kv.get_many(message_key(i) for i in ids)
+    messages = {m["id"]: m for m in found.values() if username not in m.get("deleted_for", [])}
+    missing = {i for i in ids if message_key(i) not in found}
+    if missing:
+        descs = [
+            d for d in await archive.descriptors(username)
+            if any(d["firstId"] <= i <= d["lastId"] for i in missing)
+        ]
+        for archived in (await archive.read(descs, username)).values():
+            messages.update((m["id"], m) for m in archived if m["id"] in missing)
+    await _apply_read_flags(list(messages.values()))
+    return messages
+
+
+async def ensure_indexes():
+    """
+    Gera os índices, as marcas de leitura e a busca para mensagens gravadas antes deles existirem
+    (executa uma única vez por versão do índice).
+    """
+    version = await kv.get(INDEX_VERSION_KEY) or 0
+    if version == INDEX_VERSION:
+        return
+    all_messages: List[Any] = await kv.get_by_prefix("message:")
+    entries: Dict[str, Any] = {}
+    for msg in all_messages:
+        if version >= 2:
+            # Índices e marcas já existem: só falta a busca
+            entries.update(search_entries(msg))
+            continue
+        entries.update(index_entries(msg))
+        # O antigo mark_read marcava tudo: a mensagem lida mais recente vira a marca d'água
+        if msg.get("read"):
+            key = read_key(msg["to"], msg["from"])
+            entries[key] = max(entries.get(key, 0), msg["timestamp"])
+    # Mensagens já arquivadas também entram na busca
+    archived = 0
+    hidden = await archive.hidden_ids()
+    async for key, segment in archive.segments():
+        for msg in archive.reader.messages(key, segment):
+            msg["deleted_for"] += [u for u in _participants(msg) if (u, msg["id"]) in hidden]
+            entries.update(search_entries(msg))
+            archived += 1
+    if entries:
+        await kv.set_many(entries)
+    await kv.set(INDEX_VERSION_KEY, INDEX_VERSION)
+    print(f"🗂️ Índices de mensagens gerados para {len(all_messages)} mensagens ({archived} arquivadas).")
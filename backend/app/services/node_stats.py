@@ -0,0 +1,212 @@
+import asyncio
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+
+from .. import chord
+from ..database import KV_REPLICAS, kv
+from . import archive
+from .message_bus import bus
+
+# O mesmo número de réplicas usado pelo armazenamento particionado
+REPLICATION_FACTOR = KV_REPLICAS
+# Intervalo de envio dos deltas de contadores para os outros workers
+STATS_SYNC_INTERVAL = 1.0
+
+
+def _user_key(username: str) -> str:
+    return f"user:{username}"
+
+
+class NodeStats:
+    """
+    Estatísticas por nó mantidas incrementalmente para o painel admin:
+    - colocação materializada usuário -> nó primário (e a entrada de /admin/distribution);
+    - usuários e mensagens por nó (a mensagem conta para o nó do REMETENTE).
+    O estado é carregado uma vez no startup e depois atualizado no signup, na gravação
+    e remoção de mensagens e quando o anel muda. Os outros workers recebem os deltas
+    pelo barramento, agregados a cada STATS_SYNC_INTERVAL.
+    """
+
+    def __init__(self):
+        self.ring = chord.ChordRing([])
+        self.names: Dict[str, str] = {}
+        # Mensagens enviadas por cada remetente
+        self.sent: Counter = Counter()
+        # Nó primário de cada usuário/remetente conhecido (None se todos offline)
+        self.placement: Dict[str, Optional[int]] = {}
+        self.distribution: Dict[str, dict] = {}
+        self.node_users: Dict[int, Set[str]] = defaultdict(set)
+        self.node_messages: Counter = Counter()
+        # Usuários conhecidos ordenados pela posição no anel (listas paralelas),
+        # para encontrar os afetados por um intervalo movido sem percorrer todos
+        self._positions: List[int] = []
+        self._by_position: List[str] = []
+        self._pending_users: Dict[str, str] = {}
+        self._pending_messages: Counter = Counter()
+        self._sync_task: Optional[asyncio.Task] = None
+
+    # --- Ciclo de vida ---
+
+    async def load(self, ring: chord.ChordRing):
+        """Reconstrói tudo a partir do KV Store (uma única vez, no startup)."""
+        users = await kv.get_by_prefix("user:")
+        messages = await kv.get_by_prefix("message:")
+        self.names = {u["username"]: u["name"] for u in users}
+        self.sent = Counter(m.get("from") for m in messages)
+        # Mensagens já compactadas continuam a contar como enviadas
+        self.sent.update(await archive.sent_counts())
+        self.set_ring(ring)
+        bus.subscribe("node_stats", self._on_remote_delta)
+        if self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self):
+        if self._sync_task:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+        await self._flush_deltas()
+
+    # --- Colocação ---
+
+    def _place(self, username: str, position: Optional[int] = None, replicas: Optional[List[chord.ChordNode]] = None):
+        """(Re)calcula a colocação de um usuário e atualiza os contadores dos nós."""
+        known = username in self.placement
+        old = self.placement.get(username)
+        if position is None:
+            position = self.ring.position(_user_key(username))
+        if replicas is None:
+            replicas = self.ring.owners_at(position, REPLICATION_FACTOR)
+        primary = replicas[0] if replicas else None
+        new = primary.id if primary else None
+
+        if not known:
+            idx = bisect_right(self._positions, position)
+            self._positions.insert(idx, position)
+            self._by_position.insert(idx, username)
+
+        if not known or old != new:
+            count = self.sent.get(username, 0)
+            if known and old is not None:
+                self.node_messages[old] -= count
+                self.node_users[old].discard(username)
+            if new is not None:
+                self.node_messages[new] += count
+            self.placement[username] = new
+
+        if username in self.names:
+            if new is not None:
+                self.node_users[new].add(username)
+            self.distribution[username] = {
+                "name": self.names[username],
+                "primaryNode": primary.name if primary else "Offline",
+                "primaryNodeId": new,
+                "replicaNodes": [r.name for r in replicas[1:]],
+                "chordPosition": position,
+            }
+
+    def _users_in_range(self, start: int, end: int) -> Iterable[str]:
+        """Usuários com posição em (start, end], dando a volta no anel se start >= end."""
+        lo = bisect_right(self._positions, start)
+        hi = bisect_right(self._positions, end)
+        if start < end:
+            return self._by_position[lo:hi]
+        if start > end:
+            return self._by_position[lo:] + self._by_position[:hi]
+        return list(self._by_position)
+
+    def _place_many(self, usernames: List[str]):
+        """Colocação em lote: posições e réplicas calculadas de uma vez para todos."""
+        positions = self.ring.config.positions([_user_key(u) for u in usernames])
+        placements = self.ring.place_positions(positions, REPLICATION_FACTOR)
+        for username, position, replicas in zip(usernames, positions, placements):
+            self._place(username, position, replicas)
+
+    def set_ring(self, ring: chord.ChordRing):
+        """
+        O anel mudou (startup, toggle). Com a mesma configuração só são recolocados os
+        usuários dos intervalos cujos responsáveis mudaram; senão recalcula tudo.
+        """
+        previous, self.ring = self.ring, ring
+        if self.placement and previous.config == ring.config:
+            moved: List[str] = []
+            for start, end in chord.changed_ranges(previous, ring, REPLICATION_FACTOR):
+                moved.extend(self._users_in_range(start, end))
+            self._place_many(moved)
+            return
+
+        self.placement.clear()
+        self.distribution.clear()
+        self.node_users.clear()
+        self.node_messages.clear()
+        self._positions.clear()
+        self._by_position.clear()
+        self._place_many(list(set(self.names) | set(self.sent)))
+
+    # --- Atualizações incrementais ---
+
+    def add_user(self, username: str, name: str, propagate: bool = True):
+        self.names[username] = name
+        self._place(username)
+        if propagate:
+            self._pending_users[username] = name
+
+    def add_messages(self, sender: str, delta: int = 1, propagate: bool = True):
+        """Mensagens gravadas (delta > 0) ou apagadas para todos (delta < 0)."""
+        if sender not in self.placement:
+            self._place(sender)
+        self.sent[sender] += delta
+        node_id = self.placement.get(sender)
+        if node_id is not None:
+            self.node_messages[node_id] += delta
+        if propagate:
+            self._pending_messages[sender] += delta
+
+    # --- Leituras (O(nós) para os contadores) ---
+
+    def nodes_view(self, nodes: List[chord.ChordNode]) -> List[dict]:
+        share = self.ring.load_spread()
+        return [
+            {
+                **n.dict(),
+                "users": sorted(self.node_users.get(n.id, ())),
+                "messageCount": self.node_messages.get(n.id, 0),
+                "keyspaceShare": round(share.get(n.id, 0.0), 4),
+            }
+            for n in nodes
+        ]
+
+    # --- Sincronização entre workers ---
+
+    async def _flush_deltas(self):
+        if not self._pending_users and not self._pending_messages:
+            return
+        data = {
+            "users": self._pending_users,
+            "messages": {k: v for k, v in self._pending_messages.items() if v},
+        }
+        self._pending_users = {}
+        self._pending_messages = Counter()
+        await bus.emit("node_stats", data)
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(STATS_SYNC_INTERVAL)
+            try:
+                await self._flush_deltas()
+            except Exception as e:
+                print(f"⚠️ Erro ao sincronizar estatísticas dos nós: {e}")
+
+    async def _on_remote_delta(self, data: dict):
+        for username, name in data.get("users", {}).items():
+            self.add_user(username, name, propagate=False)
+        for sender, delta in data.get("messages", {}).items():
+            self.add_messages(sender, delta, propagate=False)
+
+
+# Instância única para ser usada em todas as rotas
+node_stats = NodeStats()
@@ -0,0 +1,159 @@
+import asyncio
+import os
+from typing import Dict, List, Optional
+
+from fastapi import WebSocket
+
+from .. import metrics
+from ..database import kv
+from .message_bus import bus
+from .message_store import pending_prefix
+from .websocket_manager import manager
+
+# Entrega diferida (store-and-forward): mensagens para destinatários offline ficam em
+# pending:{destinatario}:{id} (no modo particionado, nas réplicas do nó responsável pelo
+# destinatário) e são escoadas quando ele se conecta.
+#
+# Clientes que se conectam com ?backlog=batch recebem a fila em lotes ordenados:
+#   servidor -> {"type": "backlog", "messages": [...], "upTo": id, "more": bool}
+#   cliente  -> {"type": "backlog_ack", "upTo": id}
+# O lote seguinte só sai depois do ack; o que não foi confirmado volta na próxima conexão.
+# Clientes antigos (sem ?backlog=batch) recebem a fila como frames "chat" normais, em ordem,
+# numa tarefa por sessão: com a fila de saída cheia espera que ela escoe (não desliga o cliente)
+# e cada lote só é apagado depois de o writer da conexão o ter enviado. Se a conexão cair a
+# meio, o lote volta inteiro na próxima (entrega pelo menos uma vez; o cliente ignora ids repetidos).
+PENDING_BATCH = int(os.getenv("PENDING_BATCH", "100"))
+
+OFFLINE_QUEUED = metrics.counter(
+    "okupopia_offline_queued_total", "Mensagens guardadas para destinatários offline."
+).labels()
+BACKLOG_DELIVERED = metrics.counter(
+    "okupopia_backlog_delivered_total", "Mensagens da fila offline confirmadas pelos clientes."
+).labels()
+
+
+class _Session:
+    __slots__ = ("websocket", "batched", "in_flight", "lock", "flusher", "rescan")
+
+    def __init__(self, websocket: WebSocket, batched: bool):
+        self.websocket = websocket
+        self.batched = batched
+        # Chaves do lote enviado e ainda não confirmado
+        self.in_flight: Optional[List[str]] = None
+        self.lock = asyncio.Lock()
+        # Clientes antigos: tarefa que escoa a fila e pedido de nova leitura enquanto ela corre
+        self.flusher: Optional[asyncio.Task] = None
+        self.rescan = False
+
+
+class OfflineQueue:
+    def __init__(self):
+        self._sessions: Dict[str, _Session] = {}
+
+    async def attach(self, username: str, websocket: WebSocket, batched: bool):
+        """Chamado logo após manager.connect: começa a escoar a fila do usuário."""
+        session = self._sessions[username] = _Session(websocket, batched)
+        if batched:
+            await self._send_next(username, session)
+        else:
+            self._start_legacy(username, session)
+
+    def detach(self, username: str, websocket: WebSocket):
+        session = self._sessions.get(username)
+        # Uma aba antiga que fecha não desliga a sessão da aba que a substituiu
+        if session is not None and session.websocket is websocket:
+            del self._sessions[username]
+            if session.flusher is not None:
+                session.flusher.cancel()
+
+    async def ack(self, username: str, websocket: WebSocket, up_to: Optional[str]):
+        session = self._sessions.get(username)
+        if session is None or session.websocket is not websocket or not session.in_flight:
+            return
+        async with session.lock:
+            keys = session.in_flight
+            if not keys or not keys[-1].endswith(f":{up_to}"):
+                return
+            await kv.delete_many(keys)
+            session.in_flight = None
+            BACKLOG_DELIVERED.inc(len(keys))
+        await self._send_next(username, session)
+
+    async def queued(self, username: str):
+        """
+        Uma mensagem acabou de ser gravada na fila de um destinatário: se entretanto ele se
+        conectou (a este ou a outro worker), escoa-a já em vez de esperar pela próxima reconexão.
+        """
+        OFFLINE_QUEUED.inc()
+        if username in self._sessions:
+            await self._kick(username)
+        elif bus.is_online_elsewhere(username):
+            await bus.emit("pending_ready", {"username": username})
+
+    async def _on_pending_ready(self, data: dict):
+        await self._kick(data["username"])
+
+    async def _kick(self, username: str):
+        session = self._sessions.get(username)
+        if session is None:
+            return
+        if session.batched:
+            await self._send_next(username, session)
+        else:
+            self._start_legacy(username, session)
+
+    async def _send_next(self, username: str, session: _Session):
+        async with session.lock:
+            if session.in_flight is not None:
+                return
+            rows = await kv.scan(pending_prefix(username), limit=PENDING_BATCH + 1)
+            batch = rows[:PENDING_BATCH]
+            if not batch or self._sessions.get(username) is not session:
+                return
+            connection = manager.active_connections.get(username)
+            if connection is None or connection.websocket is not session.websocket:
+                return
+            session.in_flight = [key for key, _ in batch]
+            # Um frame por lote, na ordem dos ids (cronológica)
+            connection.push(connection.codec.encode({
+                "type": "backlog",
+                "messages": [message for _, message in batch],
+                "upTo": batch[-1][1]["id"],
+                "more": len(rows) > PENDING_BATCH,
+            }))
+
+    def _start_legacy(self, username: str, session: _Session):
+        # Quem grava na fila (ack do remetente) não espera pelo socket do destinatário
+        session.rescan = True
+        if session.flusher is None or session.flusher.done():
+            session.flusher = asyncio.create_task(self._flush_legacy(username, session))
+
+    async def _flush_legacy(self, username: str, session: _Session):
+        """Cliente antigo: escoa a fila toda como mensagens normais, sem ack do cliente."""
+        while self._sessions.get(username) is session:
+            connection = manager.active_connections.get(username)
+            if connection is None or connection.websocket is not session.websocket:
+                return
+            session.rescan = False
+            rows = await kv.scan(pending_prefix(username), limit=PENDING_BATCH)
+            if not rows:
+                # Uma mensagem gravada durante a leitura pede outra volta
+                if session.rescan:
+                    continue
+                return
+            for _, message in rows:
+                frame = connection.codec.encode(message)
+                # Fila de saída cheia: espera o writer escoá-la em vez de desligar o cliente
+                while not connection.offer(frame):
+                    if not await connection.flush():
+                        return
+            # Só apaga o que o writer já enviou; conexão fechada a meio: o lote fica para a próxima
+            if not await connection.flush():
+                return
+            await kv.delete_many(key for key, _ in rows)
+            BACKLOG_DELIVERED.inc(len(rows))
+
+
+# Instância única para ser usada em todas as rotas
+offline_queue = OfflineQueue()
+bus.subscribe("pending_ready", offline_queue._on_pending_ready)
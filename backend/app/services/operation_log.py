@@ -0,0 +1,149 @@
+import asyncio
+import os
+import time
+import uuid
+from typing import Optional
+
+from ..database import kv
+from .write_pipeline import GroupCommitWriter
+
+# Log append-only: uma chave por entrada, log:{microssegundos}-{worker}.
+# Os ids são monotónicos dentro do worker e ordenáveis por tempo entre workers,
+# por isso não há read-modify-write nem entradas perdidas em escritas concorrentes.
+LOG_PREFIX = "log:"
+LEGACY_LOG_KEY = "system:operation_logs"
+
+LOG_MAX_ENTRIES = int(os.getenv("LOG_MAX_ENTRIES", "1000"))
+LOG_RETENTION_HOURS = float(os.getenv("LOG_RETENTION_HOURS", str(7 * 24)))
+LOG_TRIM_INTERVAL = float(os.getenv("LOG_TRIM_INTERVAL", "60"))
+LOG_TRIM_BATCH = 500
+
+DEFAULT_LOG_PAGE = 100
+MAX_LOG_PAGE = 500
+
+
+class OperationLog:
+    """
+    Registo das operações do sistema (toggle de nós, falhas, etc.).
+    record() só enfileira: a gravação é feita em lote por um GroupCommitWriter
+    e a retenção (idade e número máximo de entradas) é aplicada em segundo plano.
+    """
+
+    def __init__(self):
+        self._writer = GroupCommitWriter(kv.set_many, max_delay=0.05, max_pending=10000)
+        self._worker = uuid.uuid4().hex[:6]
+        self._last_micros = 0
+        self._trim_task: Optional[asyncio.Task] = None
+        self.dropped = 0
+        self._background: set = set()
+
+    def _next_id(self) -> str:
+        micros = max(time.time_ns() // 1000, self._last_micros + 1)
+        self._last_micros = micros
+        return f"{micros:016d}-{self._worker}"
+
+    async def start(self):
+        await self._writer.start()
+        await self._migrate_legacy()
+        if self._trim_task is None:
+            self._trim_task = asyncio.create_task(self._trim_loop())
+
+    async def stop(self):
+        if self._trim_task:
+            self._trim_task.cancel()
+            try:
+                await self._trim_task
+            except asyncio.CancelledError:
+                pass
+            self._trim_task = None
+        await self._writer.stop()
+
+    def record(self, operation: str, details: dict) -> dict:
+        """Regista a operação sem esperar pelo banco."""
+        entry = {
+            "id": self._next_id(),
+            "timestamp": int(time.time() * 1000),
+            "operation": operation,
+            "details": details,
+        }
+        items = {LOG_PREFIX + entry["id"]: entry}
+        if not self._writer.offer(items):
+            if self._writer.running:
+                # Fila cheia: perder uma linha de log é preferível a atrasar a operação
+                self.dropped += 1
+            else:
+                # Fora do ciclo de vida da app (scripts, testes) grava em segundo plano
+                task = asyncio.get_running_loop().create_task(kv.set_many(items))
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+        return entry
+
+    async def page(self, before: Optional[str] = None, limit: int = DEFAULT_LOG_PAGE) -> dict:
+        """Entradas mais recentes primeiro; `before` é o id da última entrada já vista."""
+        await self._writer.barrier()
+        limit = max(1, min(limit, MAX_LOG_PAGE))
+        rows = await kv.scan(
+            LOG_PREFIX,
+            before=LOG_PREFIX + before if before is not None else None,
+            limit=limit + 1,
+            reverse=True,
+        )
+        logs = [value for _, value in rows[:limit]]
+        return {
+            "logs": logs,
+            "hasMore": len(rows) > limit,
+            "nextCursor": logs[-1]["id"] if logs and len(rows) > limit else None,
+        }
+
+    async def clear(self):
+        await self._writer.barrier()
+        while True:
+            rows = await kv.scan(LOG_PREFIX, limit=LOG_TRIM_BATCH)
+            if not rows:
+                break
+            await kv.delete_many(key for key, _ in rows)
+        await kv.delete(LEGACY_LOG_KEY)
+
+    async def trim(self):
+        """Aplica a retenção: remove entradas antigas demais e o excesso acima de LOG_MAX_ENTRIES."""
+        cutoff = int((time.time() - LOG_RETENTION_HOURS * 3600) * 1_000_000)
+        while True:
+            expired = await kv.scan(LOG_PREFIX, before=f"{LOG_PREFIX}{cutoff:016d}", limit=LOG_TRIM_BATCH)
+            if not expired:
+                break
+            await kv.delete_many(key for key, _ in expired)
+
+        newest = await kv.scan(LOG_PREFIX, reverse=True, limit=LOG_MAX_ENTRIES + LOG_TRIM_BATCH)
+        excess = newest[LOG_MAX_ENTRIES:]
+        if excess:
+            await kv.delete_many(key for key, _ in excess)
+
+    async def _trim_loop(self):
+        while True:
+            await asyncio.sleep(LOG_TRIM_INTERVAL)
+            try:
+                await self.trim()
+            except Exception as e:
+                print(f"⚠️ Erro ao aplicar retenção dos logs: {e}")
+
+    async def _migrate_legacy(self):
+        """Converte a antiga lista system:operation_logs em entradas individuais (uma vez)."""
+        try:
+            legacy = await kv.get(LEGACY_LOG_KEY)
+        except Exception as e:
+            print(f"⚠️ Erro ao ler logs antigos: {e}")
+            return
+        if not legacy:
+            return
+        items = {}
+        # A lista estava da mais recente para a mais antiga
+        for i, entry in enumerate(reversed(legacy)):
+            entry_id = f"{entry.get('timestamp', 0) * 1000 + i:016d}-legacy"
+            items[LOG_PREFIX + entry_id] = {"id": entry_id, **entry}
+        await kv.set_many(items)
+        await kv.delete(LEGACY_LOG_KEY)
+        print(f"🗂️ {len(items)} logs antigos migrados para o log append-only.")
+
+
+# Instância única para ser usada em todas as rotas
+operation_log = OperationLog()
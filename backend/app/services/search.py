@@ -0,0 +1,76 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, List
+
+# Índice invertido da busca, particionado por usuário (cada um só vê as suas mensagens):
+#   search:{usuario}:{termo}:{id} -> {"tf": ocorrências do termo, "partner": parceiro da conversa}
+# Um termo por chave: a busca por prefixo ("cas" -> casa, casamento) é um único range scan
+# sobre search:{usuario}:cas, sem ler os termos nem as mensagens de outros usuários.
+
+SEARCH_PREFIX = "search:"
+# Termos mais curtos do que isto só casam por igualdade (prefixos curtos varrem demais)
+MIN_PREFIX_LENGTH = 3
+# Postings lidos por página no range scan de cada termo (todos são lidos, página a página)
+POSTINGS_PAGE = 1000
+MAX_QUERY_TERMS = 8
+# Um termo exato vale mais do que um que só começa pelo termo da consulta
+PREFIX_MATCH_WEIGHT = 0.6
+
+# Palavras muito frequentes em português que não ajudam a encontrar nada
+STOPWORDS = frozenset("""
+    a o e as os de da do das dos em na no nas nos um uma uns umas por para pra com sem
+    que se ao aos ou mas mais me te lhe eu tu ele ela vos eles elas isso isto esse
+    essa este esta ja nao sim foi ser ter tem era sao estou
+""".split())
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def normalize(text: str) -> str:
+    """Minúsculas e sem acentos: "Ação" e "acao" são o mesmo termo."""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def words(text: str) -> List[str]:
+    """Palavras normalizadas do texto, sem filtrar nada."""
+    return _TOKEN.findall(normalize(text))
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in words(text) if len(t) > 1 and t not in STOPWORDS]
+
+
+def query_terms(query: str) -> List[str]:
+    # Na consulta as stopwords contam se forem tudo o que o usuário escreveu
+    terms = tokenize(query) or words(query)
+    return list(dict.fromkeys(terms))[:MAX_QUERY_TERMS]
+
+
+def term_prefix(username: str, term: str = "") -> str:
+    return f"{SEARCH_PREFIX}{username}:{term}"
+
+
+def entries_for(msg: dict, username: str, partner: str) -> Dict[str, dict]:
+    """Postings de uma mensagem no índice de um participante."""
+    counts = Counter(tokenize(msg.get("text") or ""))
+    return {
+        f"{term_prefix(username, term)}:{msg['id']}": {"tf": tf, "partner": partner}
+        for term, tf in counts.items()
+    }
+
+
+def keys_for(msg: dict, username: str) -> List[str]:
+    return [f"{term_prefix(username, term)}:{msg['id']}" for term in set(tokenize(msg.get("text") or ""))]
+
+
+def score(term: str, matched: str, tf: int) -> float:
+    weight = 1.0 if matched == term else PREFIX_MATCH_WEIGHT
+    return weight * (1 + math.log(tf))
+
+
+def idf(documents: int, df: int) -> float:
+    """Termos raros pesam mais do que os que aparecem em quase todas as mensagens."""
+    return math.log(1 + documents / df)
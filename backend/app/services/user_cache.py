@@ -0,0 +1,102 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from ..database import kv
+from .message_bus import bus
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+
+
+def user_key(username: str) -> str:
+    return f"user:{username}"
+
+
+class UserCache:
+    """
+    Cache read-through dos registros `user:*` (LRU limitado + TTL).
+    Perfis mudam pouco: as leituras vêm da memória e as escritas passam por put(),
+    que grava no KV Store e atualiza o cache. Usuários inexistentes não são cacheados.
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, username: str) -> Optional[dict]:
+        entry = self._entries.get(username)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self._entries[username]
+            return None
+        self._entries.move_to_end(username)
+        return user
+
+    def _store(self, username: str, user: dict):
+        self._entries[username] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        self._entries.pop(username, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get(self, username: str) -> Optional[dict]:
+        user = self._lookup(username)
+        if user is not None:
+            self.hits += 1
+            return dict(user)
+        self.misses += 1
+        user = await kv.get(user_key(username))
+        if user:
+            self._store(username, user)
+            return dict(user)
+        return None
+
+    async def get_many(self, usernames: Iterable[str]) -> Dict[str, dict]:
+        """Perfis de vários usuários; os que faltam no cache vêm numa única consulta."""
+        result: Dict[str, dict] = {}
+        missing = []
+        for username in dict.fromkeys(usernames):
+            user = self._lookup(username)
+            if user is not None:
+                result[username] = dict(user)
+            else:
+                missing.append(username)
+        self.hits += len(result)
+        self.misses += len(missing)
+
+        if missing:
+            found = await kv.get_many(user_key(u) for u in missing)
+            for username in missing:
+                user = found.get(user_key(username))
+                if user:
+                    self._store(username, user)
+                    result[username] = dict(user)
+        return result
+
+    async def put(self, user: dict):
+        """Write-through: grava o perfil, atualiza o cache deste processo e invalida o dos outros workers."""
+        username = user["username"]
+        self.invalidate(username)
+        await kv.set(user_key(username), user)
+        self._store(username, dict(user))
+        await bus.emit("user_updated", {"username": username})
+
+    async def _on_user_updated(self, data: dict):
+        self.invalidate(data["username"])
+
+
+# Instância única para ser usada em todas as rotas
+user_cache = UserCache()
+bus.subscribe("user_updated", user_cache._on_user_updated)
@@ -0,0 +1,110 @@
+from typing import Dict, List, Optional, Sequence
+
+from ..database import kv
+from .search import words as normalized_words
+from .user_cache import user_cache
+
+# Diretório de usuários ordenado, para o seletor de contatos:
+#   directory:{termo}:{usuario} -> {"username", "name", "terms"}
+# Cada usuário tem uma entrada por termo (o username e cada palavra do nome, sem acentos),
+# por isso a busca por prefixo ("jo" -> joana, João Silva) é um range scan sobre directory:jo.
+
+DIRECTORY_PREFIX = "directory:"
+DIRECTORY_VERSION = 1
+DIRECTORY_VERSION_KEY = "system:user_directory_version"
+
+DEFAULT_USERS_PAGE = 50
+MAX_USERS_PAGE = 200
+# Campos públicos do perfil (a senha nunca sai); username e name vêm do próprio índice
+PUBLIC_FIELDS = ("username", "name", "status", "joinedAt")
+INDEX_FIELDS = ("username", "name")
+BACKFILL_BATCH = 500
+
+
+def terms_for(user: dict) -> List[str]:
+    username_term = "".join(normalized_words(user["username"]))
+    terms = [username_term] + normalized_words(user.get("name") or "")
+    return sorted({t for t in terms if t}) or [user["username"].casefold().replace(":", "")]
+
+
+def entries_for(user: dict) -> Dict[str, dict]:
+    terms = terms_for(user)
+    entry = {"username": user["username"], "name": user.get("name", ""), "terms": terms}
+    return {f"{DIRECTORY_PREFIX}{term}:{user['username']}": entry for term in terms}
+
+
+async def add(user: dict):
+    await kv.set_many(entries_for(user))
+
+
+def _matches(key: str, entry: dict, words: List[str]) -> bool:
+    first = words[0] if words else ""
+    term = key[len(DIRECTORY_PREFIX):].rsplit(":", 1)[0]
+    # Um usuário aparece só no primeiro dos seus termos que casa, por isso nunca se repete entre páginas
+    if term != next(t for t in entry["terms"] if t.startswith(first)):
+        return False
+    return all(any(t.startswith(w) for t in entry["terms"]) for w in words[1:])
+
+
+async def page(
+    query: str = "",
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_USERS_PAGE,
+    exclude: Optional[str] = None,
+    fields: Sequence[str] = INDEX_FIELDS,
+) -> dict:
+    """
+    Usuários cujo username ou alguma palavra do nome começa por cada termo da consulta,
+    em ordem alfabética do termo que casou. `cursor` é a última chave devolvida (keyset):
+    cada página custa um range scan de ~`limit` chaves, independente do total de usuários.
+    Só os `fields` pedidos são devolvidos; perfis completos são lidos apenas se faltarem campos no índice.
+    """
+    words = normalized_words(query)
+    prefix = DIRECTORY_PREFIX + (words[0] if words else "")
+    after = DIRECTORY_PREFIX + cursor if cursor else None
+
+    users: List[dict] = []
+    last_key = None
+    while True:
+        rows = await kv.scan(prefix, after=after, limit=limit + 1)
+        for key, entry in rows:
+            after = key
+            if entry["username"] == exclude or not _matches(key, entry, words):
+                continue
+            if len(users) == limit:
+                # Ainda há pelo menos mais um: a próxima página começa depois do último devolvido
+                return {"users": await _project(users, fields), "nextCursor": last_key[len(DIRECTORY_PREFIX):]}
+            users.append(entry)
+            last_key = key
+        if len(rows) <= limit:
+            return {"users": await _project(users, fields), "nextCursor": None}
+
+
+async def _project(entries: List[dict], fields: Sequence[str]) -> List[dict]:
+    if set(fields) <= set(INDEX_FIELDS):
+        return [{f: e[f] for f in fields} for e in entries]
+    profiles = await user_cache.get_many(e["username"] for e in entries)
+    return [
+        {f: profiles[e["username"]].get(f) for f in fields}
+        for e in entries if e["username"] in profiles
+    ]
+
+
+async def ensure_index():
+    """Gera o diretório a partir dos registros user:* existentes (uma única vez por versão)."""
+    if await kv.get(DIRECTORY_VERSION_KEY) == DIRECTORY_VERSION:
+        return
+    count = 0
+    after = None
+    while True:
+        rows = await kv.scan("user:", after=after, limit=BACKFILL_BATCH)
+        if not rows:
+            break
+        after = rows[-1][0]
+        entries: Dict[str, dict] = {}
+        for _, user in rows:
+            entries.update(entries_for(user))
+        await kv.set_many(entries)
+        count += len(rows)
+    await kv.set(DIRECTORY_VERSION_KEY, DIRECTORY_VERSION)
+    print(f"📇 Diretório de usuários gerado para {count} usuários.")
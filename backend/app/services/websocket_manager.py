@@ -1,34 +1,245 @@
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
 from fastapi import WebSocket
-import json
+import asyncio
+import os
+
+from .. import metrics
+from . import wire
+from .message_bus import MessageBus, bus as default_bus
+
+# Fila de saída por conexão e política para clientes lentos
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "256"))
+SEND_TIMEOUT = float(os.getenv("SEND_TIMEOUT", "10"))
+# "disconnect": fecha a conexão de quem não acompanha; "drop": descarta os frames excedentes
+SLOW_CONSUMER_POLICY = os.getenv("SLOW_CONSUMER_POLICY", "disconnect").lower()
+# Código de fecho "Try Again Later": o cliente pode reconectar
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class Connection:
+    """
+    Uma conexão WebSocket com a sua fila de saída, escoada por uma tarefa própria.
+    Quem envia só enfileira frames já serializados no formato negociado pela conexão
+    (texto JSON ou binário); um cliente lento atrasa apenas a sua fila.
+    Indicadores de digitação ficam à parte, um por remetente (o mais recente vence),
+    e são descartados quando a fila está sob pressão.
+    """
+
+    def __init__(self, username: str, websocket: WebSocket, codec=wire.JSON):
+        self.username = username
+        self.websocket = websocket
+        self.codec = codec
+        self._outbox: Deque[wire.Frame] = deque()
+        self._typing: Dict[str, wire.Frame] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.closed = False
+        self.dropped = 0
+        # Frames da fila principal enfileirados e já enviados pelo writer (para flush())
+        self._pushed = 0
+        self._sent = 0
+        self._flushes: List[Tuple[int, asyncio.Future]] = []
+
+    @property
+    def depth(self) -> int:
+        return len(self._outbox) + len(self._typing)
+
+    def start(self):
+        self._task = asyncio.create_task(self._writer())
+
+    def stop(self):
+        self.closed = True
+        if self._task and not self._task.done() and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._settle()
+
+    def push(self, frame: wire.Frame) -> bool:
+        if self.closed:
+            return False
+        if len(self._outbox) >= SEND_QUEUE_SIZE:
+            if SLOW_CONSUMER_POLICY == "drop":
+                self.dropped += 1
+                metrics.WS_FRAMES_DROPPED.inc()
+                return False
+            self._kick("fila de envio cheia")
+            return False
+        self._append(frame)
+        return True
+
+    def offer(self, frame: wire.Frame) -> bool:
+        """Como push(), mas com a fila cheia só devolve False: não desliga nem descarta."""
+        if self.closed or len(self._outbox) >= SEND_QUEUE_SIZE:
+            return False
+        self._append(frame)
+        return True
+
+    def _append(self, frame: wire.Frame):
+        self._outbox.append(frame)
+        self._pushed += 1
+        self._wakeup.set()
+
+    async def flush(self) -> bool:
+        """
+        Espera até o writer ter enviado todos os frames já enfileirados (não só tirado da fila).
+        Devolve False se a conexão fechou antes disso.
+        """
+        if self.closed:
+            return False
+        if self._sent >= self._pushed:
+            return True
+        future = asyncio.get_running_loop().create_future()
+        self._flushes.append((self._pushed, future))
+        return await future
+
+    def _settle(self):
+        """Resolve os flush() já cumpridos; com a conexão fechada, todos com False."""
+        waiting = []
+        for target, future in self._flushes:
+            if future.done():
+                continue
+            if self.closed:
+                future.set_result(False)
+            elif target <= self._sent:
+                future.set_result(True)
+            else:
+                waiting.append((target, future))
+        self._flushes = waiting
+
+    def push_droppable(self, key: str, frame: wire.Frame) -> bool:
+        if self.closed:
+            return False
+        if len(self._outbox) >= SEND_QUEUE_SIZE // 2:
+            # Sob pressão, digitação é a primeira coisa a ser sacrificada
+            self.dropped += 1
+            metrics.WS_FRAMES_DROPPED.inc()
+            return True
+        self._typing[key] = frame
+        self._wakeup.set()
+        return True
+
+    async def _writer(self):
+        send = self.websocket.send_bytes if self.codec.binary else self.websocket.send_text
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._outbox or self._typing:
+                    if self._outbox:
+                        frame = self._outbox.popleft()
+                        counted = True
+                    else:
+                        key = next(iter(self._typing))
+                        frame = self._typing.pop(key)
+                        counted = False
+                    await asyncio.wait_for(send(frame), SEND_TIMEOUT)
+                    metrics.WS_FRAMES_OUT.inc()
+                    if counted:
+                        self._sent += 1
+                        if self._flushes:
+                            self._settle()
+        except asyncio.TimeoutError:
+            self._kick("envio excedeu o tempo limite")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Socket já fechado: o loop de receção trata do disconnect
+            self.closed = True
+            self._settle()
+
+    def _kick(self, reason: str):
+        if self.closed:
+            return
+        print(f"🐢 Cliente lento desconectado ({self.username}): {reason}")
+        metrics.WS_SLOW_CONSUMERS.inc()
+        self.stop()
+        asyncio.get_running_loop().create_task(self._close())
+
+    async def _close(self):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE), SEND_TIMEOUT)
+        except Exception:
+            pass
+
 
 class ConnectionManager:
-    def __init__(self):
-        # Dicionário para rastrear conexões ativas: { "username": WebSocket }
-        self.active_connections: dict[str, WebSocket] = {}
+    def __init__(self, bus: MessageBus = default_bus):
+        # Dicionário para rastrear conexões ativas neste worker: { "username": Connection }
+        self.active_connections: Dict[str, Connection] = {}
+        # Barramento para alcançar usuários conectados a outros workers/hosts
+        self.bus = bus
+        bus.on_deliver = self._deliver_local
+        bus.on_broadcast = self._broadcast_local
 
     async def connect(self, username: str, websocket: WebSocket):
-        await websocket.accept()
-        # Se o usuário já estiver conectado em outra aba, fecha a antiga ou ignora
-        self.active_connections[username] = websocket
+        # Clientes novos pedem o protocolo binário pelo subprotocolo; os antigos ficam no JSON
+        codec, protocol = wire.negotiate(wire.offered_protocols(websocket))
+        await websocket.accept(subprotocol=protocol)
+        # Se o usuário já estiver conectado em outra aba, a conexão nova substitui a antiga
+        previous = self.active_connections.get(username)
+        if previous:
+            previous.stop()
+        connection = Connection(username, websocket, codec)
+        connection.start()
+        self.active_connections[username] = connection
+        self.bus.join(username)
         print(f"🔌 Usuário conectado: {username}")
 
-    def disconnect(self, username: str):
-        if username in self.active_connections:
-            del self.active_connections[username]
-            print(f"❌ Usuário desconectado: {username}")
+    def disconnect(self, username: str, websocket: Optional[WebSocket] = None):
+        connection = self.active_connections.get(username)
+        # Ignora o disconnect de uma aba antiga que já foi substituída
+        if connection is None or (websocket is not None and connection.websocket is not websocket):
+            return
+        connection.stop()
+        del self.active_connections[username]
+        self.bus.leave(username)
+        print(f"❌ Usuário desconectado: {username}")
+
+    def is_online(self, username: str) -> bool:
+        """Se o usuário está conectado a este ou a qualquer outro worker."""
+        return username in self.active_connections or self.bus.is_online_elsewhere(username)
+
+    async def _deliver_local(self, username: str, message: dict) -> bool:
+        connection = self.active_connections.get(username)
+        if connection is None:
+            return False
+        if message.get("type") == "typing":
+            return connection.push_droppable(message.get("from", ""), connection.codec.encode(message))
+        return connection.push(connection.codec.encode(message))
 
-    async def send_personal_message(self, message: dict, username: str):
-        """Envia uma mensagem JSON para um usuário específico se ele estiver online"""
-        if username in self.active_connections:
-            websocket = self.active_connections[username]
-            await websocket.send_json(message)
+    async def send_personal_message(self, message: dict, username: str, confirm: bool = False):
+        """
+        Enfileira uma mensagem JSON para um usuário específico se ele estiver online (em qualquer worker).
+        Com `confirm`, uma entrega noutro worker só conta depois de ele a confirmar.
+        """
+        if await self._deliver_local(username, message):
             return True
-        return False
+        return await self.bus.send(username, message, confirm=confirm)
+
+    async def _broadcast_local(self, message: dict):
+        # Serializa uma única vez por formato; cada fila é escoada pela sua tarefa, em paralelo
+        frames: Dict[str, wire.Frame] = {}
+        for connection in list(self.active_connections.values()):
+            frame = frames.get(connection.codec.name)
+            if frame is None:
+                frame = frames[connection.codec.name] = connection.codec.encode(message)
+            connection.push(frame)
 
     async def broadcast(self, message: dict):
         """Envia para todos os usuários conectados (útil para anúncios do sistema)"""
-        for connection in self.active_connections.values():
-            await connection.send_json(message)
+        await self._broadcast_local(message)
+        await self.bus.broadcast(message)
+
+    def queue_depths(self):
+        return [c.depth for c in self.active_connections.values()]
 
 # Instância única para ser usada em todas as rotas
-manager = ConnectionManager()
\ No newline at end of file
+manager = ConnectionManager()
+
+# Lidas só na coleta do /metrics: nada a fazer no caminho de envio
+metrics.gauge("okupopia_ws_connections", "Conexões WebSocket abertas neste worker.",
+              lambda: len(manager.active_connections))
+metrics.gauge("okupopia_ws_send_queue_depth", "Frames à espera nas filas de envio (soma de todas as conexões).",
+              lambda: sum(manager.queue_depths()))
+metrics.gauge("okupopia_ws_send_queue_depth_max", "Maior fila de envio entre as conexões abertas.",
+              lambda: max(manager.queue_depths(), default=0))
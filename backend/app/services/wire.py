@@ -0,0 +1,127 @@
+import json
+import os
+import zlib
+from typing import Dict, List, Optional, Tuple, Union
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+try:
+    import orjson
+except ImportError:
+    # orjson é opcional: sem ele o JSON usa a biblioteca padrão
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    # Sem msgpack o protocolo binário não é oferecido e todos os clientes ficam no JSON
+    msgpack = None
+
+# Formatos de frame do WebSocket, negociados pelo subprotocolo (Sec-WebSocket-Protocol):
+#   (nenhum) ou "okupopia.json"  -> frames de texto JSON (clientes antigos)
+#   "okupopia.msgpack"           -> frames binários: 1 byte de flags + MessagePack,
+#                                   comprimido com deflate quando FLAG_DEFLATE está ligado
+# O servidor aceita sempre frames de texto JSON, qualquer que seja o protocolo negociado.
+JSON_PROTOCOL = "okupopia.json"
+MSGPACK_PROTOCOL = "okupopia.msgpack"
+
+FLAG_DEFLATE = 0x01
+# Payloads a partir deste tamanho vão comprimidos (0 desliga a compressão)
+WS_DEFLATE_MIN_BYTES = int(os.getenv("WS_DEFLATE_MIN_BYTES", "1024"))
+WS_DEFLATE_LEVEL = 6
+# Tamanho máximo de um frame do cliente, já descomprimido (protege contra zip bombs)
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", str(1024 * 1024)))
+# Código de fecho do WebSocket para "mensagem grande demais" (RFC 6455)
+CLOSE_TOO_BIG = 1009
+
+Frame = Union[str, bytes]
+
+
+class FrameTooLarge(ValueError):
+    """Frame do cliente acima de WS_MAX_FRAME_BYTES (antes ou depois de descomprimir)."""
+
+
+if orjson is not None:
+    def dumps(message: dict) -> str:
+        return orjson.dumps(message).decode()
+
+    loads = orjson.loads
+else:
+    def dumps(message: dict) -> str:
+        return json.dumps(message)
+
+    loads = json.loads
+
+
+class JsonCodec:
+    name = JSON_PROTOCOL
+    binary = False
+
+    @staticmethod
+    def encode(message: dict) -> str:
+        return dumps(message)
+
+
+class MsgpackCodec:
+    name = MSGPACK_PROTOCOL
+    binary = True
+
+    @staticmethod
+    def encode(message: dict) -> bytes:
+        payload = msgpack.packb(message)
+        if WS_DEFLATE_MIN_BYTES and len(payload) >= WS_DEFLATE_MIN_BYTES:
+            return bytes((FLAG_DEFLATE,)) + zlib.compress(payload, WS_DEFLATE_LEVEL)
+        return bytes((0,)) + payload
+
+
+JSON = JsonCodec()
+CODECS: Dict[str, object] = {JSON_PROTOCOL: JSON}
+if msgpack is not None:
+    CODECS[MSGPACK_PROTOCOL] = MsgpackCodec()
+
+
+def negotiate(offered: List[str]) -> Tuple[object, Optional[str]]:
+    """Primeiro subprotocolo oferecido pelo cliente que o servidor conhece; senão JSON sem subprotocolo."""
+    for protocol in offered:
+        codec = CODECS.get(protocol.strip())
+        if codec is not None:
+            return codec, protocol.strip()
+    return JSON, None
+
+
+def offered_protocols(websocket: WebSocket) -> List[str]:
+    return list(websocket.scope.get("subprotocols") or [])
+
+
+def decode_binary(data: bytes) -> dict:
+    if msgpack is None:
+        raise ValueError("Frames binários exigem o pacote msgpack")
+    if not data:
+        raise ValueError("Frame binário vazio")
+    if len(data) > WS_MAX_FRAME_BYTES + 1:
+        raise FrameTooLarge(f"Frame binário com {len(data)} bytes")
+    payload = data[1:]
+    if data[0] & FLAG_DEFLATE:
+        # Descomprime no máximo WS_MAX_FRAME_BYTES; se sobrar entrada o frame é recusado
+        inflater = zlib.decompressobj()
+        payload = inflater.decompress(payload, WS_MAX_FRAME_BYTES)
+        if inflater.unconsumed_tail:
+            raise FrameTooLarge(f"Frame descomprimido acima de {WS_MAX_FRAME_BYTES} bytes")
+    return msgpack.unpackb(payload)
+
+
+async def receive(websocket: WebSocket) -> dict:
+    """Próximo frame do cliente já decodificado, em texto JSON ou binário."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    try:
+        if message.get("bytes") is not None:
+            return decode_binary(message["bytes"])
+        if len(message["text"]) > WS_MAX_FRAME_BYTES:
+            raise FrameTooLarge(f"Frame de texto com {len(message['text'])} caracteres")
+    except FrameTooLarge as e:
+        print(f"⚠️ WebSocket: {e}; fechando com {CLOSE_TOO_BIG}")
+        await websocket.close(code=CLOSE_TOO_BIG)
+        raise WebSocketDisconnect(CLOSE_TOO_BIG, str(e))
+    return loads(message["text"])
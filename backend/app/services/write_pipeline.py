@@ -0,0 +1,176 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Parâmetros do group commit (podem ser ajustados por variável de ambiente)
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "256"))
+WRITE_BATCH_DELAY_MS = float(os.getenv("WRITE_BATCH_DELAY_MS", "5"))
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "10000"))
+WRITE_MAX_RETRIES = 3
+
+_STOP = object()
+
+
+class GroupCommitWriter:
+    """
+    Estágio write-behind: junta as escritas de todas as conexões e grava-as
+    em lotes (um único set_many) quando o lote enche ou o prazo expira.
+
+    - submit() devolve um Future que resolve quando o lote foi gravado;
+    - a fila é limitada: se o banco atrasar, submit() espera (backpressure);
+    - stop() grava tudo o que ainda está na fila antes de terminar.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[Dict[str, Any]], Awaitable[Any]],
+        max_batch: int = WRITE_BATCH_SIZE,
+        max_delay: float = WRITE_BATCH_DELAY_MS / 1000,
+        max_pending: int = WRITE_QUEUE_SIZE,
+    ):
+        self._flush = flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # Verdadeiro desde que o primeiro item de um lote sai da fila até o lote ser gravado
+        self._busy = False
+        # Estatísticas simples para diagnóstico
+        self.batches = 0
+        self.items_written = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._batch_ready = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Drena a fila e encerra o estágio."""
+        if not self.running:
+            return
+        await self._queue.put(_STOP)
+        self._batch_ready.set()
+        await self._task
+        self._task = None
+
+    async def submit(self, items: Dict[str, Any]) -> asyncio.Future:
+        """
+        Enfileira as chaves para o próximo lote. Espera apenas se a fila estiver cheia;
+        a durabilidade é sinalizada pelo Future devolvido.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if not self.running:
+            # Sem o estágio (ex.: fora do ciclo de vida da app) grava diretamente
+            try:
+                await self._flush(items)
+                future.set_result(True)
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        await self._queue.put((items, future))
+        if self._queue.qsize() >= self.max_batch:
+            self._batch_ready.set()
+        return future
+
+    def offer(self, items: Dict[str, Any]) -> bool:
+        """
+        Enfileira sem nunca esperar nem reportar durabilidade (fire-and-forget).
+        Devolve False se o estágio não estiver a correr ou a fila estiver cheia.
+        """
+        if not self.running:
+            return False
+        try:
+            self._queue.put_nowait((items, None))
+        except asyncio.QueueFull:
+            return False
+        if self._queue.qsize() >= self.max_batch:
+            self._batch_ready.set()
+        return True
+
+    async def barrier(self):
+        """
+        Espera até que tudo o que já foi submetido esteja gravado.
+        Usado pelas leituras para garantir read-your-writes; retorna logo se não houver nada pendente.
+        """
+        if not self.running or (self._queue.empty() and not self._busy):
+            return
+        await (await self.submit({}))
+
+    async def _run(self):
+        queue = self._queue
+        stopping = False
+        while not stopping:
+            first = await queue.get()
+            if first is _STOP:
+                break
+            self._busy = True
+            # Gatilho por tempo ou por tamanho, o que vier primeiro
+            if queue.qsize() < self.max_batch - 1:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_ready.clear()
+
+            batch: List[Tuple[Dict[str, Any], Optional[asyncio.Future]]] = [first]
+            while len(batch) < self.max_batch and not queue.empty():
+                entry = queue.get_nowait()
+                if entry is _STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+            try:
+                await self._write(batch)
+            finally:
+                self._busy = False
+
+            if stopping:
+                # Drena o que ainda restar na fila antes de sair, nos mesmos lotes de max_batch
+                rest = []
+                while not queue.empty():
+                    entry = queue.get_nowait()
+                    if entry is not _STOP:
+                        rest.append(entry)
+                for i in range(0, len(rest), self.max_batch):
+                    await self._write(rest[i:i + self.max_batch])
+
+    async def _write(self, batch: List[Tuple[Dict[str, Any], Optional[asyncio.Future]]]):
+        merged: Dict[str, Any] = {}
+        for items, _ in batch:
+            merged.update(items)
+
+        error: Optional[Exception] = None
+        for attempt in range(WRITE_MAX_RETRIES):
+            try:
+                if merged:
+                    await self._flush(merged)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                print(f"⚠️ Falha ao gravar lote ({len(batch)} itens, tentativa {attempt + 1}): {e}")
+                await asyncio.sleep(0.05 * 2 ** attempt)
+
+        self.batches += 1
+        if error is None:
+            self.items_written += len(batch)
+        for _, future in batch:
+            if future is None or future.done():
+                continue
+            if error is None:
+                future.set_result(True)
+            else:
+                future.set_exception(error)
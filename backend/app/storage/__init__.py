@@ -0,0 +1,15 @@
+from .base import KVBackend, prefix_end
+from .memory import MemoryBackend
+from .sharded import QuorumError, ShardedBackend
+from .sqlite import SQLiteBackend
+from .supabase import SupabaseBackend
+
+__all__ = [
+    "KVBackend",
+    "MemoryBackend",
+    "QuorumError",
+    "SQLiteBackend",
+    "ShardedBackend",
+    "SupabaseBackend",
+    "prefix_end",
+]
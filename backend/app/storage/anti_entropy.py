@@ -0,0 +1,529 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+from itertools import combinations
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
+
+from .. import chord, metrics
+
+if TYPE_CHECKING:
+    from .sharded import ShardedBackend
+
+# Anti-entropia entre as réplicas do modo particionado.
+#
+# Cada nó tem um resumo das suas chaves em dois níveis. O anel é cortado em segmentos pelos
+# pontos dos nós (cada segmento fica dentro de um único arco e tem um único conjunto de réplicas)
+# e o espaço das chaves em folhas lexicográficas, as mesmas em todas as réplicas. Por célula
+# (segmento, folha) guarda-se só o XOR dos digests (chave, versão) e o número de entradas; por
+# segmento, o XOR e a soma das suas células. Nenhuma chave fica em memória.
+#
+# As escritas confirmadas por uma réplica entram no resumo dela (o XOR acumula o histórico: duas
+# réplicas que receberam as mesmas escritas têm o mesmo resumo). Comparar duas réplicas de um arco
+# é comparar os segmentos e, nos que diferem, as células; cada folha divergente é relida por range
+# scan nas duas réplicas, as versões mais recentes são copiadas (como nas leituras) e as células
+# dessa folha passam a refletir o estado lido. Uma escrita que chega entre o scan e esse reinício
+# faz a folha divergir outra vez e a próxima ronda volta a relê-la.
+#
+# Os resumos são montados no arranque com um scan de cada partição (com I/O limitado), só no
+# worker que tem a lease da anti-entropia; os outros workers não montam nem atualizam resumos.
+ANTI_ENTROPY_INTERVAL = float(os.getenv("ANTI_ENTROPY_INTERVAL", "60"))
+# Teto de I/O da anti-entropia (scans das árvores + cópias), em bytes por segundo (0 = sem limite)
+ANTI_ENTROPY_RATE = int(os.getenv("ANTI_ENTROPY_RATE", str(1024 * 1024)))
+# Máximo de folhas lexicográficas (os limites saem do primeiro scan completo)
+MERKLE_LEAVES = 256
+SCAN_PAGE = 500
+LEASE_KEY = "system:anti_entropy_lease"
+
+REPAIRED_KEYS = metrics.counter(
+    "okupopia_anti_entropy_keys_total", "Chaves copiadas entre réplicas pela anti-entropia."
+).labels()
+TRANSFERRED_BYTES = metrics.counter(
+    "okupopia_anti_entropy_bytes_total", "Bytes copiados entre réplicas pela anti-entropia."
+).labels()
+
+# Intervalo [início, fim) de índices de segmentos
+LeafSpan = Tuple[int, int]
+# (segmento, folha)
+Cell = Tuple[int, int]
+
+
+def _digest(key: str, version: int) -> int:
+    return int.from_bytes(blake2b(f"{key}\0{version}".encode(), digest_size=8).digest(), "big")
+
+
+def _size(envelope: dict) -> int:
+    return len(json.dumps(envelope, separators=(",", ":")))
+
+
+class RateLimiter:
+    """Espaça as operações para não passar de `rate` unidades por segundo, em média."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._free_at = time.monotonic()
+
+    async def consume(self, amount: int):
+        if self.rate <= 0 or amount <= 0:
+            return
+        now = time.monotonic()
+        self._free_at = max(now, self._free_at) + amount / self.rate
+        await asyncio.sleep(self._free_at - now)
+
+
+class MerkleTree:
+    """
+    Resumo das chaves de uma réplica: XOR dos digests e contagem por célula (segmento, folha)
+    e por segmento. A comparação desce só pelos segmentos cujo resumo difere.
+    """
+
+    def __init__(self, segments: int, leaves: int):
+        self.ready = False
+        self.segments = segments
+        self.leaves = leaves
+        self._xors = array("Q", bytes(8 * segments * leaves))
+        self._counts = array("q", bytes(8 * segments * leaves))
+        self._segment_xors = array("Q", bytes(8 * segments))
+        self._segment_counts = array("q", bytes(8 * segments))
+
+    @property
+    def entries(self) -> int:
+        return sum(self._segment_counts)
+
+    def observe(self, segment: int, leaf: int, digest: int, count: int = 1):
+        index = segment * self.leaves + leaf
+        self._xors[index] ^= digest
+        self._counts[index] += count
+        self._segment_xors[segment] ^= digest
+        self._segment_counts[segment] += count
+
+    def reset_leaf(self, leaf: int, cells: Dict[int, Tuple[int, int]]):
+        """Substitui a folha em todos os segmentos pelo estado lido: {segmento: (xor, contagem)}."""
+        for segment in range(self.segments):
+            index = segment * self.leaves + leaf
+            xor, count = cells.get(segment, (0, 0))
+            self._segment_xors[segment] ^= self._xors[index] ^ xor
+            self._segment_counts[segment] += count - self._counts[index]
+            self._xors[index] = xor
+            self._counts[index] = count
+
+    def diff(self, other: "MerkleTree", spans: Iterable[LeafSpan]) -> List[Cell]:
+        """Células dos segmentos dos intervalos onde as duas réplicas divergem."""
+        found: List[Cell] = []
+        for lo, hi in spans:
+            for segment in range(lo, hi):
+                if (self._segment_xors[segment] == other._segment_xors[segment]
+                        and self._segment_counts[segment] == other._segment_counts[segment]):
+                    continue
+                base = segment * self.leaves
+                for leaf in range(self.leaves):
+                    index = base + leaf
+                    if self._xors[index] != other._xors[index] or self._counts[index] != other._counts[index]:
+                        found.append((segment, leaf))
+        return found
+
+
+class AntiEntropy:
+    """Rondas periódicas de comparação entre réplicas e transferência pelos resumos no rebalance."""
+
+    def __init__(self, backend: "ShardedBackend", interval: float = ANTI_ENTROPY_INTERVAL,
+                 rate: float = ANTI_ENTROPY_RATE):
+        self.backend = backend
+        self.interval = interval
+        self.enabled = interval > 0
+        self.limiter = RateLimiter(rate)
+        self.config: Optional[chord.RingConfig] = None
+        self.cuts: List[int] = []
+        # Limites das folhas lexicográficas: folha i = (bounds[i-1], bounds[i]], a última sem fim
+        self.bounds: Optional[List[str]] = None
+        self.trees: Dict[int, MerkleTree] = {}
+        self._worker = uuid.uuid4().hex[:6]
+        self._lock = asyncio.Lock()
+        # Anel ainda não aplicado aos resumos (espera que a ronda em curso termine)
+        self._pending_ring: Optional[chord.ChordRing] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self.state = "idle"
+        self.rounds = 0
+        self.scanned_keys = 0
+        self.repaired_keys = 0
+        self.transferred_bytes = 0
+        self.current: Optional[dict] = None
+        self.last_round: Optional[dict] = None
+
+    # --- Ciclo de vida ---
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                if await self._acquire_lease():
+                    await self.run_once()
+            except Exception as e:
+                print(f"⚠️ Erro na anti-entropia entre réplicas: {e}")
+
+    async def _acquire_lease(self) -> bool:
+        """Só um worker monta os resumos (scan das partições) e faz as rondas."""
+        now = time.time()
+        meta = self.backend.meta
+        lease = await meta.get(LEASE_KEY)
+        if lease and lease.get("owner") != self._worker and lease.get("until", 0) > now:
+            return False
+        await meta.set(LEASE_KEY, {"owner": self._worker, "until": now + 3 * self.interval})
+        # Sem compare-and-set: relê para desistir se outro worker gravou por cima ao mesmo tempo
+        lease = await meta.get(LEASE_KEY)
+        return bool(lease) and lease.get("owner") == self._worker
+
+    def ring_changed(self, ring: chord.ChordRing):
+        """Acrescenta os pontos do anel novo aos cortes dos segmentos e agenda uma ronda."""
+        if not self.enabled or len(ring) == 0:
+            return
+        self._pending_ring = ring
+        if not self._lock.locked():
+            self._apply_ring()
+        if self._wake is not None:
+            self._wake.set()
+
+    def _apply_ring(self):
+        ring, self._pending_ring = self._pending_ring, None
+        if ring is None:
+            return
+        if ring.config != self.config:
+            self.config = ring.config
+            self.cuts = sorted(set(ring.boundaries()))
+        else:
+            cuts = sorted(set(self.cuts) | set(ring.boundaries()))
+            if len(cuts) == len(self.cuts):
+                # Só saíram nós: os segmentos e os resumos continuam válidos
+                return
+            self.cuts = cuts
+        # Segmentos novos repartem chaves espalhadas por todas as folhas: os resumos são
+        # montados de novo no próximo scan (e os limites das folhas recalculados com ele)
+        self.trees = {}
+        self.bounds = None
+
+    def _segment(self, position: int) -> int:
+        # Segmento i = (cuts[i-1], cuts[i]]; depois do último corte dá a volta para o segmento 0
+        index = bisect_left(self.cuts, position)
+        return index if index < len(self.cuts) else 0
+
+    # --- Registo das escritas ---
+
+    def positions(self, keys: List[str]) -> Optional[Tuple[chord.RingConfig, Dict[str, int]]]:
+        # Sem resumos montados (worker sem a lease) as escritas não custam nada aqui
+        if not self.enabled or self.config is None or not self.trees:
+            return None
+        return self.config, dict(zip(keys, self.backend.positions(keys, self.config)))
+
+    def record(self, node_id: int, envelopes: Dict[str, dict], placed: Tuple[chord.RingConfig, Dict[str, int]]):
+        """Uma réplica confirmou estas escritas."""
+        config, positions = placed
+        tree = self.trees.get(node_id)
+        if tree is None or not tree.ready or config is not self.config:
+            return
+        for key, envelope in envelopes.items():
+            tree.observe(self._segment(positions[key]), bisect_left(self.bounds, key), _digest(key, envelope["t"]))
+
+    # --- Montagem dos resumos ---
+
+    async def _build(self, node_id: int) -> bool:
+        """Lê a partição inteira do nó uma vez (com I/O limitado) e marca o resumo como pronto."""
+        tree = self.trees.get(node_id)
+        if tree is not None and tree.ready:
+            return True
+        config, cuts = self.config, self.cuts
+        # O primeiro scan completo também decide os limites das folhas
+        sizing = self.bounds is None
+        bounds: List[str] = [] if sizing else self.bounds
+        chunks: List[Dict[int, List[int]]] = []
+        if not sizing:
+            tree = self.trees[node_id] = MerkleTree(len(cuts), len(bounds) + 1)
+        after = None
+        while True:
+            try:
+                rows = await self.backend._call(node_id, "scan", "", after, None, SCAN_PAGE)
+            except Exception:
+                return False
+            if not rows:
+                break
+            after = rows[-1][0]
+            if config is not self.config or cuts is not self.cuts or (not sizing and self.trees.get(node_id) is not tree):
+                return False
+            positions = self.backend.positions([key for key, _ in rows], config)
+            if sizing:
+                # Cada página é uma folha provisória; acima de 2 * MERKLE_LEAVES juntam-se aos pares
+                cells: Dict[int, List[int]] = {}
+                for (key, envelope), position in zip(rows, positions):
+                    cell = cells.setdefault(self._segment(position), [0, 0])
+                    cell[0] ^= _digest(key, envelope["t"])
+                    cell[1] += 1
+                chunks.append(cells)
+                bounds.append(after)
+                if len(chunks) > 2 * MERKLE_LEAVES:
+                    chunks, bounds = self._coarsen(chunks, bounds)
+            else:
+                for (key, envelope), position in zip(rows, positions):
+                    tree.observe(self._segment(position), bisect_left(bounds, key), _digest(key, envelope["t"]))
+            self.scanned_keys += len(rows)
+            await self.limiter.consume(sum(len(key) + _size(envelope) for key, envelope in rows))
+        if sizing:
+            while len(chunks) > MERKLE_LEAVES:
+                chunks, bounds = self._coarsen(chunks, bounds)
+            if self.bounds is not None:
+                # Outro scan decidiu os limites entretanto: este recomeça com eles
+                return await self._build(node_id)
+            self.bounds = bounds
+            tree = self.trees[node_id] = MerkleTree(len(cuts), len(bounds) + 1)
+            for leaf, cells in enumerate(chunks):
+                for segment, (xor, count) in cells.items():
+                    tree.observe(segment, leaf, xor, count)
+        tree.ready = True
+        print(f"🌳 Resumo de Merkle do nó {node_id} montado ({tree.entries} chaves, {tree.leaves} folhas).")
+        return True
+
+    @staticmethod
+    def _coarsen(chunks: List[Dict[int, List[int]]], bounds: List[str]):
+        """Junta as folhas provisórias aos pares (o limite de cada par é o da segunda)."""
+        merged: List[Dict[int, List[int]]] = []
+        for i in range(0, len(chunks), 2):
+            cells = {segment: list(cell) for segment, cell in chunks[i].items()}
+            for segment, (xor, count) in (chunks[i + 1].items() if i + 1 < len(chunks) else ()):
+                cell = cells.setdefault(segment, [0, 0])
+                cell[0] ^= xor
+                cell[1] += count
+            merged.append(cells)
+        return merged, bounds[1::2] + (bounds[-1:] if len(bounds) % 2 else [])
+
+    # --- Comparação e reparação ---
+
+    def _spans(self, start: int, end: int) -> List[LeafSpan]:
+        """Segmentos do intervalo de posições (start, end]; start == end é o anel inteiro."""
+        first = bisect_left(self.cuts, start) + 1
+        last = bisect_left(self.cuts, end) + 1
+        if first < last:
+            return [(first, last)]
+        return [(first, len(self.cuts)), (0, last)]
+
+    def _arcs(self, ring: chord.ChordRing) -> List[Tuple[List[LeafSpan], List[int]]]:
+        points = sorted(set(ring.boundaries()))
+        return [
+            (self._spans(points[i - 1], end), [n.id for n in ring.owners_at(end, self.backend.replicas)])
+            for i, end in enumerate(points)
+        ]
+
+    async def _scan_leaf(self, node_id: int, leaf: int) -> Dict[str, dict]:
+        """Range scan das chaves de uma folha na partição do nó."""
+        bounds = self.bounds
+        after = bounds[leaf - 1] if leaf > 0 else None
+        last = bounds[leaf] if leaf < len(bounds) else None
+        found: Dict[str, dict] = {}
+        while True:
+            rows = await self.backend._call(node_id, "scan", "", after, None, SCAN_PAGE)
+            inside = [(key, envelope) for key, envelope in rows if last is None or key <= last]
+            found.update(inside)
+            self.scanned_keys += len(inside)
+            await self.limiter.consume(sum(len(key) + _size(envelope) for key, envelope in inside))
+            if len(inside) < SCAN_PAGE:
+                return found
+            after = rows[-1][0]
+
+    async def _repair(self, source: int, target: int, cells: List[Cell], both_ways: bool,
+                      shared: Optional[Set[int]] = None) -> int:
+        """
+        Relê as folhas divergentes nas duas réplicas e copia as versões mais recentes.
+        Só são copiadas chaves dos segmentos `shared` (os que as duas réplicas partilham) ou,
+        sem eles, dos segmentos onde a folha divergiu.
+        """
+        segments_by_leaf: Dict[int, Set[int]] = {}
+        for segment, leaf in cells:
+            segments_by_leaf.setdefault(leaf, set()).add(segment)
+
+        copied = 0
+        config = self.config
+        for leaf, segments in sorted(segments_by_leaf.items()):
+            segments = shared if shared is not None else segments
+            found_a, found_b = await asyncio.gather(self._scan_leaf(source, leaf), self._scan_leaf(target, leaf))
+            keys = list(found_a.keys() | found_b.keys())
+            segment_of = dict(zip(keys, map(self._segment, self.backend.positions(keys, config))))
+
+            for sender, receiver, have, missing in ((source, target, found_a, found_b), (target, source, found_b, found_a)):
+                if sender == target and not both_ways:
+                    continue
+                # Só as chaves dos arcos que as duas réplicas partilham
+                newer = {
+                    key: envelope for key, envelope in have.items()
+                    if segment_of[key] in segments and (key not in missing or envelope["t"] > missing[key]["t"])
+                }
+                if not newer:
+                    continue
+                size = sum(len(key) + _size(envelope) for key, envelope in newer.items())
+                await self.limiter.consume(size)
+                await self.backend._call(receiver, "set_many", newer)
+                missing.update(newer)
+                copied += len(newer)
+                self.transferred_bytes += size
+                TRANSFERRED_BYTES.inc(size)
+                if self.current is not None:
+                    self.current["bytesTransferred"] += size
+
+            # A folha passa a refletir o que as réplicas têm de facto, em todos os segmentos
+            if config is not self.config:
+                continue
+            for node_id, rows in ((source, found_a), (target, found_b)):
+                tree = self.trees.get(node_id)
+                if tree is None or not tree.ready:
+                    continue
+                state: Dict[int, Tuple[int, int]] = {}
+                for key, envelope in rows.items():
+                    xor, count = state.get(segment_of[key], (0, 0))
+                    state[segment_of[key]] = (xor ^ _digest(key, envelope["t"]), count + 1)
+                tree.reset_leaf(leaf, state)
+        self.repaired_keys += copied
+        REPAIRED_KEYS.inc(copied)
+        return copied
+
+    async def run_once(self) -> int:
+        """Uma ronda: compara as réplicas de cada arco do anel e repara as folhas divergentes."""
+        ring = self.backend.ring
+        if not self.enabled or len(ring) < 2:
+            return 0
+        async with self._lock:
+            self._apply_ring()
+            self.state = "building"
+            for node in ring.nodes:
+                await self._build(node.id)
+
+            self.state = "comparing"
+            arcs = self._arcs(ring)
+            self.current = {
+                "startedAt": time.time(),
+                "rangesTotal": len(arcs),
+                "rangesDone": 0,
+                "rangesDiverged": 0,
+                "keysRepaired": 0,
+                "bytesTransferred": 0,
+            }
+            try:
+                # Junta as células divergentes por par de réplicas: cada folha é relida uma vez por par
+                # e reparada em todos os segmentos que as duas partilham
+                pairs: Dict[Tuple[int, int], List[Cell]] = {}
+                shared: Dict[Tuple[int, int], Set[int]] = {}
+                for spans, owners in arcs:
+                    diverged = False
+                    for a, b in combinations(owners, 2):
+                        shared.setdefault((a, b), set()).update(
+                            segment for lo, hi in spans for segment in range(lo, hi)
+                        )
+                        tree_a, tree_b = self.trees.get(a), self.trees.get(b)
+                        if not (tree_a and tree_b and tree_a.ready and tree_b.ready):
+                            continue
+                        cells = tree_a.diff(tree_b, spans)
+                        if cells:
+                            diverged = True
+                            pairs.setdefault((a, b), []).extend(cells)
+                    self.current["rangesDone"] += 1
+                    self.current["rangesDiverged"] += diverged
+                    await asyncio.sleep(0)
+                for (a, b), cells in pairs.items():
+                    try:
+                        self.current["keysRepaired"] += await self._repair(
+                            a, b, cells, both_ways=True, shared=shared[(a, b)]
+                        )
+                    except Exception:
+                        # Réplica indisponível: fica para a próxima ronda
+                        continue
+            finally:
+                self.current["finishedAt"] = time.time()
+                self.last_round, self.current = self.current, None
+                self.rounds += 1
+                self.state = "idle"
+        if self.last_round["keysRepaired"]:
+            print(
+                f"🌳 Anti-entropia: {self.last_round['keysRepaired']} chaves reparadas em "
+                f"{self.last_round['rangesDiverged']} intervalos ({self.last_round['bytesTransferred'] / 1024:.0f} KiB)"
+            )
+        return self.last_round["keysRepaired"]
+
+    async def hand_off(self, old: chord.ChordRing, new: chord.ChordRing, moved: List[chord.KeyRange]) -> Optional[int]:
+        """
+        Rebalance pelos resumos: cada novo responsável é comparado com uma réplica antiga do mesmo
+        intervalo e só recebe as folhas divergentes. None se os resumos não servem (outra
+        configuração, segmentos novos ou worker sem resumos montados), e o rebalance volta ao scan completo.
+        """
+        if not self.enabled or self.config is None or old.config != self.config or new.config != self.config:
+            return None
+        async with self._lock:
+            self._apply_ring()
+            self.state = "rebalancing"
+            try:
+                pairs: Dict[Tuple[int, int], List[int]] = {}
+                for start, end in moved:
+                    for lo, hi in self._spans(start, end):
+                        for segment in range(lo, hi):
+                            before = [n.id for n in old.owners_at(self.cuts[segment], self.backend.replicas)]
+                            after = [n.id for n in new.owners_at(self.cuts[segment], self.backend.replicas)]
+                            targets = [n for n in after if n not in before]
+                            if not targets:
+                                continue
+                            sources = self.backend._read_order(tuple(before))
+                            for node_id in sources[:1] + targets:
+                                tree = self.trees.get(node_id)
+                                if tree is None or not tree.ready:
+                                    return None
+                            for target in targets:
+                                pairs.setdefault((sources[0], target), []).append(segment)
+
+                copied = 0
+                for (source, target), segments in pairs.items():
+                    spans = [(segment, segment + 1) for segment in segments]
+                    divergent = self.trees[source].diff(self.trees[target], spans)
+                    if divergent:
+                        try:
+                            copied += await self._repair(source, target, divergent, both_ways=False)
+                        except Exception:
+                            continue
+                return copied
+            finally:
+                self.state = "idle"
+
+    def status(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "state": self.state,
+            "intervalSeconds": self.interval,
+            "rateLimitBytesPerSecond": self.limiter.rate,
+            "trees": {
+                str(node_id): {"ready": tree.ready, "keys": tree.entries}
+                for node_id, tree in sorted(self.trees.items())
+            },
+            "segments": len(self.cuts),
+            "leaves": len(self.bounds) + 1 if self.bounds is not None else 0,
+            "rounds": self.rounds,
+            "scannedKeys": self.scanned_keys,
+            "repairedKeys": self.repaired_keys,
+            "bytesTransferred": self.transferred_bytes,
+            "currentRound": dict(self.current) if self.current else None,
+            "lastRound": self.last_round,
+        }
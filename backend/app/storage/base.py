@@ -0,0 +1,87 @@
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+def prefix_end(prefix: str) -> Optional[str]:
+    """Menor string maior que todas as chaves com o prefixo (limite exclusivo de um range scan)."""
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class KVBackend(ABC):
+    """
+    Interface comum dos motores de armazenamento chave-valor.
+    Os valores são sempre JSON; as chaves são ordenadas byte a byte,
+    o que permite range scans sobre prefixos (ex.: ids que começam pelo timestamp).
+    """
+
+    name = "base"
+
+    async def connect(self):
+        """Abre conexões/recursos. Chamado no startup; as operações também o fazem sob demanda."""
+
+    async def close(self):
+        """Libera conexões/recursos no shutdown."""
+
+    def set_ring(self, ring, handoff: bool = True):
+        """Motores particionados recebem o anel Chord atual; os restantes ignoram."""
+
+    async def rebalance(self, old, new) -> int:
+        """Copia as chaves dos intervalos que mudaram de dono (só motores particionados)."""
+        return 0
+
+    def replication_status(self) -> Optional[dict]:
+        """Progresso da reparação entre réplicas (só motores particionados)."""
+        return None
+
+    @abstractmethod
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Busca várias chaves de uma vez. Chaves ausentes não aparecem no resultado."""
+
+    @abstractmethod
+    async def set_many(self, items: Dict[str, Any]):
+        """Grava várias chaves numa única operação."""
+
+    @abstractmethod
+    async def delete_many(self, keys: Iterable[str]):
+        """Remove várias chaves numa única operação."""
+
+    @abstractmethod
+    async def scan(
+        self,
+        prefix: str = "",
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        limit: Optional[int] = None,
+        reverse: bool = False,
+    ) -> List[Tuple[str, Any]]:
+        """
+        Range scan ordenado pela chave: pares (chave, valor) com o prefixo,
+        estritamente entre `after` e `before` (ambos opcionais e exclusivos).
+        Com `reverse=True` a ordem é decrescente e o `limit` vale a partir do fim.
+        """
+
+    async def get(self, key: str) -> Optional[Any]:
+        return (await self.get_many([key])).get(key)
+
+    async def set(self, key: str, value: Any):
+        await self.set_many({key: value})
+
+    async def delete(self, key: str):
+        await self.delete_many([key])
+
+    async def get_by_prefix(self, prefix: str) -> List[Any]:
+        return [value for _, value in await self.scan(prefix)]
+
+    async def delete_unchanged(self, expected: Dict[str, Any]) -> List[str]:
+        """
+        Remove as chaves cujo valor ainda é o esperado; devolve as que foram removidas.
+        Por omissão é ler e depois apagar (melhor esforço): motores com escrita condicional
+        fazem as duas coisas atomicamente.
+        """
+        found = await self.get_many(expected)
+        keys = [k for k, v in expected.items() if k in found and found[k] == v]
+        if keys:
+            await self.delete_many(keys)
+        return keys
@@ -0,0 +1,68 @@
+import json
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .base import KVBackend, prefix_end
+
+
+class MemoryBackend(KVBackend):
+    """
+    Motor puramente em memória (testes, benchmarks, demonstrações sem banco).
+    Guarda os valores serializados em JSON para ter a mesma semântica dos motores
+    persistentes: cada leitura devolve uma cópia nova e valores não-JSON falham na escrita.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._data: Dict[str, str] = {}
+        # Índice ordenado das chaves para os range scans
+        self._keys: List[str] = []
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        data = self._data
+        return {k: json.loads(data[k]) for k in keys if k in data}
+
+    async def set_many(self, items: Dict[str, Any]):
+        encoded = {k: json.dumps(v) for k, v in items.items()}
+        for key in encoded:
+            if key not in self._data:
+                insort(self._keys, key)
+        self._data.update(encoded)
+
+    async def delete_many(self, keys: Iterable[str]):
+        for key in set(keys):
+            if self._data.pop(key, None) is not None:
+                del self._keys[bisect_left(self._keys, key)]
+
+    async def delete_unchanged(self, expected: Dict[str, Any]) -> List[str]:
+        # Sem await no meio: leitura e remoção são atómicas neste processo
+        data = self._data
+        keys = [k for k, v in expected.items() if k in data and json.loads(data[k]) == v]
+        await self.delete_many(keys)
+        return keys
+
+    async def scan(
+        self,
+        prefix: str = "",
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        limit: Optional[int] = None,
+        reverse: bool = False,
+    ) -> List[Tuple[str, Any]]:
+        keys = self._keys
+        lo = bisect_left(keys, prefix)
+        if after is not None and after >= prefix:
+            lo = max(lo, bisect_right(keys, after))
+        end = prefix_end(prefix)
+        hi = len(keys) if end is None else bisect_left(keys, end)
+        if before is not None:
+            hi = min(hi, bisect_left(keys, before))
+        if lo >= hi:
+            return []
+        selected = keys[lo:hi]
+        if reverse:
+            selected.reverse()
+        if limit is not None:
+            selected = selected[:limit]
+        return [(k, json.loads(self._data[k])) for k in selected]
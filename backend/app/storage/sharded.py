@@ -0,0 +1,414 @@
+import asyncio
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from .. import chord, metrics
+from .anti_entropy import AntiEntropy
+from .base import KVBackend
+
+# Chaves guardadas fora do anel: a própria configuração do anel tem de ser legível antes dele existir
+META_PREFIX = "system:"
+# Índices de um usuário ficam nas réplicas de user:{usuário}, para que os range scans
+# da caixa de entrada e das conversas sejam servidos por um único nó
+USER_SCOPED_PREFIXES = ("inbox:", "conversation:", "read:", "archive:", "search:", "pending:")
+
+SHARD_TIMEOUT = 5.0
+# Depois de uma falha o nó deixa de ser preferido nas leituras durante este tempo
+SHARD_RETRY_AFTER = 5.0
+SCAN_PAGE = 500
+
+_LOOKUP_TIME = metrics.CHORD_LOOKUP.labels("storage")
+
+
+class QuorumError(Exception):
+    """Menos réplicas do que o quórum confirmaram a escrita."""
+
+
+def route_key(key: str) -> str:
+    """Chave cuja posição no anel decide os nós responsáveis por `key`."""
+    for scoped in USER_SCOPED_PREFIXES:
+        if key.startswith(scoped):
+            user = key[len(scoped):].split(":", 1)[0]
+            return f"user:{user}"
+    return key
+
+
+def route_prefix(prefix: str) -> Optional[str]:
+    """Rota de um scan por prefixo, se todas as chaves do prefixo caem nas mesmas réplicas."""
+    for scoped in USER_SCOPED_PREFIXES:
+        if prefix.startswith(scoped) and ":" in prefix[len(scoped):]:
+            return route_key(prefix)
+    return None
+
+
+def _is_tombstone(envelope: dict) -> bool:
+    return envelope.get("d", False)
+
+
+def _newest(a: Optional[dict], b: Optional[dict]) -> Optional[dict]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return b if b["t"] > a["t"] else a
+
+
+class ShardedBackend(KVBackend):
+    """
+    Armazenamento particionado pelo anel Chord: cada nó é dono de uma partição própria
+    (um ficheiro SQLite por nó, por exemplo) e cada chave vive no primário e nos seus
+    sucessores (`replicas` nós físicos distintos).
+
+    - Escritas vão para todas as réplicas em paralelo e terminam quando `write_quorum`
+      confirmaram, incluindo o primário se estiver saudável (para a leitura no nó mais
+      próximo ver a escrita). As restantes continuam em segundo plano.
+    - Leituras vêm da réplica viva mais próxima (a primeira no sentido do anel que não
+      falhou recentemente); com `read_quorum` > 1 são consultadas várias e vence a mais recente.
+    - Cada valor é gravado num envelope {"t": versão, "v": valor}; remoções deixam uma
+      lápide {"t": versão, "d": true}, para que réplicas divergentes se resolvam pela versão.
+
+    Desativar um nó tira-o do anel: as suas chaves passam para os sucessores, que já
+    tinham cópias, e rebalance() copia para os novos responsáveis apenas os intervalos movidos.
+    Réplicas que perderam escritas são reparadas pela anti-entropia (árvores de Merkle por
+    intervalo do anel, ver anti_entropy.py), que também faz as cópias do rebalance.
+    """
+
+    name = "sharded"
+
+    def __init__(
+        self,
+        meta: KVBackend,
+        shard_factory: Callable[[int], KVBackend],
+        replicas: int = 3,
+        write_quorum: int = 2,
+        read_quorum: int = 1,
+    ):
+        self.meta = meta
+        self.shard_factory = shard_factory
+        self.replicas = replicas
+        self.write_quorum = write_quorum
+        self.read_quorum = read_quorum
+        self.ring = chord.ChordRing([])
+        self._shards: Dict[int, KVBackend] = {}
+        self._down_until: Dict[int, float] = {}
+        # Durante a transferência de um rebalance as leituras consultam todas as réplicas
+        self.handoff = False
+        self._last_version = 0
+        self._background: Set[asyncio.Task] = set()
+        self.anti_entropy = AntiEntropy(self)
+
+    # --- Anel e partições ---
+
+    def set_ring(self, ring: chord.ChordRing, handoff: bool = True):
+        previous, self.ring = self.ring, ring
+        self.handoff = handoff and len(previous) > 0
+        self.anti_entropy.ring_changed(ring)
+
+    def replication_status(self) -> Optional[dict]:
+        return self.anti_entropy.status()
+
+    def positions(self, keys: List[str], config: chord.RingConfig) -> List[int]:
+        """Posições no anel das chaves de roteamento de `keys`."""
+        routed = [route_key(key) for key in keys]
+        if len(routed) < chord.VECTOR_MIN_BATCH:
+            # Poucas chaves (escritas do chat): as posições já estão no cache do _owners
+            return [config.position(key) for key in routed]
+        return config.positions(routed)
+
+    def _shard(self, node_id: int) -> KVBackend:
+        shard = self._shards.get(node_id)
+        if shard is None:
+            shard = self._shards[node_id] = self.shard_factory(node_id)
+        return shard
+
+    def _owners(self, key: str) -> Tuple[int, ...]:
+        start = time.perf_counter()
+        owners = self.ring.get_replica_nodes(route_key(key), self.replicas)
+        _LOOKUP_TIME.observe(time.perf_counter() - start)
+        if not owners:
+            raise QuorumError("Nenhum nó ativo no anel")
+        return tuple(n.id for n in owners)
+
+    def _healthy(self, node_id: int) -> bool:
+        return self._down_until.get(node_id, 0) <= time.monotonic()
+
+    def _mark_down(self, node_id: int, error: Exception):
+        if self._healthy(node_id):
+            print(f"⚠️ Partição do nó {node_id} falhou: {error}")
+        self._down_until[node_id] = time.monotonic() + SHARD_RETRY_AFTER
+
+    def _read_order(self, owners: Tuple[int, ...]) -> List[int]:
+        """Réplicas pela ordem de preferência: as saudáveis primeiro, no sentido do anel."""
+        return sorted(owners, key=lambda node_id: not self._healthy(node_id))
+
+    async def _call(self, node_id: int, op: str, *args):
+        try:
+            return await asyncio.wait_for(getattr(self._shard(node_id), op)(*args), SHARD_TIMEOUT)
+        except Exception as e:
+            self._mark_down(node_id, e)
+            raise
+
+    def _next_version(self) -> int:
+        version = max(time.time_ns(), self._last_version + 1)
+        self._last_version = version
+        return version
+
+    async def connect(self):
+        await self.meta.connect()
+        self.anti_entropy.start()
+
+    async def close(self):
+        await self.anti_entropy.stop()
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+        await self.meta.close()
+        for shard in self._shards.values():
+            await shard.close()
+
+    # --- Escrita replicada ---
+
+    async def _replicate(self, envelopes: Dict[str, dict]):
+        groups: Dict[Tuple[int, ...], Dict[str, dict]] = {}
+        for key, envelope in envelopes.items():
+            groups.setdefault(self._owners(key), {})[key] = envelope
+        per_node: Dict[int, Dict[str, dict]] = {}
+        for owners, items in groups.items():
+            for node_id in owners:
+                per_node.setdefault(node_id, {}).update(items)
+
+        acked: Set[int] = set()
+        failed: Set[int] = set()
+
+        def satisfied(owners: Tuple[int, ...]) -> bool:
+            ok = sum(1 for n in owners if n in acked)
+            primary_done = owners[0] in acked or owners[0] in failed
+            return ok >= min(self.write_quorum, len(owners)) and primary_done
+
+        tasks = {
+            asyncio.ensure_future(self._call(node_id, "set_many", items)): node_id
+            for node_id, items in per_node.items()
+        }
+        pending = set(tasks)
+        while pending and not all(satisfied(o) for o in groups):
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                (failed if task.exception() else acked).add(tasks[task])
+
+        # As árvores de Merkle só registam o que cada réplica confirmou
+        placed = self.anti_entropy.positions(list(envelopes))
+        if placed is not None:
+            for node_id in acked:
+                self.anti_entropy.record(node_id, per_node[node_id], placed)
+
+        # Réplicas lentas terminam em segundo plano; se falharem o nó fica marcado como suspeito
+        # e a escrita falta na árvore de Merkle dele, por isso a anti-entropia a repõe depois
+        for task in pending:
+            self._background.add(task)
+            task.add_done_callback(self._on_background_done)
+            if placed is not None:
+                node_id = tasks[task]
+                task.add_done_callback(
+                    lambda task, node_id=node_id: self._on_stored(task, node_id, per_node[node_id], placed)
+                )
+
+        missing = [o for o in groups if not satisfied(o)]
+        if missing:
+            raise QuorumError(
+                f"Quórum de escrita não atingido ({self.write_quorum}) para as réplicas {list(missing[0])}"
+            )
+
+    def _on_background_done(self, task: asyncio.Task):
+        self._background.discard(task)
+        if not task.cancelled():
+            task.exception()
+
+    def _on_stored(self, task: asyncio.Task, node_id: int, items: Dict[str, dict], placed):
+        if not task.cancelled() and task.exception() is None:
+            self.anti_entropy.record(node_id, items, placed)
+
+    async def set_many(self, items: Dict[str, Any]):
+        meta = {k: v for k, v in items.items() if k.startswith(META_PREFIX)}
+        if meta:
+            await self.meta.set_many(meta)
+        version = self._next_version()
+        envelopes = {k: {"t": version, "v": v} for k, v in items.items() if k not in meta}
+        if envelopes:
+            await self._replicate(envelopes)
+
+    async def delete_many(self, keys: Iterable[str]):
+        keys = list(dict.fromkeys(keys))
+        meta = [k for k in keys if k.startswith(META_PREFIX)]
+        if meta:
+            await self.meta.delete_many(meta)
+        version = self._next_version()
+        tombstones = {k: {"t": version, "d": True} for k in keys if not k.startswith(META_PREFIX)}
+        if tombstones:
+            await self._replicate(tombstones)
+
+    # --- Leituras ---
+
+    def _fanout(self) -> int:
+        return self.replicas if self.handoff else self.read_quorum
+
+    async def _read_envelopes(self, owners: Tuple[int, ...], keys: List[str]) -> Dict[str, dict]:
+        """Lê das `_fanout()` réplicas mais próximas; se uma falhar, passa à seguinte."""
+        candidates = self._read_order(owners)
+        wanted = min(self._fanout(), len(candidates))
+        merged: Dict[str, dict] = {}
+        answered = 0
+        while candidates and answered < wanted:
+            batch, candidates = candidates[:wanted - answered], candidates[wanted - answered:]
+            results = await asyncio.gather(
+                *(self._call(node_id, "get_many", keys) for node_id in batch), return_exceptions=True
+            )
+            for found in results:
+                if isinstance(found, Exception):
+                    continue
+                answered += 1
+                for key, envelope in found.items():
+                    merged[key] = _newest(merged.get(key), envelope)
+        if not answered:
+            raise QuorumError(f"Nenhuma réplica respondeu ({list(owners)})")
+        return merged
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(dict.fromkeys(keys))
+        meta = [k for k in keys if k.startswith(META_PREFIX)]
+        result = await self.meta.get_many(meta) if meta else {}
+
+        groups: Dict[Tuple[int, ...], List[str]] = {}
+        for key in keys:
+            if not key.startswith(META_PREFIX):
+                groups.setdefault(self._owners(key), []).append(key)
+        found = await asyncio.gather(*(self._read_envelopes(o, ks) for o, ks in groups.items()))
+        for envelopes in found:
+            for key, envelope in envelopes.items():
+                if not _is_tombstone(envelope):
+                    result[key] = envelope["v"]
+        return result
+
+    def _scan_nodes(self, prefix: str) -> List[int]:
+        routed = route_prefix(prefix)
+        if routed is None:
+            # Chaves espalhadas pelo anel: consulta uma vez cada nó ativo
+            return [n.id for n in self.ring.nodes]
+        candidates = self._read_order(self._owners(routed))
+        return candidates[:max(1, min(self._fanout(), len(candidates)))]
+
+    async def scan(
+        self,
+        prefix: str = "",
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        limit: Optional[int] = None,
+        reverse: bool = False,
+    ) -> List[Tuple[str, Any]]:
+        if prefix.startswith(META_PREFIX):
+            return await self.meta.scan(prefix, after, before, limit, reverse)
+        rows = await self._scan_ring(prefix, after, before, limit, reverse)
+        if META_PREFIX.startswith(prefix):
+            # O intervalo também cobre as chaves system:*, que vivem fora do anel
+            meta = await self.meta.scan(prefix, after, before, limit, reverse)
+            rows = sorted(rows + meta, key=lambda row: row[0], reverse=reverse)[:limit]
+        return rows
+
+    async def _scan_ring(self, prefix, after, before, limit, reverse) -> List[Tuple[str, Any]]:
+        nodes = self._scan_nodes(prefix)
+        if not nodes:
+            raise QuorumError("Nenhum nó ativo no anel")
+
+        result: List[Tuple[str, Any]] = []
+        while True:
+            page = SCAN_PAGE if limit is None else max(limit - len(result), 1)
+            pages = await asyncio.gather(
+                *(self._call(n, "scan", prefix, after, before, page, reverse) for n in nodes)
+            )
+            merged: Dict[str, dict] = {}
+            # Só as chaves até à última de cada página cheia estão completas em todas as réplicas
+            boundary: Optional[str] = None
+            for rows in pages:
+                for key, envelope in rows:
+                    merged[key] = _newest(merged.get(key), envelope)
+                if len(rows) == page:
+                    last = rows[-1][0]
+                    if boundary is None or (last > boundary if reverse else last < boundary):
+                        boundary = last
+
+            for key in sorted(merged, reverse=reverse):
+                if boundary is not None and (key < boundary if reverse else key > boundary):
+                    break
+                envelope = merged[key]
+                if not _is_tombstone(envelope):
+                    result.append((key, envelope["v"]))
+                    if limit is not None and len(result) >= limit:
+                        return result
+            if boundary is None:
+                return result
+            if reverse:
+                before = boundary
+            else:
+                after = boundary
+
+    # --- Rebalanceamento ---
+
+    async def rebalance(self, old: chord.ChordRing, new: chord.ChordRing) -> int:
+        """
+        Copia para os novos responsáveis as chaves dos intervalos que mudaram de dono.
+        Só as versões mais recentes do que as do destino são gravadas. Devolve o número de chaves copiadas.
+        Com as árvores de Merkle disponíveis só as folhas divergentes são lidas; senão as partições
+        antigas são varridas por inteiro.
+        """
+        try:
+            moved = chord.changed_ranges(old, new, self.replicas)
+        except ValueError:
+            # Configuração do anel diferente: todas as posições podem ter mudado
+            moved = [(0, 0)]
+        copied = 0
+        if moved and len(old) > 0:
+            copied = await self.anti_entropy.hand_off(old, new, moved)
+        if copied is None:
+            # Sem árvores utilizáveis: varre as partições antigas por inteiro
+            copied = 0
+            for source in old.nodes:
+                after = None
+                while True:
+                    try:
+                        rows = await self._call(source.id, "scan", "", after, None, SCAN_PAGE)
+                    except Exception:
+                        break
+                    if not rows:
+                        break
+                    after = rows[-1][0]
+                    copied += await self._hand_off(old, new, moved, rows)
+        if self.ring is new:
+            self.handoff = False
+        return copied
+
+    async def _hand_off(self, old, new, moved, rows) -> int:
+        targets: Dict[int, Dict[str, dict]] = {}
+        routed = [route_key(key) for key, _ in rows]
+        positions = new.config.positions(routed)
+        old_owners = old.place_many(routed, self.replicas)
+        new_owners = new.place_positions(positions, self.replicas)
+        for (key, envelope), position, before, after in zip(rows, positions, old_owners, new_owners):
+            if not any(chord.in_range(position, start, end) for start, end in moved):
+                continue
+            previous = {n.id for n in before}
+            for node in after:
+                if node.id not in previous:
+                    targets.setdefault(node.id, {})[key] = envelope
+
+        copied = 0
+        for node_id, items in targets.items():
+            try:
+                current = await self._call(node_id, "get_many", list(items))
+                newer = {k: e for k, e in items.items() if k not in current or e["t"] > current[k]["t"]}
+                if newer:
+                    await self._call(node_id, "set_many", newer)
+                    placed = self.anti_entropy.positions(list(newer))
+                    if placed is not None:
+                        self.anti_entropy.record(node_id, newer, placed)
+                    copied += len(newer)
+            except Exception:
+                continue
+        return copied
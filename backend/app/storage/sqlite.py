@@ -0,0 +1,151 @@
+import asyncio
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .base import KVBackend, prefix_end
+
+# Limite conservador de parâmetros por instrução (SQLITE_MAX_VARIABLE_NUMBER antigo = 999)
+SQLITE_PARAM_CHUNK = 500
+
+
+class SQLiteBackend(KVBackend):
+    """
+    Motor embutido em SQLite (modo WAL). A tabela é WITHOUT ROWID com a chave como
+    PRIMARY KEY, ou seja, a própria B-tree é o índice ordenado usado nos range scans.
+    Todas as chamadas correm numa única thread dedicada, que é dona da conexão.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str = "okupopia.db"):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kv-sqlite")
+
+    def _open(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID"
+            )
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def connect(self):
+        await self._run(self._open)
+
+    async def close(self):
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        await self._run(_close)
+
+    # --- Implementações síncronas (executadas na thread do SQLite) ---
+
+    def _get_many(self, keys: List[str]) -> Dict[str, Any]:
+        conn = self._open()
+        result = {}
+        for i in range(0, len(keys), SQLITE_PARAM_CHUNK):
+            chunk = keys[i:i + SQLITE_PARAM_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(f"SELECT key, value FROM kv WHERE key IN ({placeholders})", chunk)
+            result.update((k, json.loads(v)) for k, v in rows)
+        return result
+
+    def _set_many(self, rows: List[Tuple[str, str]]):
+        conn = self._open()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO kv (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                rows,
+            )
+
+    def _delete_many(self, keys: List[str]):
+        conn = self._open()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("DELETE FROM kv WHERE key = ?", [(k,) for k in keys])
+
+    def _delete_unchanged(self, expected: Dict[str, Any]) -> List[str]:
+        conn = self._open()
+        keys = list(expected)
+        with conn:
+            # IMMEDIATE: nenhum outro processo escreve entre a comparação e a remoção
+            conn.execute("BEGIN IMMEDIATE")
+            deleted = []
+            for i in range(0, len(keys), SQLITE_PARAM_CHUNK):
+                chunk = keys[i:i + SQLITE_PARAM_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(f"SELECT key, value FROM kv WHERE key IN ({placeholders})", chunk)
+                deleted.extend(k for k, v in rows if json.loads(v) == expected[k])
+            conn.executemany("DELETE FROM kv WHERE key = ?", [(k,) for k in deleted])
+        return deleted
+
+    def _scan(self, prefix, after, before, limit, reverse) -> List[Tuple[str, Any]]:
+        conditions, params = [], []
+        if prefix:
+            conditions.append("key >= ?")
+            params.append(prefix)
+            conditions.append("key < ?")
+            params.append(prefix_end(prefix))
+        if after is not None:
+            conditions.append("key > ?")
+            params.append(after)
+        if before is not None:
+            conditions.append("key < ?")
+            params.append(before)
+        sql = "SELECT key, value FROM kv"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY key DESC" if reverse else " ORDER BY key"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        rows = self._open().execute(sql, params)
+        return [(k, json.loads(v)) for k, v in rows]
+
+    # --- Interface assíncrona ---
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        return await self._run(self._get_many, keys)
+
+    async def set_many(self, items: Dict[str, Any]):
+        if not items:
+            return
+        rows = [(k, json.dumps(v)) for k, v in items.items()]
+        await self._run(self._set_many, rows)
+
+    async def delete_many(self, keys: Iterable[str]):
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return
+        await self._run(self._delete_many, keys)
+
+    async def delete_unchanged(self, expected: Dict[str, Any]) -> List[str]:
+        if not expected:
+            return []
+        return await self._run(self._delete_unchanged, dict(expected))
+
+    async def scan(
+        self,
+        prefix: str = "",
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        limit: Optional[int] = None,
+        reverse: bool = False,
+    ) -> List[Tuple[str, Any]]:
+        return await self._run(self._scan, prefix, after, before, limit, reverse)
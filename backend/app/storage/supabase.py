@@ -0,0 +1,118 @@
+import asyncio
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .base import KVBackend
+
+TABLE_NAME = "kv_store_aef9e41b"
+
+# O PostgREST recebe o filtro "in" na URL; lotes grandes são divididos para não estourar o limite
+IN_FILTER_CHUNK = 200
+UPSERT_CHUNK = 500
+# O PostgREST corta cada resposta em db-max-rows (1000 no Supabase): scans maiores são paginados
+SCAN_PAGE = int(os.getenv("SUPABASE_MAX_ROWS", "1000"))
+
+
+class SupabaseBackend(KVBackend):
+    """
+    Motor remoto sobre a tabela KV do Supabase (PostgREST).
+    Os range scans dependem da ordenação da coluna `key`: para ter a mesma ordem
+    byte a byte dos motores locais, a coluna deve usar a collation "C"
+    (migração em supabase/migrations/20261017000000_kv_store_key_collate_c.sql).
+    O prefixo é filtrado com LIKE, que não depende da collation.
+    """
+
+    name = "supabase"
+
+    def __init__(self, url: str, key: str, table: str = TABLE_NAME):
+        self.url = url
+        self.key = key
+        self.table_name = table
+        self._client = None
+        self._lock = asyncio.Lock()
+
+    async def connect(self):
+        if self._client is None:
+            # Import tardio: os motores locais não precisam do SDK do Supabase
+            from supabase._async.client import create_client as create_async_client
+            async with self._lock:
+                if self._client is None:
+                    self._client = await create_async_client(self.url, self.key)
+        return self._client
+
+    async def _table(self):
+        client = self._client or await self.connect()
+        return client.table(self.table_name)
+
+    async def get(self, key: str) -> Optional[Any]:
+        table = await self._table()
+        response = await table.select("value").eq("key", key).maybe_single().execute()
+        if response and hasattr(response, 'data') and response.data:
+            return response.data.get("value")
+        return None
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        table = await self._table()
+        chunks = [keys[i:i + IN_FILTER_CHUNK] for i in range(0, len(keys), IN_FILTER_CHUNK)]
+        responses = await asyncio.gather(*(
+            table.select("key, value").in_("key", chunk).execute()
+            for chunk in chunks
+        ))
+        return {d["key"]: d["value"] for r in responses if r.data for d in r.data}
+
+    async def set_many(self, items: Dict[str, Any]):
+        if not items:
+            return
+        table = await self._table()
+        rows = [{"key": k, "value": v} for k, v in items.items()]
+        # Lotes pequenos vão num único upsert (atômico no Postgres); cargas grandes são fatiadas
+        for i in range(0, len(rows), UPSERT_CHUNK):
+            await table.upsert(rows[i:i + UPSERT_CHUNK]).execute()
+
+    async def delete_many(self, keys: Iterable[str]):
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return
+        table = await self._table()
+        await asyncio.gather(*(
+            table.delete().in_("key", keys[i:i + IN_FILTER_CHUNK]).execute()
+            for i in range(0, len(keys), IN_FILTER_CHUNK)
+        ))
+
+    async def scan(
+        self,
+        prefix: str = "",
+        after: Optional[str] = None,
+        before: Optional[str] = None,
+        limit: Optional[int] = None,
+        reverse: bool = False,
+    ) -> List[Tuple[str, Any]]:
+        table = await self._table()
+        rows: List[Tuple[str, Any]] = []
+        while True:
+            page = SCAN_PAGE if limit is None else min(limit - len(rows), SCAN_PAGE)
+            query = table.select("key, value")
+            if prefix:
+                query = query.like("key", f"{_escape_like(prefix)}%")
+            if after is not None:
+                query = query.gt("key", after)
+            if before is not None:
+                query = query.lt("key", before)
+            response = await query.order("key", desc=reverse).limit(page).execute()
+            data = response.data or []
+            rows.extend((d["key"], d["value"]) for d in data)
+            if len(data) < page or (limit is not None and len(rows) >= limit):
+                return rows
+            # Próxima página a partir da última chave recebida (keyset)
+            if reverse:
+                before = data[-1]["key"]
+            else:
+                after = data[-1]["key"]
+
+
+def _escape_like(prefix: str) -> str:
+    """Escapa os curingas do LIKE para que o prefixo seja tratado literalmente."""
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
@@ -0,0 +1,73 @@
+"""
+Micro-benchmark da colocação no anel Chord: chave a chave vs. API em lote.
+
+Uso (a partir de backend/):
+    python -m benchmarks.bench_chord --keys 50000
+"""
+import argparse
+import random
+import string
+import time
+
+from app import chord
+
+
+def best_of(repeat: int, fn):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def report(label: str, baseline: float, elapsed: float, keys: int):
+    print(f"  {label:<34} {elapsed * 1000:9.1f} ms  {keys / elapsed:12,.0f} chaves/s  {baseline / elapsed:6.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, default=50000)
+    parser.add_argument("--nodes", type=int, default=5)
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    keys = [
+        "user:" + "".join(rng.choices(string.ascii_lowercase + string.digits, k=rng.randint(4, 16)))
+        for _ in range(args.keys)
+    ]
+    nodes = [chord.ChordNode(id=i, name=f"Node-{i}", active=True) for i in range(1, args.nodes + 1)]
+    print(f"{args.keys} chaves, {args.nodes} nós, {args.replicas} réplicas, NumPy: {'sim' if chord.np is not None else 'não'}")
+
+    print("hash_string")
+    base, expected = best_of(args.repeat, lambda: [chord.hash_string(k) for k in keys])
+    report("laço por chave", base, base, len(keys))
+    elapsed, got = best_of(args.repeat, lambda: chord.hash_strings(keys))
+    assert got == expected, "hash_strings diverge de hash_string"
+    report("hash_strings (lote)", base, elapsed, len(keys))
+
+    for config in (chord.LEGACY_RING, chord.default_ring_config()):
+        ring = chord.ChordRing(nodes, config)
+        print(f"colocação (anel v{config.version}, {config.vnodes} vnodes)")
+
+        def per_key():
+            # Sem cache: simula a primeira colocação de um conjunto grande de usuários
+            chord.get_chord_position.cache_clear()
+            chord.hash32.cache_clear()
+            return [ring.get_replica_nodes(k, args.replicas) for k in keys]
+
+        base, expected = best_of(args.repeat, per_key)
+        report("get_replica_nodes por chave", base, base, len(keys))
+        elapsed, got = best_of(args.repeat, lambda: ring.place_many(keys, args.replicas))
+        assert [[n.id for n in r] for r in got] == [[n.id for n in r] for r in expected], "place_many diverge"
+        report("place_many (lote)", base, elapsed, len(keys))
+        elapsed, _ = best_of(args.repeat, lambda: [ring.get_replica_nodes(k, args.replicas) for k in keys])
+        report("get_replica_nodes (cache quente)", base, elapsed, len(keys))
+
+
+if __name__ == "__main__":
+    main()
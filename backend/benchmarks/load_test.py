@@ -0,0 +1,460 @@
+"""
+Teste de carga do backend do chat contra um KV Store local (sem Supabase).
+
+Sobe a app FastAPI num servidor uvicorn dentro do próprio processo (numa thread),
+com KV_BACKEND=memory ou sqlite, e simula:
+  - N usuários com WebSocket aberto a enviar mensagens de chat e indicadores de digitação;
+  - clientes REST a chamar /inbox, /conversations, /users e /admin/* segundo um mix configurável.
+
+Relata p50/p95/p99 de latência (entrega e ack das mensagens, cada rota REST),
+mensagens por segundo e idas ao KV Store por pedido, e grava tudo em JSON para
+comparar execuções entre commits (--compare).
+
+Uso (a partir de backend/; `pip install -r requirements-dev.txt` traz `websockets` e `httpx`):
+    python -m benchmarks.load_test --users 1000 --duration 30 --output results.json
+    python -m benchmarks.load_test --backend sqlite --compare results.json
+    python -m benchmarks.load_test --protocol msgpack --compare results.json
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+from app.services import wire
+
+PREFIX = "/make-server-aef9e41b"
+KV_PRIMITIVES = ("get_many", "set_many", "delete_many", "scan")
+DEFAULT_MIX = "inbox=4,conversations=3,history=2,users=1,admin_nodes=1,admin_distribution=1,admin_logs=1"
+
+# Rótulo (rota) do pedido em curso no servidor, para atribuir as idas ao KV Store
+current_label: contextvars.ContextVar = contextvars.ContextVar("current_label", default="background")
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # Método nearest-rank
+    rank = math.ceil(pct / 100 * len(sorted_values))
+    return sorted_values[min(len(sorted_values), max(rank, 1)) - 1]
+
+
+def summarize(samples: List[float]) -> dict:
+    values = sorted(samples)
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+# --- Instrumentação do servidor (só dentro deste processo) ---
+
+class KVCallCounter:
+    """Conta as idas ao motor do KV Store (operações primitivas) por rota."""
+
+    def __init__(self):
+        self.calls: Dict[str, Counter] = defaultdict(Counter)
+        self.requests: Counter = Counter()
+
+    def install(self, backend):
+        for op in KV_PRIMITIVES:
+            original = getattr(backend, op)
+
+            def counted(*args, _op=op, _original=original, **kwargs):
+                self.calls[current_label.get()][_op] += 1
+                return _original(*args, **kwargs)
+
+            setattr(backend, op, counted)
+
+
+class RouteLabelMiddleware:
+    """Middleware ASGI que marca cada pedido com o template da rota (ex.: GET /inbox)."""
+
+    def __init__(self, app, counter: KVCallCounter):
+        self.app = app
+        self.counter = counter
+        self._labels: Dict[tuple, str] = {}
+
+    def _label(self, scope) -> str:
+        method = scope.get("method", "WS")
+        cache_key = (method, scope["path"])
+        label = self._labels.get(cache_key)
+        if label is None:
+            from starlette.routing import Match
+            label = scope["path"]
+            for route in self.app.router.routes:
+                if route.matches(scope)[0] == Match.FULL:
+                    label = route.path
+                    break
+            label = f"{method} {label.replace(PREFIX, '')}"
+            self._labels[cache_key] = label
+        return label
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        label = self._label(scope)
+        if scope["type"] == "http":
+            self.counter.requests[label] += 1
+        token = current_label.set(label)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_label.reset(token)
+
+
+class ServerThread:
+    def __init__(self, app, port: int):
+        import uvicorn
+        config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", ws="websockets")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        deadline = time.monotonic() + 30
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError("o servidor não arrancou")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=30)
+
+
+# --- Carga ---
+
+class LoadStats:
+    def __init__(self):
+        self.deliver: List[float] = []
+        self.ack: List[float] = []
+        self.rest: Dict[str, List[float]] = defaultdict(list)
+        self.sent = 0
+        self.typing_sent = 0
+        self.delivered = 0
+        self.acked = 0
+        self.errors: Counter = Counter()
+        # seq -> instante de envio; id do servidor -> instante de envio (para o ack)
+        self.pending: Dict[int, float] = {}
+        self.by_server_id: Dict[str, float] = {}
+
+
+class LoadGenerator:
+    def __init__(self, args, base_url: str):
+        self.args = args
+        self.base_url = base_url
+        self.ws_url = base_url.replace("http", "ws", 1)
+        self.users = [f"bench{i:05d}" for i in range(args.users)]
+        self.stats = LoadStats()
+        self.rng = random.Random(args.seed)
+        self._seq = 0
+        self.connected = 0
+        self.mix = self._parse_mix(args.mix)
+
+    @staticmethod
+    def _parse_mix(spec: str) -> List[tuple]:
+        mix = []
+        for part in spec.split(","):
+            name, _, weight = part.partition("=")
+            mix.append((name.strip(), float(weight or 1)))
+        return mix
+
+    async def signup_all(self, client):
+        semaphore = asyncio.Semaphore(50)
+
+        async def signup(username):
+            async with semaphore:
+                await client.post(
+                    f"{PREFIX}/signup",
+                    json={"username": username, "password": "bench", "name": username.title()},
+                )
+
+        await asyncio.gather(*(signup(u) for u in self.users))
+
+    async def _reader(self, ws):
+        stats = self.stats
+        async for raw in ws:
+            now = time.perf_counter()
+            frame = wire.decode_binary(raw) if isinstance(raw, bytes) else json.loads(raw)
+            kind = frame.get("type")
+            if kind == "chat":
+                seq = int(frame["text"].rsplit(" ", 1)[-1])
+                sent_at = stats.pending.pop(seq, None)
+                if sent_at is not None:
+                    stats.deliver.append(now - sent_at)
+                    stats.delivered += 1
+                    stats.by_server_id[frame["id"]] = sent_at
+            elif kind == "ack":
+                sent_at = stats.by_server_id.pop(frame["id"], None)
+                if sent_at is not None:
+                    stats.ack.append(now - sent_at)
+                    stats.acked += 1
+            elif kind == "error":
+                stats.errors["ws_error: " + re.sub(r"bench\d+", "<user>", frame.get("message", ""))] += 1
+
+    async def _user(self, username: str, ready: asyncio.Event, deadline_box: list):
+        import websockets
+        args, stats = self.args, self.stats
+        rng = random.Random(f"{args.seed}-{username}")
+        try:
+            binary = args.protocol == "msgpack"
+            encode = wire.CODECS[wire.MSGPACK_PROTOCOL].encode if binary else json.dumps
+            async with websockets.connect(
+                f"{self.ws_url}{PREFIX}/ws/{username}",
+                max_queue=None,
+                subprotocols=[wire.MSGPACK_PROTOCOL] if binary else None,
+            ) as ws:
+                reader = asyncio.create_task(self._reader(ws))
+                self.connected += 1
+                await ready.wait()
+                try:
+                    while time.perf_counter() < deadline_box[0]:
+                        await asyncio.sleep(rng.expovariate(args.rate))
+                        if time.perf_counter() >= deadline_box[0]:
+                            break
+                        target = rng.choice(self.users)
+                        if target == username:
+                            continue
+                        if rng.random() < args.typing_ratio:
+                            await ws.send(encode({"type": "typing", "to": target, "status": "start"}))
+                            stats.typing_sent += 1
+                            continue
+                        self._seq += 1
+                        stats.pending[self._seq] = time.perf_counter()
+                        await ws.send(encode({"type": "chat", "to": target, "text": f"bench {self._seq}"}))
+                        stats.sent += 1
+                    # Dá tempo às últimas entregas e acks
+                    await asyncio.sleep(args.drain)
+                finally:
+                    reader.cancel()
+        except Exception as e:
+            stats.errors[type(e).__name__] += 1
+
+    def _rest_request(self):
+        user = self.rng.choice(self.users)
+        partner = self.rng.choice(self.users)
+        name = self.rng.choices([m[0] for m in self.mix], weights=[m[1] for m in self.mix])[0]
+        if name == "inbox":
+            return name, f"{PREFIX}/inbox", {"username": user, "limit": 50}
+        if name == "inbox_full":
+            return name, f"{PREFIX}/inbox", {"username": user}
+        if name == "conversations":
+            return name, f"{PREFIX}/conversations", {"username": user}
+        if name == "history":
+            return name, f"{PREFIX}/conversations/{partner}/messages", {"username": user, "limit": 50}
+        if name == "users":
+            return name, f"{PREFIX}/users", {"username": user}
+        if name == "admin_nodes":
+            return name, f"{PREFIX}/admin/nodes", None
+        if name == "admin_distribution":
+            return name, f"{PREFIX}/admin/distribution", None
+        if name == "admin_logs":
+            return name, f"{PREFIX}/admin/logs", None
+        raise ValueError(f"rota desconhecida no mix: {name}")
+
+    async def _rest_worker(self, client, ready: asyncio.Event, deadline_box: list, interval: float):
+        await ready.wait()
+        while time.perf_counter() < deadline_box[0]:
+            name, path, params = self._rest_request()
+            start = time.perf_counter()
+            try:
+                response = await client.get(path, params=params)
+                if response.status_code >= 400:
+                    self.stats.errors[f"http_{response.status_code}"] += 1
+            except Exception as e:
+                self.stats.errors[type(e).__name__] += 1
+                continue
+            elapsed = time.perf_counter() - start
+            self.stats.rest[name].append(elapsed)
+            if interval:
+                await asyncio.sleep(max(0.0, interval - elapsed))
+
+    async def run(self) -> float:
+        import httpx
+        args = self.args
+        limits = httpx.Limits(max_connections=args.rest_concurrency * 2)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=60) as client:
+            print(f"👥 Criando {len(self.users)} usuários...")
+            await self.signup_all(client)
+
+            ready = asyncio.Event()
+            deadline_box = [float("inf")]
+            print(f"🔌 Conectando {len(self.users)} WebSockets...")
+            users = []
+            for i in range(0, len(self.users), 100):
+                users.extend(
+                    asyncio.create_task(self._user(u, ready, deadline_box)) for u in self.users[i:i + 100]
+                )
+                await asyncio.sleep(0.05)
+            interval = args.rest_concurrency / args.rest_rps if args.rest_rps else 0.0
+            rest = [
+                asyncio.create_task(self._rest_worker(client, ready, deadline_box, interval))
+                for _ in range(args.rest_concurrency)
+            ]
+            # Só começa quando todos estiverem online (senão as primeiras mensagens falham)
+            connect_deadline = time.perf_counter() + 60
+            while self.connected < len(self.users) and time.perf_counter() < connect_deadline:
+                if all(t.done() for t in users):
+                    break
+                await asyncio.sleep(0.1)
+
+            print(f"🚀 Carga durante {args.duration}s...")
+            started = time.perf_counter()
+            deadline_box[0] = started + args.duration
+            ready.set()
+            await asyncio.gather(*rest)
+            elapsed = time.perf_counter() - started
+            await asyncio.gather(*users)
+            return elapsed
+
+
+def build_report(args, generator: LoadGenerator, counter: KVCallCounter, elapsed: float) -> dict:
+    stats = generator.stats
+    kv = {}
+    for label, ops in sorted(counter.calls.items()):
+        calls = sum(ops.values())
+        if label.startswith("WS"):
+            requests = stats.sent + stats.typing_sent
+        elif label == "background":
+            requests = stats.sent
+        else:
+            requests = counter.requests.get(label, 0)
+        kv[label] = {
+            "calls": calls,
+            "requests": requests,
+            "per_request": round(calls / requests, 3) if requests else None,
+            "by_op": dict(ops),
+        }
+    return {
+        "revision": git_revision(),
+        "timestamp": int(time.time()),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "throughput": {
+            "duration_s": round(elapsed, 3),
+            "chat_sent": stats.sent,
+            "typing_sent": stats.typing_sent,
+            "delivered": stats.delivered,
+            "acked": stats.acked,
+            "messages_per_s": round(stats.delivered / elapsed, 1) if elapsed else 0.0,
+            "rest_requests": sum(len(v) for v in stats.rest.values()),
+            "rest_per_s": round(sum(len(v) for v in stats.rest.values()) / elapsed, 1) if elapsed else 0.0,
+        },
+        "latency": {
+            "ws_deliver": summarize(stats.deliver),
+            "ws_ack": summarize(stats.ack),
+            **{f"rest_{name}": summarize(samples) for name, samples in sorted(stats.rest.items())},
+        },
+        "kv_calls": kv,
+        "errors": dict(stats.errors),
+    }
+
+
+def print_report(report: dict, baseline: Optional[dict] = None):
+    t = report["throughput"]
+    print(f"\n📊 {t['delivered']} mensagens entregues em {t['duration_s']}s → {t['messages_per_s']} msg/s; "
+          f"{t['rest_requests']} pedidos REST ({t['rest_per_s']}/s)")
+    print(f"{'latência':<28}{'n':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, s in report["latency"].items():
+        line = f"{name:<28}{s['count']:>8}{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}{s['p99_ms']:>10.2f}"
+        old = (baseline or {}).get("latency", {}).get(name)
+        if old and old["p99_ms"]:
+            line += f"   p99 {(s['p99_ms'] - old['p99_ms']) / old['p99_ms'] * 100:+.1f}%"
+        print(line)
+    print(f"\n{'idas ao KV Store':<40}{'chamadas':>10}{'por pedido':>12}")
+    for label, k in report["kv_calls"].items():
+        per_request = "-" if k["per_request"] is None else f"{k['per_request']:.2f}"
+        print(f"{label:<40}{k['calls']:>10}{per_request:>12}")
+    if baseline:
+        print(f"\n(comparado com {baseline.get('revision')}: "
+              f"{baseline['throughput']['messages_per_s']} msg/s antes)")
+    if report["errors"]:
+        print(f"\n⚠️ Erros: {report['errors']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="usuários com WebSocket aberto")
+    parser.add_argument("--duration", type=float, default=30, help="segundos de carga")
+    parser.add_argument("--rate", type=float, default=0.5, help="frames por segundo por usuário")
+    parser.add_argument("--typing-ratio", type=float, default=0.3, help="fração dos frames que são digitação")
+    parser.add_argument("--rest-concurrency", type=int, default=20)
+    parser.add_argument("--rest-rps", type=float, default=200, help="pedidos REST por segundo (0 = sem limite)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="pesos das rotas REST, ex.: inbox=4,users=1")
+    parser.add_argument("--backend", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--protocol", choices=("json", "msgpack"), default="json", help="formato dos frames WebSocket")
+    parser.add_argument("--drain", type=float, default=2.0, help="espera final pelas entregas e acks")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="ficheiro JSON com os resultados")
+    parser.add_argument("--compare", help="resultados JSON anteriores para comparar")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    tmpdir = tempfile.mkdtemp(prefix="okupopia-bench-")
+    # Configura o KV antes de importar a app (lido no import de app.database)
+    os.environ["KV_BACKEND"] = args.backend
+    os.environ["KV_SQLITE_PATH"] = os.path.join(tmpdir, "bench.db")
+    os.environ.setdefault("MESSAGE_BUS", "local")
+    # Uma fila por conexão grande o suficiente para medir latência e não expulsões
+    os.environ.setdefault("SEND_QUEUE_SIZE", "4096")
+
+    from app.main import app
+    from app.database import kv
+
+    counter = KVCallCounter()
+    counter.install(kv.backend)
+    port = free_port()
+    server = ServerThread(RouteLabelMiddleware(app, counter), port)
+    server.start()
+    try:
+        generator = LoadGenerator(args, f"http://127.0.0.1:{port}")
+        elapsed = asyncio.run(generator.run())
+    finally:
+        server.stop()
+
+    report = build_report(args, generator, counter, elapsed)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Resultados gravados em {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
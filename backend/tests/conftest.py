@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import uuid
+
+import pytest
+
+# Os testes correm sem Supabase: o motor é trocado por teste (memory ou sqlite)
+os.environ.setdefault("KV_BACKEND", "memory")
+os.environ.setdefault("MESSAGE_BUS", "local")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.database import kv  # noqa: E402
+from app.services.user_cache import user_cache  # noqa: E402
+from app.storage import MemoryBackend, SQLiteBackend  # noqa: E402
+
+BACKENDS = ["memory", "sqlite"]
+
+
+def make_backend(name: str, path) -> object:
+    if name == "memory":
+        return MemoryBackend()
+    return SQLiteBackend(str(path / f"{name}-{uuid.uuid4().hex[:6]}.db"))
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, tmp_path):
+    """Troca o motor da fachada `kv` por um vazio; quem usar a app (TestClient) faz o connect."""
+    previous = kv.backend
+    kv.backend = make_backend(request.param, tmp_path)
+    kv.clear_snapshots()
+    user_cache.clear()
+    yield kv.backend
+    kv.backend = previous
+    user_cache.clear()
+
+
+@pytest.fixture
+async def store(backend):
+    """A fachada `kv` ligada a um motor vazio, para testes assíncronos dos serviços."""
+    await kv.connect()
+    yield kv
+    await kv.close()
+
+
+def make_message(sender: str, recipient: str, text: str, offset_ms: int = 0, age_days: float = 0) -> dict:
+    timestamp = int((time.time() - age_days * 86400) * 1000) + offset_ms
+    return {
+        "id": f"{timestamp}-{uuid.uuid4().hex[:8]}",
+        "from": sender,
+        "to": recipient,
+        "text": text,
+        "timestamp": timestamp,
+        "read": False,
+        "type": "chat",
+        "deleted_for": [],
+    }
@@ -0,0 +1,66 @@
+import pytest
+
+from app import chord
+
+KEYS = [f"user:u{i}" for i in range(2000)]
+
+
+def nodes(*ids, inactive=()):
+    return [chord.ChordNode(id=i, name=f"Nó {i}", active=i not in inactive) for i in ids]
+
+
+@pytest.fixture(params=[chord.LEGACY_RING, chord.RingConfig(version=chord.VNODE_RING_VERSION, vnodes=16)],
+                ids=["v1", "v2"])
+def config(request):
+    return request.param
+
+
+def test_batched_positions_match_the_scalar_hash(config):
+    assert config.positions(KEYS) == [config.position(k) for k in KEYS]
+    assert chord.hash32_many(KEYS[:100]) == [chord.hash32(k) for k in KEYS[:100]]
+
+
+def test_place_many_matches_per_key_lookup(config):
+    ring = chord.ChordRing(nodes(1, 2, 3, 4, 5), config)
+    placed = ring.place_many(KEYS, 3)
+    assert [[n.id for n in p] for p in placed] == [[n.id for n in ring.get_replica_nodes(k, 3)] for k in KEYS]
+
+
+def test_replicas_are_distinct_physical_nodes_starting_at_the_primary(config):
+    ring = chord.ChordRing(nodes(1, 2, 3, 4, 5), config)
+    for key in KEYS[:200]:
+        replicas = ring.get_replica_nodes(key, 3)
+        assert len({n.id for n in replicas}) == 3
+        assert replicas[0].id == ring.find_responsible_node(key).id
+
+
+def test_inactive_nodes_own_nothing(config):
+    ring = chord.ChordRing(nodes(1, 2, 3, inactive=(2,)), config)
+    assert len(ring) == 2
+    assert all(ring.find_responsible_node(k).id != 2 for k in KEYS[:500])
+
+
+@pytest.mark.parametrize("replicas", [1, 3])
+def test_changed_ranges_cover_exactly_the_keys_that_move(config, replicas):
+    old = chord.ChordRing(nodes(1, 2, 3, 4, 5), config)
+    new = chord.ChordRing(nodes(1, 2, 3, 4, 5, inactive=(3,)), config)
+    moved = chord.changed_ranges(old, new, replicas)
+    before = old.place_many(KEYS, replicas)
+    after = new.place_many(KEYS, replicas)
+    for key, position, b, a in zip(KEYS, config.positions(KEYS), before, after):
+        inside = any(chord.in_range(position, start, end) for start, end in moved)
+        # Nos dois sentidos: quem muda de dono está num intervalo e quem está num intervalo muda
+        assert inside == ([n.id for n in b] != [n.id for n in a]), key
+
+
+def test_changed_ranges_is_empty_for_the_same_ring(config):
+    ring = chord.ChordRing(nodes(1, 2, 3), config)
+    assert chord.changed_ranges(ring, chord.ChordRing(nodes(1, 2, 3), config), 3) == []
+
+
+def test_changed_ranges_rejects_different_configs():
+    with pytest.raises(ValueError):
+        chord.changed_ranges(
+            chord.ChordRing(nodes(1, 2), chord.LEGACY_RING),
+            chord.ChordRing(nodes(1, 2), chord.RingConfig(version=chord.VNODE_RING_VERSION)),
+        )
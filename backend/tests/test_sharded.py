@@ -0,0 +1,156 @@
+import pytest
+
+from app import chord
+from app.storage import MemoryBackend, QuorumError, ShardedBackend
+from app.storage import anti_entropy
+from app.storage.anti_entropy import AntiEntropy
+
+from .conftest import BACKENDS, make_backend
+
+pytestmark = pytest.mark.anyio
+
+CONFIG = chord.RingConfig(version=chord.VNODE_RING_VERSION, vnodes=8)
+
+
+class Flaky:
+    """Partição que pode ser desligada: todas as operações falham enquanto `down`."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.down = False
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args):
+            if self.down:
+                raise ConnectionError("partição indisponível")
+            return await attr(*args)
+        return call
+
+
+@pytest.fixture(params=BACKENDS)
+async def cluster(request, tmp_path):
+    shards = {}
+
+    def factory(node_id):
+        shards[node_id] = Flaky(make_backend(request.param, tmp_path))
+        return shards[node_id]
+
+    backend = ShardedBackend(meta=MemoryBackend(), shard_factory=factory, replicas=3, write_quorum=2)
+    backend.anti_entropy = AntiEntropy(backend, interval=60, rate=0)
+    ring = chord.ChordRing([chord.ChordNode(id=i, name=f"Nó {i}", active=True) for i in range(1, 5)], CONFIG)
+    backend.set_ring(ring, handoff=False)
+    await backend.connect()
+    for node in ring.nodes:
+        backend._shard(node.id)
+    yield backend, shards
+    for shard in shards.values():
+        shard.down = False
+    await backend.close()
+
+
+async def raw(shards, node_id, key):
+    return (await shards[node_id].inner.get_many([key])).get(key)
+
+
+async def test_write_reaches_every_replica_in_envelopes(cluster):
+    backend, shards = cluster
+    await backend.set_many({"user:ana": {"name": "Ana"}})
+    owners = backend._owners("user:ana")
+    assert len(owners) == 3
+    for node_id in owners:
+        envelope = await raw(shards, node_id, "user:ana")
+        assert envelope["v"] == {"name": "Ana"} and envelope["t"] > 0
+    assert await backend.get("user:ana") == {"name": "Ana"}
+
+
+async def test_write_quorum_tolerates_one_replica_down(cluster):
+    backend, shards = cluster
+    owners = backend._owners("user:bia")
+    shards[owners[-1]].down = True
+    await backend.set_many({"user:bia": {"name": "Bia"}})
+    assert await raw(shards, owners[-1], "user:bia") is None
+    assert await backend.get("user:bia") == {"name": "Bia"}
+
+
+async def test_write_fails_without_quorum(cluster):
+    backend, shards = cluster
+    owners = backend._owners("user:caio")
+    for node_id in owners[1:]:
+        shards[node_id].down = True
+    with pytest.raises(QuorumError):
+        await backend.set_many({"user:caio": {"name": "Caio"}})
+
+
+async def test_delete_leaves_a_newer_tombstone(cluster):
+    backend, shards = cluster
+    await backend.set_many({"user:duda": {"name": "Duda"}})
+    await backend.delete_many(["user:duda"])
+    assert await backend.get("user:duda") is None
+    assert await backend.scan("user:") == []
+    for node_id in backend._owners("user:duda"):
+        envelope = await raw(shards, node_id, "user:duda")
+        assert envelope["d"] is True
+
+
+async def test_reads_resolve_divergent_replicas_by_version(cluster):
+    backend, shards = cluster
+    await backend.set_many({"user:edu": {"v": 1}})
+    owners = backend._owners("user:edu")
+    # Réplica mais próxima perdeu a remoção: a lápide mais recente das outras vence com quórum 2
+    shards[owners[0]].down = True
+    await backend.delete_many(["user:edu"])
+    shards[owners[0]].down = False
+    backend._down_until.clear()
+    backend.read_quorum = 2
+    assert await backend.get("user:edu") is None
+
+
+async def test_anti_entropy_repairs_only_divergent_leaves(cluster, monkeypatch):
+    backend, shards = cluster
+    monkeypatch.setattr(anti_entropy, "SCAN_PAGE", 40)
+    await backend.set_many({f"user:u{i:04d}": {"n": i} for i in range(600)})
+    assert await backend.anti_entropy._acquire_lease()
+    assert await backend.anti_entropy.run_once() == 0
+    built = backend.anti_entropy.scanned_keys
+    assert backend.anti_entropy.status()["leaves"] > 1
+
+    # Uma réplica falha durante uma escrita; as outras duas fazem o quórum
+    key = "user:u0007"
+    lagging = backend._owners(key)[-1]
+    shards[lagging].down = True
+    await backend.set_many({key: {"n": "novo"}})
+    shards[lagging].down = False
+    backend._down_until.clear()
+
+    assert await backend.anti_entropy.run_once() >= 1
+    assert (await raw(shards, lagging, key))["v"] == {"n": "novo"}
+    # Só as folhas divergentes foram relidas, não as partições inteiras
+    assert backend.anti_entropy.scanned_keys - built < built
+    assert await backend.anti_entropy.run_once() == 0
+
+
+async def test_anti_entropy_lease_has_a_single_owner(cluster):
+    backend, _ = cluster
+    other = AntiEntropy(backend, interval=60)
+    assert await backend.anti_entropy._acquire_lease()
+    assert not await other._acquire_lease()
+    # Sem a lease o outro worker não monta resumos nem paga nada por escrita
+    assert other.positions(["user:ana"]) is None
+
+
+async def test_rebalance_copies_moved_ranges_through_the_summaries(cluster):
+    backend, shards = cluster
+    old = backend.ring
+    await backend.set_many({f"user:u{i:04d}": {"n": i} for i in range(300)})
+    await backend.anti_entropy.run_once()
+    new = chord.ChordRing([n.model_copy(update={"active": n.id != 2}) for n in old.nodes], CONFIG)
+    backend.set_ring(new)
+    await backend.rebalance(old, new)
+    for i in range(300):
+        key = f"user:u{i:04d}"
+        for node_id in backend._owners(key):
+            assert (await raw(shards, node_id, key))["v"] == {"n": i}
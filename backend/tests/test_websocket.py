@@ -0,0 +1,124 @@
+import asyncio
+import zlib
+
+import msgpack
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+from app.database import kv
+from app.main import app
+from app.services import message_store, user_directory, websocket_manager, wire
+
+from .conftest import make_message
+
+API = "/make-server-aef9e41b"
+
+
+@pytest.fixture
+def client(backend):
+    with TestClient(app) as client:
+        yield client
+
+
+def queue_offline(client, *messages):
+    async def enqueue():
+        # Um group commit para todas, em vez de esperar cada lote
+        durable = [await message_store.enqueue_message(msg, pending=True) for msg in messages]
+        await asyncio.gather(*durable)
+    client.portal.call(enqueue)
+
+
+def pending(client, username):
+    return client.portal.call(kv.scan, message_store.pending_prefix(username))
+
+
+# --- Fila offline ---
+
+def test_batched_backlog_is_deleted_only_after_ack(client):
+    messages = [make_message("ana", "bob", f"offline {i}", offset_ms=i) for i in range(3)]
+    queue_offline(client, *messages)
+
+    with client.websocket_connect(f"{API}/ws/bob?backlog=batch") as ws:
+        frame = ws.receive_json()
+        assert frame["type"] == "backlog"
+        assert [m["id"] for m in frame["messages"]] == [m["id"] for m in messages]
+        assert frame["upTo"] == messages[-1]["id"] and frame["more"] is False
+    # Sem ack o lote volta na próxima conexão
+    assert len(pending(client, "bob")) == 3
+
+    with client.websocket_connect(f"{API}/ws/bob?backlog=batch") as ws:
+        frame = ws.receive_json()
+        ws.send_json({"type": "backlog_ack", "upTo": frame["upTo"]})
+        # O ack é processado antes do frame seguinte do mesmo cliente
+        ws.send_json({"type": "typing", "to": "ana"})
+    assert pending(client, "bob") == []
+
+
+def test_legacy_clients_receive_the_queue_as_chat_frames(client):
+    messages = [make_message("ana", "bob", f"offline {i}", offset_ms=i) for i in range(3)]
+    queue_offline(client, *messages)
+
+    with client.websocket_connect(f"{API}/ws/bob") as ws:
+        received = [ws.receive_json() for _ in messages]
+    assert [m["text"] for m in received] == [m["text"] for m in messages]
+    assert all(m["type"] == "chat" for m in received)
+    assert pending(client, "bob") == []
+
+
+def test_legacy_backlog_larger_than_the_send_queue_is_delivered_without_a_kick(client, monkeypatch):
+    # Um único lote maior do que a fila de saída: antes o push fechava a conexão com 1013
+    count = websocket_manager.SEND_QUEUE_SIZE + 44
+    monkeypatch.setattr("app.services.offline_queue.PENDING_BATCH", count * 2)
+    messages = [make_message("ana", "bob", f"offline {i}", offset_ms=i) for i in range(count)]
+    queue_offline(client, *messages)
+
+    with client.websocket_connect(f"{API}/ws/bob") as ws:
+        received = [ws.receive_json()["id"] for _ in messages]
+        ws.send_json({"type": "typing", "to": "ana"})
+    assert received == [m["id"] for m in messages]
+    assert pending(client, "bob") == []
+
+
+def test_legacy_backlog_is_kept_until_the_writer_sends_it(client, monkeypatch):
+    messages = [make_message("ana", "bob", f"offline {i}", offset_ms=i) for i in range(3)]
+    queue_offline(client, *messages)
+
+    async def never_flushes(self):
+        # Frames enfileirados mas a conexão cai antes de o writer os enviar
+        return False
+
+    monkeypatch.setattr(websocket_manager.Connection, "flush", never_flushes)
+    with client.websocket_connect(f"{API}/ws/bob") as ws:
+        ws.send_json({"type": "typing", "to": "ana"})
+    assert len(pending(client, "bob")) == 3
+
+
+# --- Frames binários ---
+
+def test_inflated_frames_over_the_limit_close_with_1009(client):
+    bomb = msgpack.packb({"type": "chat", "to": "ana", "text": "x" * (wire.WS_MAX_FRAME_BYTES * 2)})
+    with client.websocket_connect(f"{API}/ws/bob", subprotocols=[wire.MSGPACK_PROTOCOL]) as ws:
+        ws.send_bytes(bytes((wire.FLAG_DEFLATE,)) + zlib.compress(bomb, 9))
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_bytes()
+    assert closed.value.code == wire.CLOSE_TOO_BIG
+
+
+# --- /users ---
+
+def test_users_without_parameters_returns_the_first_page(client, monkeypatch):
+    monkeypatch.setattr(user_directory, "DEFAULT_USERS_PAGE", 3)
+
+    async def add_users():
+        for i in range(7):
+            await user_directory.add({"username": f"user{i}", "name": f"Usuário {i}"})
+    client.portal.call(add_users)
+
+    page = client.get(f"{API}/users", params={"username": "user0"}).json()
+    seen = [u["username"] for u in page["users"]]
+    assert len(seen) == 3
+    while page["nextCursor"]:
+        page = client.get(f"{API}/users", params={"username": "user0", "cursor": page["nextCursor"]}).json()
+        seen.extend(u["username"] for u in page["users"])
+    assert sorted(seen) == [f"user{i}" for i in range(1, 7)]
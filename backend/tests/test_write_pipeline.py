@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from app.services.write_pipeline import GroupCommitWriter
+
+pytestmark = pytest.mark.anyio
+
+
+class Recorder:
+    def __init__(self, delay: float = 0):
+        self.batches = []
+        self.delay = delay
+
+    async def __call__(self, items):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.batches.append(dict(items))
+
+
+async def test_group_commit_merges_concurrent_submits():
+    flush = Recorder()
+    writer = GroupCommitWriter(flush, max_batch=64, max_delay=0.05)
+    await writer.start()
+    futures = await asyncio.gather(*(writer.submit({f"k{i}": i}) for i in range(50)))
+    await asyncio.gather(*futures)
+    await writer.stop()
+
+    assert len(flush.batches) < 50
+    written = {k: v for batch in flush.batches for k, v in batch.items()}
+    assert written == {f"k{i}": i for i in range(50)}
+
+
+async def test_batches_never_exceed_max_batch():
+    flush = Recorder()
+    writer = GroupCommitWriter(flush, max_batch=4, max_delay=0.01)
+    await writer.start()
+    futures = [await writer.submit({f"k{i}": i}) for i in range(10)]
+    await asyncio.gather(*futures)
+    await writer.stop()
+
+    assert all(len(batch) <= 4 for batch in flush.batches)
+    assert sum(len(batch) for batch in flush.batches) == 10
+
+
+async def test_stop_drains_the_queue_in_max_batch_chunks():
+    flush = Recorder(delay=0.01)
+    writer = GroupCommitWriter(flush, max_batch=4, max_delay=0.5)
+    await writer.start()
+    for i in range(13):
+        assert writer.offer({f"k{i}": i})
+    await writer.stop()
+
+    assert sum(len(batch) for batch in flush.batches) == 13
+    assert all(len(batch) <= 4 for batch in flush.batches)
+    assert writer.pending == 0
+
+
+async def test_barrier_waits_for_submitted_writes():
+    flush = Recorder(delay=0.02)
+    writer = GroupCommitWriter(flush, max_batch=64, max_delay=0.05)
+    await writer.start()
+    writer.offer({"a": 1})
+    await writer.barrier()
+    assert flush.batches and flush.batches[0]["a"] == 1
+    await writer.stop()
+
+
+async def test_failed_flush_is_reported_to_every_waiter():
+    async def broken(items):
+        raise RuntimeError("disco cheio")
+
+    writer = GroupCommitWriter(broken, max_batch=8, max_delay=0.01)
+    await writer.start()
+    futures = [await writer.submit({f"k{i}": i}) for i in range(3)]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    await writer.stop()
+    assert all(isinstance(r, RuntimeError) for r in results)
@@ -36,7 +36,8 @@ export default function App() {
   useEffect(() => {
     if (!currentUser) return;
 
-    const wsUrl = `${API_URL.replace(/^http/, 'ws')}/ws/${currentUser.username}`;
+    // backlog=batch: a fila offline chega em lotes que o cliente confirma com backlog_ack
+    const wsUrl = `${API_URL.replace(/^http/, 'ws')}/ws/${currentUser.username}?backlog=batch`;
     const ws = new WebSocket(wsUrl);
 
     ws.onmessage = async (event) => {
@@ -67,6 +68,26 @@ export default function App() {
         setRefreshTrigger(prev => prev + 1);
       }
 
+      if (data.type === "backlog") {
+        // Mensagens recebidas enquanto estava offline: notifica por remetente e confirma o lote
+        const senders = new Map<string, { name: string; count: number; text: string }>();
+        for (const msg of data.messages) {
+          const entry = senders.get(msg.from) || { name: msg.name || msg.from, count: 0, text: msg.text };
+          entry.count += 1;
+          entry.text = msg.text;
+          senders.set(msg.from, entry);
+        }
+        senders.forEach((entry, from) => {
+          if (selectedConvRef.current?.username === from) return;
+          toast.info(`${entry.count > 1 ? `${entry.count} mensagens` : "Mensagem"} de ${entry.name}`, {
+            description: entry.text,
+            id: `msg-${from}`
+          });
+        });
+        ws.send(JSON.stringify({ type: "backlog_ack", upTo: data.upTo }));
+        setRefreshTrigger(prev => prev + 1);
+      }
+
       if (data.type === "read_receipt") {
         setRefreshTrigger(prev => prev + 1);
       }
@@ -32,6 +32,8 @@ export function ConversationList({
 }: ConversationListProps) {
   const [conversations, setConversations] = useState<Conversation[]>([]);
   const [allUsers, setAllUsers] = useState<{ username: string; name: string }[]>([]);
+  // nextCursor da última página de /users (null quando não há mais)
+  const [usersCursor, setUsersCursor] = useState<string | null>(null);
   const [loading, setLoading] = useState(true);
   const [showNewChat, setShowNewChat] = useState(false);
   const [showAdmin, setShowAdmin] = useState(false);
@@ -51,12 +53,15 @@ export function ConversationList({
     }
   };
 
-  const fetchAllUsers = async () => {
+  const fetchAllUsers = async (cursor: string | null = null) => {
     try {
-      const response = await fetch(`${API_URL}/users?username=${currentUsername}`);
+      const params = new URLSearchParams({ username: currentUsername });
+      if (cursor) params.set("cursor", cursor);
+      const response = await fetch(`${API_URL}/users?${params}`);
       if (response.ok) {
         const data = await response.json();
-        setAllUsers(data.users);
+        setAllUsers(prev => (cursor ? [...prev, ...data.users] : data.users));
+        setUsersCursor(data.nextCursor ?? null);
       }
     } catch (error) {
       console.error("Error:", error);
@@ -108,6 +113,11 @@ export function ConversationList({
                 </button>
               ))
             )}
+            {usersCursor && (
+              <button onClick={() => fetchAllUsers(usersCursor)} className="w-full p-4 text-center text-sm font-medium text-blue-600 hover:bg-gray-50">
+                Carregar mais
+              </button>
+            )}
           </div>
         </div>
       )}
@@ -0,0 +1,19 @@
+-- Os range scans do backend Python (prefixo + cursores after/before, ordem por key) assumem a
+-- ordem byte a byte das chaves. Com a collation padrão (ex.: en_US) a pontuação é ignorada no
+-- primeiro nível de comparação e "inbox:bob:1712..." cai fora do intervalo [inbox:bob:, inbox:bob;).
+-- Passa a coluna key da tabela KV (e das partições do modo sharded, kv_store_aef9e41b_*) para "C".
+DO $$
+DECLARE
+  t record;
+BEGIN
+  FOR t IN
+    SELECT c.table_schema, c.table_name
+    FROM information_schema.columns c
+    WHERE c.table_schema = 'public'
+      AND c.column_name = 'key'
+      AND (c.table_name = 'kv_store_aef9e41b' OR c.table_name LIKE 'kv\_store\_aef9e41b\_%')
+      AND c.collation_name IS DISTINCT FROM 'C'
+  LOOP
+    EXECUTE format('ALTER TABLE %I.%I ALTER COLUMN key TYPE text COLLATE "C"', t.table_schema, t.table_name);
+  END LOOP;
+END $$;